@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+from response_cache import get_response_cache
+
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Limits of the OpenAI Batch API per batch file: 50,000 requests and 200 MB; the size limit is kept with some margin.
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+
+def write_batch_files(batch_prefix, units, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """Write units as Batch API request lines (`unit_id` as `custom_id`) into `<batch_prefix>_<i>.jsonl` files.
+
+    A new file is started before one would exceed `max_requests` lines or `max_bytes` bytes.
+    Returns the paths of the files written.
+    """
+    if os.path.dirname(batch_prefix):
+        os.makedirs(os.path.dirname(batch_prefix), exist_ok=True)
+    paths = []
+    f = None
+    num_requests = num_bytes = 0
+    try:
+        for unit in units:
+            line = (json.dumps({
+                "custom_id": unit['unit_id'],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": unit['create_params'],
+            }) + "\n").encode("utf-8")
+            if f is None or num_requests >= max_requests or (num_requests > 0 and num_bytes + len(line) > max_bytes):
+                if f is not None:
+                    f.close()
+                paths.append(f"{batch_prefix}_{len(paths)}.jsonl")
+                f = open(paths[-1], 'wb')
+                num_requests = num_bytes = 0
+            f.write(line)
+            num_requests += 1
+            num_bytes += len(line)
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+class OpenAIBatchBackend:
+    """Submits batch files to the OpenAI Batch API."""
+
+    def __init__(self, client=None):
+        if client is None:
+            import openai
+            client = openai.OpenAI()
+        self.client = client
+
+    def submit(self, batch_path):
+        with open(batch_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        """Yield the output (and error) lines of a finished batch."""
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+class LocalBatchBackend:
+    """File-based stand-in for the Batch API, answering requests with the mock server responses.
+
+    Each batch lives in `<directory>/<batch id>/`; it is processed on the first poll after submission.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def submit(self, batch_path):
+        batch_id = f"batch_local_{uuid.uuid4().hex[:16]}"
+        batch_dir = os.path.join(self.directory, batch_id)
+        os.makedirs(batch_dir)
+        with open(batch_path, 'r') as src, open(os.path.join(batch_dir, "input.jsonl"), 'w') as dst:
+            dst.write(src.read())
+        self._write_status(batch_id, "validating")
+        return batch_id
+
+    def _write_status(self, batch_id, status):
+        with open(os.path.join(self.directory, batch_id, "status"), 'w') as f:
+            f.write(status)
+
+    def status(self, batch_id):
+        with open(os.path.join(self.directory, batch_id, "status"), 'r') as f:
+            status = f.read().strip()
+        if status == "validating":
+            self._write_status(batch_id, "in_progress")
+            return "in_progress"
+        if status == "in_progress":
+            self._process(batch_id)
+            self._write_status(batch_id, "completed")
+            return "completed"
+        return status
+
+    def _process(self, batch_id):
+        from mock_openai_server import build_completion
+        batch_dir = os.path.join(self.directory, batch_id)
+        with open(os.path.join(batch_dir, "input.jsonl"), 'r') as src, \
+                open(os.path.join(batch_dir, "output.jsonl"), 'w') as dst:
+            for line in src:
+                request = json.loads(line)
+                dst.write(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                    "custom_id": request['custom_id'],
+                    "response": {
+                        "status_code": 200,
+                        "request_id": uuid.uuid4().hex,
+                        "body": build_completion(request['body']),
+                    },
+                    "error": None,
+                }) + "\n")
+
+    def results(self, batch_id):
+        output_path = os.path.join(self.directory, batch_id, "output.jsonl")
+        if not os.path.exists(output_path):
+            return
+        with open(output_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def get_batch_backend(name, directory):
+    if name == 'openai':
+        return OpenAIBatchBackend()
+    if name == 'local':
+        return LocalBatchBackend(os.path.join(directory, "local_backend"))
+    raise ValueError(f"Unknown batch backend {name}")
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_batch(
+    units,
+    backend,
+    batch_prefix,
+    on_result,
+    poll_seconds=60,
+    max_batch_requests=MAX_BATCH_REQUESTS,
+    max_batch_bytes=MAX_BATCH_BYTES,
+    cache_path=None,
+    cache_mode='off',
+    cache_max_mb=1024,
+):
+    """Run units through a batch backend and call `on_result(unit, response)` for each of them.
+
+    Units are split into batch files `<batch_prefix>_<i>.jsonl` within the request count and size
+    limits of a batch file (see `write_batch_files`). Submitted batch ids are kept
+    in `<batch_prefix>_state.json` keyed by the digest of their file, so rerunning with the same
+    pending units polls the batches already submitted instead of paying for them twice.
+    Responses are mapped back to units by `custom_id`; units without a successful response get `None`.
+    """
+    cache = get_response_cache(cache_path, cache_mode, cache_max_mb)
+    pending = []
+    for unit in units:
+        cached_response = cache.get(unit['create_params']) if cache is not None else None
+        if cached_response is not None:
+            on_result(unit, cached_response)
+        else:
+            pending.append(unit)
+
+    state_path = f"{batch_prefix}_state.json"
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    batch_ids = []
+    for batch_path in write_batch_files(batch_prefix, pending, max_batch_requests, max_batch_bytes):
+        digest = _file_digest(batch_path)
+        if digest not in state:
+            state[digest] = backend.submit(batch_path)
+            with open(state_path, 'w') as f:
+                json.dump(state, f, indent=4)
+            print(f"Submitted batch {state[digest]} ({batch_path})")
+        batch_ids.append(state[digest])
+
+    units_by_id = {unit['unit_id']: unit for unit in pending}
+    num_errors = 0
+    for batch_id in batch_ids:
+        status = backend.status(batch_id)
+        while status not in TERMINAL_STATUSES:
+            print(f"Batch {batch_id}: {status}, polling again in {poll_seconds}s")
+            time.sleep(poll_seconds)
+            status = backend.status(batch_id)
+        print(f"Batch {batch_id}: {status}")
+        for line in backend.results(batch_id):
+            unit = units_by_id.pop(line['custom_id'], None)
+            if unit is None:
+                continue
+            response = line.get('response') or {}
+            if response.get('status_code') == 200:
+                body = response['body']
+                if cache is not None:
+                    cache.put(unit['create_params'], body)
+                on_result(unit, body)
+            else:
+                num_errors += 1
+                print(f"Batch Error: {line['custom_id']} - {line.get('error') or response.get('body')}")
+                on_result(unit, None)
+    for unit in units_by_id.values():
+        num_errors += 1
+        print(f"Batch Error: {unit['unit_id']} - no result returned")
+        on_result(unit, None)
+    if cache is not None:
+        print(f"Response cache ({cache.mode}): {cache.summary()}")
+        cache.close()
+    print(f"Batch run: {len(units) - len(pending)} cached, {len(pending)} submitted in {len(batch_ids)} batches, {num_errors} errors")
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from document_store import DocumentStore, RawDocument
+from synthetic_corpus import write_corpus
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_worker(approach, root, doc_names):
+    """Fetch the retrieved sections and ground truth of every document the way a step does it."""
+    os.chdir(root)
+    start = time.perf_counter()
+    num_sections = 0
+    if approach == "raw":
+        # Current approach: every document is fully parsed and kept for the whole run.
+        all_sections = {}
+        all_ground_truths = {}
+        for doc_name in doc_names:
+            with open(f"raw_data/outputs/{doc_name}.json", "r") as f:
+                output = json.load(f)
+            with open(f"raw_data/ground_truths/{doc_name}.json", "r") as f:
+                all_ground_truths[doc_name] = json.load(f)['synthesizer_result']
+            all_sections[doc_name] = {s['id']: s for s in output['chunker_result']['document_sections']}
+            for each_result in output['results']:
+                for section_id in each_result['retrieval_result']['relevant_sections']:
+                    num_sections += all_sections[doc_name][section_id] is not None
+    elif approach in ["raw_per_doc", "store"]:
+        store = DocumentStore("processed_data/document_store") if approach == "store" else None
+        for doc_name in doc_names:
+            document = store.open(doc_name) if store is not None else RawDocument(doc_name)
+            for each_result in document.metadata['results']:
+                section_ids = set(each_result['retrieval_result']['relevant_sections'])
+                num_sections += sum(1 for _ in document.iter_sections(section_ids))
+                document.ground_truth(each_result['retrieval_result']['line_item_name'])
+            document.close()
+    elif approach == "convert":
+        DocumentStore("processed_data/document_store").build(doc_names)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"approach": approach, "seconds": elapsed, "peak_rss_mb": peak_rss_mb(), "sections": num_sections}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark peak RSS and load time of the document store against raw JSON loading")
+    parser.add_argument(
+        "--num-docs",
+        type=int,
+        default=500,
+        required=False,
+        help="Number of synthetic documents"
+    )
+    parser.add_argument(
+        "--num-sections",
+        type=int,
+        default=40,
+        required=False,
+        help="Average number of sections per document"
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        default=None,
+        required=False,
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--root",
+        type=str,
+        default=None,
+        required=False,
+        help=argparse.SUPPRESS
+    )
+
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        with open(os.path.join(args.root, "doc_names.json"), "r") as f:
+            run_worker(args.worker, args.root, json.load(f))
+        sys.exit(0)
+
+    root = tempfile.mkdtemp(prefix="bench_document_store_")
+    try:
+        doc_names = write_corpus(root, args.num_docs, num_sections=args.num_sections)
+        with open(os.path.join(root, "doc_names.json"), "w") as f:
+            json.dump(doc_names, f)
+        corpus_mb = sum(
+            os.path.getsize(os.path.join(dir_path, name))
+            for dir_path, _, names in os.walk(os.path.join(root, "raw_data")) for name in names
+        ) / 1024 ** 2
+        print(f"Synthetic corpus: {len(doc_names)} documents, {corpus_mb:.1f} MB of raw JSON")
+        print(f"{'approach':>12} {'seconds':>9} {'peak RSS MB':>12}")
+        for approach in ["raw", "raw_per_doc", "convert", "store"]:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", approach, "--root", root],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{approach:>12} {result['seconds']:>9.2f} {result['peak_rss_mb']:>12.1f}")
+    finally:
+        shutil.rmtree(root)
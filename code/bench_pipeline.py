@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from mock_openai_server import ServerBehavior, start_mock_server
+from synthetic_corpus import write_corpus
+
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_NAME = "mock-model"
+# Higher is better for throughput, lower is better for the rest.
+GATED_METRICS = {"units_per_second": 1, "wall_seconds": -1, "peak_rss_mb": -1}
+# Timings of steps shorter than this are mostly interpreter startup noise and are not gated.
+MIN_GATED_SECONDS = 2.0
+
+
+def step_commands(args, doc_names):
+    """`(step name, command)` of every step of an end-to-end run."""
+    common = [
+        "--test-run", "",
+        "--docs", ",".join(doc_names),
+        "--model-name", MODEL_NAME,
+        "--n-jobs", str(args.n_jobs),
+        "--cache-mode", "off",
+    ]
+    if args.runner == "pipeline":
+        steps = [("pipeline", [os.path.join(CODE_DIR, "pipeline.py")] + common + ["--token-counter", args.token_counter])]
+    else:
+        steps = [
+            ("retrieval", [os.path.join(CODE_DIR, "step_3_retrieval.py")] + common + ["--token-counter", args.token_counter]),
+            ("extraction", [os.path.join(CODE_DIR, "step_4_extraction.py")] + common + [
+                "--retrieval-result", f"processed_data/step_3_retrieval_result_{MODEL_NAME}.json",
+            ]),
+        ]
+    steps.append(("evaluation", [
+        os.path.join(CODE_DIR, "step_5_evaluation.py"),
+        "--model-generation-path", f"processed_data/step_4_extraction_log_{MODEL_NAME}.json",
+    ]))
+    return steps
+
+
+RUN_REPORTS = {
+    "retrieval": f"processed_data/step_3_retrieval_run_report_{MODEL_NAME}.json",
+    "extraction": f"processed_data/step_4_extraction_run_report_{MODEL_NAME}.json",
+    "pipeline": f"processed_data/pipeline_run_report_{MODEL_NAME}.json",
+    "evaluation": f"processed_data/step_4_extraction_log_{MODEL_NAME}_eval_run_report.json",
+}
+
+
+def run_step(name, command, root, env):
+    """Run one step in `root`; returns its wall time and peak RSS, its output goes to `bench_<name>.log`."""
+    log_path = os.path.join(root, f"bench_{name}.log")
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable] + command, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        with open(log_path, "r") as f:
+            print("".join(f.readlines()[-30:]))
+        raise RuntimeError(f"Step {name} failed, see {log_path}")
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss_mb = usage.ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+    return wall_seconds, peak_rss_mb
+
+
+def step_metrics(name, root, wall_seconds, peak_rss_mb):
+    with open(os.path.join(root, RUN_REPORTS[name]), "r") as f:
+        report = json.load(f)
+    metrics = {"wall_seconds": wall_seconds, "peak_rss_mb": peak_rss_mb, "units": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    for stage in ["retrieval", "extraction"]:
+        metrics['units'] += report['counters'].get(f"{stage}_units", 0)
+        for kind in ["prompt_tokens", "completion_tokens"]:
+            metrics[kind] += report['distributions'].get(f"{stage}_{kind}", {}).get('total', 0)
+        latency = report['distributions'].get(f"{stage}_latency_seconds")
+        if latency is not None:
+            metrics[f"{stage}_latency_p50"] = latency['p50']
+            metrics[f"{stage}_latency_p95"] = latency['p95']
+            metrics[f"{stage}_latency_p99"] = latency['p99']
+    if name == "evaluation":
+        metrics['units'] = report['counters'].get("line_items", 0)
+    metrics['retries'] = report['counters'].get("dispatch_retries", 0)
+    metrics['units_per_second'] = metrics['units'] / max(wall_seconds, 1e-9)
+    return metrics
+
+
+def compare(report, baseline, max_regression):
+    """Messages for every gated metric that got worse than `baseline` by more than `max_regression`."""
+    regressions = []
+    for name, metrics in report['steps'].items():
+        baseline_metrics = baseline['steps'].get(name)
+        if baseline_metrics is None:
+            continue
+        for metric, direction in GATED_METRICS.items():
+            if metric != "peak_rss_mb" and baseline_metrics['wall_seconds'] < MIN_GATED_SECONDS:
+                continue
+            old, new = baseline_metrics[metric], metrics[metric]
+            if old <= 0:
+                continue
+            change = (new - old) / old
+            if change * direction < -max_regression:
+                regressions.append(f"{name} {metric}: {old:.2f} -> {new:.2f} ({change:+.1%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run steps 3-5 end to end on a synthetic corpus against the mock OpenAI server")
+    parser.add_argument(
+        "--num-docs",
+        type=int,
+        default=20,
+        required=False,
+        help="Number of synthetic documents"
+    )
+    parser.add_argument(
+        "--num-sections",
+        type=int,
+        default=30,
+        required=False,
+        help="Average number of sections per document"
+    )
+    parser.add_argument(
+        "--runner",
+        choices=['steps', 'pipeline'],
+        default='steps',
+        required=False,
+        help="steps: step 3 then step 4, pipeline: code/pipeline.py; step 5 runs after either"
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=32,
+        required=False,
+        help="Number of concurrent requests of every step"
+    )
+    parser.add_argument(
+        "--token-counter",
+        choices=['hf', 'estimate'],
+        default='estimate',
+        required=False,
+        help="Token counter of the retrieval step, estimate avoids needing the tokenizer offline"
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=200.0,
+        required=False,
+        help="Median simulated latency of a request in milliseconds"
+    )
+    parser.add_argument(
+        "--latency-sigma",
+        type=float,
+        default=0.5,
+        required=False,
+        help="Shape of the lognormal latency distribution, 0 for a constant latency"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.01,
+        required=False,
+        help="Fraction of requests answered with a 429 or a 500"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        required=False,
+        help="Random seed of the corpus and of the simulated latency and errors"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        required=False,
+        help="Where to write the benchmark report (JSON)"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        required=False,
+        help="Benchmark report to compare against; exits with status 1 on a regression"
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.15,
+        required=False,
+        help="Relative slowdown (or memory growth) of a step tolerated against the baseline"
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the working directory with the corpus, outputs and step logs"
+    )
+
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_pipeline_")
+    server = start_mock_server(behavior=ServerBehavior(args.latency_ms, args.latency_sigma, args.error_rate, seed=args.seed))
+    env = dict(os.environ, OPENAI_BASE_URL=server.base_url, OPENAI_API_KEY="mock", HF_HUB_OFFLINE="1")
+    try:
+        doc_names = write_corpus(root, args.num_docs, num_sections=args.num_sections, seed=args.seed)
+        print(f"Synthetic corpus: {len(doc_names)} documents in {root}, mock server at {server.base_url}")
+        report = {"config": vars(args), "steps": {}}
+        for name, command in step_commands(args, doc_names):
+            wall_seconds, peak_rss_mb = run_step(name, command, root, env)
+            report['steps'][name] = step_metrics(name, root, wall_seconds, peak_rss_mb)
+        steps = report['steps'].values()
+        report['total'] = {
+            "wall_seconds": sum(m['wall_seconds'] for m in steps),
+            "peak_rss_mb": max(m['peak_rss_mb'] for m in steps),
+            "prompt_tokens": sum(m['prompt_tokens'] for m in steps),
+            "completion_tokens": sum(m['completion_tokens'] for m in steps),
+        }
+        report['mock'] = {"requests": server.request_count, "errors": server.error_count}
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(root)
+
+    print(f"{'step':>12} {'units':>7} {'units/s':>9} {'seconds':>9} {'peak RSS MB':>12} {'prompt tok':>11} {'compl tok':>10} {'retries':>8}")
+    for name, metrics in report['steps'].items():
+        print(f"{name:>12} {metrics['units']:>7} {metrics['units_per_second']:>9.1f} {metrics['wall_seconds']:>9.2f} {metrics['peak_rss_mb']:>12.1f} {metrics['prompt_tokens']:>11} {metrics['completion_tokens']:>10} {metrics['retries']:>8}")
+    total = report['total']
+    print(f"Total: {total['wall_seconds']:.2f}s, peak RSS {total['peak_rss_mb']:.1f} MB, {total['prompt_tokens']} prompt and {total['completion_tokens']} completion tokens, mock served {report['mock']['requests']} requests ({report['mock']['errors']} errors)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"No regression beyond {args.max_regression:.0%} against {args.baseline}")
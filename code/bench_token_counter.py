@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import random
+import argparse
+import subprocess
+from section_grouper import section_content
+from synthetic_corpus import make_section
+from token_counter import DEFAULT_TOKENIZER, EstimatedTokenCounter, HFTokenCounter, calibrate
+
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_COMMANDS = {
+    "eager tokenizer load (previous step 3 import)": [
+        "-c", f"from transformers import AutoTokenizer; AutoTokenizer.from_pretrained({DEFAULT_TOKENIZER!r})",
+    ],
+    "step_3_retrieval.py --help": [os.path.join(CODE_DIR, "step_3_retrieval.py"), "--help"],
+    "lazy HF counter, first count": [
+        "-c", f"import sys; sys.path.insert(0, {CODE_DIR!r}); from token_counter import HFTokenCounter; HFTokenCounter().count('x')",
+    ],
+    "estimator, first count": [
+        "-c", f"import sys; sys.path.insert(0, {CODE_DIR!r}); from token_counter import estimate_tokens; estimate_tokens('x')",
+    ],
+}
+
+
+def time_command(command, repeats):
+    """Best wall time of `repeats` fresh interpreter runs, or None if the command fails."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + command, capture_output=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            return None
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark startup time and counting speed of the token counters")
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        required=False,
+        help="Runs per startup command, the best one is reported"
+    )
+    parser.add_argument(
+        "--num-sections",
+        type=int,
+        default=2000,
+        required=False,
+        help="Number of synthetic sections to count"
+    )
+
+    args = parser.parse_args()
+
+    print(f"{'startup':>48} {'seconds':>9}")
+    for name, command in STARTUP_COMMANDS.items():
+        elapsed = time_command(command, args.repeats)
+        print(f"{name:>48} {'failed' if elapsed is None else f'{elapsed:.2f}':>9}")
+
+    rng = random.Random(0)
+    texts = [section_content(make_section("synthetic", i, rng, 50, 900)) for i in range(args.num_sections)]
+    start = time.perf_counter()
+    EstimatedTokenCounter().count_batch(texts)
+    estimate_seconds = time.perf_counter() - start
+    print(f"\nCounting {len(texts)} sections: estimator {estimate_seconds:.2f}s")
+    reference = HFTokenCounter()
+    try:
+        reference.tokenizer
+    except Exception as e:
+        print(f"Tokenizer {DEFAULT_TOKENIZER} not available ({e}), skipping the accuracy comparison")
+        sys.exit(0)
+    start = time.perf_counter()
+    reference.count_batch(texts)
+    print(f"Counting {len(texts)} sections: tokenizer {time.perf_counter() - start:.2f}s (loaded)")
+    estimator, relative_errors = calibrate(texts, reference)
+    print(f"Estimator calibrated on these sections: held-out relative error mean {relative_errors.mean():.3f}, p99 {estimator.error_bound:.3f}")
@@ -0,0 +1,87 @@
+import os
+import json
+
+
+class Checkpoint:
+    """Append-only JSONL file with one record per completed processing unit.
+
+    Records are looked up by their `unit_id` through an in-memory byte offset index,
+    so final outputs can be assembled by streaming the file instead of keeping every
+    unit in memory. Without `resume` an existing checkpoint is discarded.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        self._offsets = {}
+        self._scan()
+        self._file = open(path, 'ab')
+
+    def _scan(self):
+        """Index existing records; a torn last line from an interrupted run is cut off."""
+        if not os.path.exists(self.path):
+            return
+        valid_end = 0
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self._offsets[record['unit_id']] = offset
+                offset += len(line)
+                valid_end = offset
+        if valid_end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_end)
+
+    def completed_ids(self):
+        return set(self._offsets)
+
+    def append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._offsets[record['unit_id']] = self._file.tell()
+        self._file.write(line)
+        self._file.flush()
+
+    def iter_records(self, unit_ids=None):
+        """Stream records in the order of `unit_ids` (file order by default), skipping missing ones."""
+        self._file.flush()
+        if unit_ids is None:
+            unit_ids = sorted(self._offsets, key=self._offsets.get)
+        with open(self.path, 'rb') as f:
+            for unit_id in unit_ids:
+                if unit_id not in self._offsets:
+                    continue
+                f.seek(self._offsets[unit_id])
+                yield json.loads(f.readline())
+
+    def close(self):
+        self._file.close()
+
+
+def format_array_item(record):
+    """A record as it appears inside a `json.dump(records, f, indent=4)` array."""
+    # Indented JSON has no blank lines, so every line gets the extra indentation.
+    return "    " + json.dumps(record, indent=4).replace("\n", "\n    ")
+
+
+def write_json_array(path, records, preformatted=False):
+    """Stream records into a JSON array file, formatted like `json.dump(records, f, indent=4)`.
+
+    With `preformatted`, `records` are strings already rendered with `format_array_item`.
+    """
+    with open(path, 'w') as f:
+        f.write("[")
+        is_empty = True
+        for record in records:
+            f.write("\n" if is_empty else ",\n")
+            f.write(record if preformatted else format_array_item(record))
+            is_empty = False
+        f.write("]" if is_empty else "\n]")
@@ -0,0 +1,220 @@
+import os
+import json
+import mmap
+import argparse
+from manifest import document_fingerprint
+
+
+class RawDocument:
+    """A document read straight from `raw_data/outputs/{doc}.json` and `raw_data/ground_truths/{doc}.json`."""
+
+    def __init__(self, doc_name, raw_dir="raw_data"):
+        self.doc_name = doc_name
+        self.raw_dir = raw_dir
+        with open(os.path.join(raw_dir, "outputs", f"{doc_name}.json"), "r") as f:
+            output = json.load(f)
+        self._sections = output.pop('chunker_result')['document_sections']
+        self._section_index = {s['id']: s for s in self._sections}
+        self.metadata = output
+        self._ground_truth = None
+
+    def section_ids(self):
+        return [s['id'] for s in self._sections]
+
+    def iter_sections(self, section_ids=None):
+        """Sections in document order, optionally only those in `section_ids`."""
+        for each_section in self._sections:
+            if section_ids is None or each_section['id'] in section_ids:
+                yield each_section
+
+    def get_section(self, section_id):
+        return self._section_index.get(section_id)
+
+    def fingerprint(self):
+        """`document_fingerprint` of the sections."""
+        return document_fingerprint(self._sections)
+
+    def ground_truth(self, line_item_name):
+        if self._ground_truth is None:
+            with open(os.path.join(self.raw_dir, "ground_truths", f"{self.doc_name}.json"), "r") as f:
+                self._ground_truth = json.load(f)['synthesizer_result']
+        return self._ground_truth[line_item_name]
+
+    def close(self):
+        self._sections = None
+        self._section_index = None
+
+
+class StoredDocument:
+    """A converted document: sections and ground truth items are memory-mapped and decoded on first access."""
+
+    def __init__(self, doc_name, store_dir):
+        self.doc_name = doc_name
+        with open(os.path.join(store_dir, f"{doc_name}.index.json"), "r") as f:
+            index = json.load(f)
+        self.metadata = index['metadata']
+        self._section_index = {section_id: (offset, length) for section_id, offset, length in index['sections']}
+        self._section_order = [section_id for section_id, _, _ in index['sections']]
+        self._section_position = {section_id: position for position, section_id in enumerate(self._section_order)}
+        self._fingerprint = index.get('fingerprint')
+        self._ground_truth_index = index['ground_truth']
+        self._decoded = {}
+        self._files = []
+        self._sections = self._map(os.path.join(store_dir, f"{doc_name}.sections.bin"))
+        self._ground_truths = self._map(os.path.join(store_dir, f"{doc_name}.ground_truth.bin"))
+
+    def _map(self, path):
+        f = open(path, "rb")
+        self._files.append(f)
+        if os.path.getsize(path) == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def section_ids(self):
+        return list(self._section_order)
+
+    def iter_sections(self, section_ids=None):
+        """Sections in document order, optionally only those in `section_ids`; only the sections yielded are decoded."""
+        if section_ids is None:
+            section_ids = self._section_order
+        else:
+            section_ids = sorted(
+                (section_id for section_id in section_ids if section_id in self._section_position),
+                key=self._section_position.get,
+            )
+        for section_id in section_ids:
+            yield self.get_section(section_id)
+
+    def get_section(self, section_id):
+        if section_id not in self._section_index:
+            return None
+        if section_id not in self._decoded:
+            offset, length = self._section_index[section_id]
+            self._decoded[section_id] = json.loads(self._sections[offset:offset + length].decode("utf-8"))
+        return self._decoded[section_id]
+
+    def fingerprint(self):
+        """`document_fingerprint` of the sections, computed at conversion so that it needs no section decoded."""
+        if self._fingerprint is None:
+            self._fingerprint = document_fingerprint(self.iter_sections())
+        return self._fingerprint
+
+    def ground_truth(self, line_item_name):
+        offset, length = self._ground_truth_index[line_item_name]
+        return json.loads(self._ground_truths[offset:offset + length].decode("utf-8"))
+
+    def close(self):
+        self._decoded = {}
+        for data in [self._sections, self._ground_truths]:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for f in self._files:
+            f.close()
+
+
+def _write_records(path, records):
+    """Write JSON records back to back; returns `(offset, length)` of each."""
+    spans = []
+    offset = 0
+    with open(path, "wb") as f:
+        for record in records:
+            data = json.dumps(record).encode("utf-8")
+            f.write(data)
+            spans.append((offset, len(data)))
+            offset += len(data)
+    return spans
+
+
+def convert_document(doc_name, raw_dir, store_dir):
+    """Convert one document to `{doc}.sections.bin`, `{doc}.ground_truth.bin` and `{doc}.index.json`."""
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(raw_dir, "outputs", f"{doc_name}.json"), "r") as f:
+        output = json.load(f)
+    sections = output.pop('chunker_result')['document_sections']
+    section_spans = _write_records(os.path.join(store_dir, f"{doc_name}.sections.bin"), sections)
+    ground_truth_path = os.path.join(raw_dir, "ground_truths", f"{doc_name}.json")
+    ground_truth = {}
+    if os.path.exists(ground_truth_path):
+        with open(ground_truth_path, "r") as f:
+            ground_truth = json.load(f)['synthesizer_result']
+    ground_truth_spans = _write_records(
+        os.path.join(store_dir, f"{doc_name}.ground_truth.bin"), list(ground_truth.values())
+    )
+    ground_truth_index = dict(zip(ground_truth, ground_truth_spans))
+    index = {
+        "sections": [[s['id'], offset, length] for s, (offset, length) in zip(sections, section_spans)],
+        "ground_truth": ground_truth_index,
+        "metadata": output,
+        "fingerprint": document_fingerprint(sections),
+    }
+    # The index is written last, so a partially converted document is converted again.
+    tmp_path = os.path.join(store_dir, f"{doc_name}.index.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(store_dir, f"{doc_name}.index.json"))
+
+
+class DocumentStore:
+    """Directory of converted documents, converted from `raw_dir` the first time they are needed."""
+
+    def __init__(self, store_dir, raw_dir="raw_data"):
+        self.store_dir = store_dir
+        self.raw_dir = raw_dir
+
+    def _is_current(self, doc_name):
+        index_path = os.path.join(self.store_dir, f"{doc_name}.index.json")
+        if not os.path.exists(index_path):
+            return False
+        index_mtime = os.path.getmtime(index_path)
+        for sub_dir in ["outputs", "ground_truths"]:
+            source_path = os.path.join(self.raw_dir, sub_dir, f"{doc_name}.json")
+            if os.path.exists(source_path) and os.path.getmtime(source_path) > index_mtime:
+                return False
+        return True
+
+    def build(self, doc_names):
+        """Convert the documents that are missing or older than their raw JSON; returns how many were converted."""
+        num_converted = 0
+        for doc_name in doc_names:
+            if not self._is_current(doc_name):
+                convert_document(doc_name, self.raw_dir, self.store_dir)
+                num_converted += 1
+        return num_converted
+
+    def open(self, doc_name):
+        if not self._is_current(doc_name):
+            convert_document(doc_name, self.raw_dir, self.store_dir)
+        return StoredDocument(doc_name, self.store_dir)
+
+
+def open_document(doc_name, store=None):
+    """Open a document from `store` when given, else from the raw JSON files."""
+    if store is not None:
+        return store.open(doc_name)
+    return RawDocument(doc_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert raw_data JSON documents into the indexed document store")
+    parser.add_argument(
+        "--store-dir",
+        type=str,
+        default="processed_data/document_store",
+        required=False,
+        help="Directory of the document store"
+    )
+    parser.add_argument(
+        "--raw-dir",
+        type=str,
+        default="raw_data",
+        required=False,
+        help="Directory holding outputs/ and ground_truths/"
+    )
+
+    args = parser.parse_args()
+
+    doc_names = sorted(
+        name[:-len(".json")] for name in os.listdir(os.path.join(args.raw_dir, "outputs")) if name.endswith(".json")
+    )
+    num_converted = DocumentStore(args.store_dir, raw_dir=args.raw_dir).build(doc_names)
+    print(f"Converted {num_converted} of {len(doc_names)} documents into {args.store_dir}")
@@ -0,0 +1,150 @@
+import re
+import json
+import argparse
+import numpy as np
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "any", "are", "as", "at", "be", "by", "can", "contains", "each", "extract", "find",
+    "for", "from", "if", "in", "is", "it", "its", "of", "on", "or", "section", "sections", "that", "the",
+    "this", "to", "which", "with",
+}
+
+
+def tokenize(text):
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over the sections of one document.
+
+    The per-(section, term) BM25 weights are precomputed into one matrix, so scoring a
+    query is a single column gather and matrix-vector product.
+    """
+
+    def __init__(self, sections, k1=1.5, b=0.75):
+        # `sections` may be a stream, it is read once.
+        self.section_ids = []
+        docs_tokens = []
+        for s in sections:
+            self.section_ids.append(s['id'])
+            docs_tokens.append(tokenize(f"{s['title']}\n{s['text']}"))
+        self.vocab = {}
+        rows, cols = [], []
+        for row, tokens in enumerate(docs_tokens):
+            for token in tokens:
+                rows.append(row)
+                cols.append(self.vocab.setdefault(token, len(self.vocab)))
+        tf = np.zeros((len(self.section_ids), max(1, len(self.vocab))), dtype=np.float32)
+        np.add.at(tf, (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)), 1.0)
+        doc_len = tf.sum(axis=1, keepdims=True)
+        avg_doc_len = max(float(doc_len.mean()), 1.0) if len(self.section_ids) else 1.0
+        doc_freq = (tf > 0).sum(axis=0)
+        idf = np.log1p((len(self.section_ids) - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * doc_len / avg_doc_len)
+        self.weights = idf * tf * (k1 + 1) / (tf + norm)
+
+    def scores(self, query):
+        term_ids = [self.vocab[t] for t in tokenize(query) if t in self.vocab]
+        if not term_ids or not self.section_ids:
+            return np.zeros(len(self.section_ids), dtype=np.float32)
+        term_ids, counts = np.unique(np.array(term_ids), return_counts=True)
+        return self.weights[:, term_ids] @ counts.astype(np.float32)
+
+    def select(self, query, top_k=20, threshold=0.0, margin=0):
+        """Ids of the sections to keep for `query`, in document order.
+
+        Keeps the `top_k` best ranked sections plus any section scoring at least `threshold`
+        times the best score, then `margin` more of the next ranked sections as a recall safety net.
+        """
+        scores = self.scores(query)
+        if len(scores) == 0:
+            return []
+        ranking = np.argsort(-scores, kind="stable")
+        num_keep = min(top_k, len(ranking))
+        if threshold > 0 and scores.max() > 0:
+            num_keep = max(num_keep, int((scores >= threshold * scores.max()).sum()))
+        num_keep = min(num_keep + margin, len(ranking))
+        keep = np.sort(ranking[:num_keep])
+        return [self.section_ids[i] for i in keep]
+
+
+def section_recall(selected_ids, relevant_ids):
+    relevant_ids = set(relevant_ids)
+    if not relevant_ids:
+        return 1.0
+    return len(relevant_ids & set(selected_ids)) / len(relevant_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report recall of the BM25 section pre-filter against existing retrieval results")
+    parser.add_argument(
+        "--docs",
+        type=str,
+        nargs="+",
+        default=[
+            "adventis", "ancora_heart", "andrian", "anomali", "at_bay", "bitgo", "corium",
+            "gardner", "jfrog", "park_place", "people_ai", "sprout", "standard_biotools", "sylabs",
+        ],
+        required=False,
+        help="Documents to evaluate"
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        nargs="+",
+        default=[5, 10, 20, 30, 50],
+        required=False,
+        help="top-k values to report"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Relative score threshold"
+    )
+    parser.add_argument(
+        "--margin",
+        type=int,
+        default=0,
+        required=False,
+        help="Extra sections kept beyond the cutoff"
+    )
+
+    args = parser.parse_args()
+
+    with open("raw_data/retrieval_instructions.json", "r") as f:
+        line_item_descs_dct = {d['Line item name']: d for d in json.load(f)}
+
+    indexed_docs = []
+    for doc_name in args.docs:
+        with open(f"raw_data/outputs/{doc_name}.json", "r") as f:
+            doc = json.load(f)
+        sections = doc['chunker_result']['document_sections']
+        section_chars = {s['id']: len(s['title']) + len(s['text']) for s in sections}
+        relevant = {
+            r['retrieval_result']['line_item_name']: r['retrieval_result']['relevant_sections']
+            for r in doc['results']
+        }
+        indexed_docs.append((doc_name, BM25Index(sections), section_chars, relevant))
+
+    print(f"{'top_k':>6} {'mean recall':>12} {'min recall':>11} {'full recall':>12} {'kept sections':>14} {'kept chars':>11}")
+    for top_k in args.top_k:
+        recalls, kept_sections, kept_chars = [], [], []
+        for doc_name, index, section_chars, relevant in indexed_docs:
+            total_chars = sum(section_chars.values())
+            for item_name, relevant_ids in relevant.items():
+                if item_name not in line_item_descs_dct:
+                    continue
+                query = f"{item_name}\n{line_item_descs_dct[item_name]['Line item instruction']}"
+                selected = index.select(query, top_k=top_k, threshold=args.threshold, margin=args.margin)
+                recalls.append(section_recall(selected, relevant_ids))
+                kept_sections.append(len(selected) / max(1, len(section_chars)))
+                kept_chars.append(sum(section_chars[s] for s in selected) / max(1, total_chars))
+        recalls = np.array(recalls)
+        print(
+            f"{top_k:>6} {recalls.mean():>12.3f} {recalls.min():>11.3f} {(recalls == 1).mean():>12.3f} "
+            f"{np.mean(kept_sections):>14.3f} {np.mean(kept_chars):>11.3f}"
+        )
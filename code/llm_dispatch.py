@@ -0,0 +1,242 @@
+import time
+import asyncio
+import itertools
+from tqdm import tqdm
+from rate_limiter import (
+    RateLimiter,
+    RunStats,
+    backoff_delay,
+    estimate_prompt_tokens,
+    get_retry_after,
+    is_retryable_error,
+)
+from response_cache import get_response_cache
+
+
+# Follow-up units returned by `on_result` are sent before the queued units (priority 0).
+FOLLOW_UP_PRIORITY = -1
+
+
+def get_async_client():
+    """Create the single pooled client shared by every request of a run.
+
+    Retries are handled by the dispatcher so that they respect the run's rate budgets.
+    `openai` is imported here, so that scripts start without paying for it until the first request.
+    """
+    import openai
+    return openai.AsyncOpenAI(max_retries=0)
+
+
+def describe_unit(unit):
+    """Short human readable label of a processing unit for log lines."""
+    item_name = unit.get('item_name', unit.get('line_item_name'))
+    if item_name is None:
+        item_names = unit.get('item_names', unit.get('line_item_names'))
+        if item_names is not None:
+            item_name = ", ".join(item_names)
+    parts = [unit.get('doc_name'), item_name]
+    if 'section_group_idx' in unit:
+        parts.append(unit['section_group_idx'])
+    return " - ".join(str(p) for p in parts if p is not None)
+
+
+def unit_token_estimate(unit):
+    if unit.get('estimated_tokens') is None:
+        unit['estimated_tokens'] = estimate_prompt_tokens(unit['create_params'])
+    return unit['estimated_tokens']
+
+
+class LLMDispatcher:
+    """Runs processing units on a shared AsyncOpenAI client with a bounded number of in-flight requests.
+
+    Pending units are served by `priority` (lower first, see `submit`), then largest estimated
+    prompt first to shorten the tail of a run.
+    Units whose `create_params` are already in `cache` are answered without an API call.
+    With `warmup`, only the first unit of every `prefix_key` is sent at once; its siblings
+    are held back until it returns, so they hit the provider's prompt cache. Within a priority,
+    these warm-up units go first, so that their siblings are released early.
+    Requests are admitted through the RPM/TPM budgets of `limiter` and retried with jittered
+    exponential backoff on rate limits and transient errors. Results are streamed back in
+    completion order, with the time spent on each unit in `unit['latency_seconds']` and its
+    retries in `unit['retries']`; new units can be submitted while the stream is being consumed.
+    """
+
+    def __init__(self, client, concurrency=16, limiter=None, max_retries=6, stats=None, cache=None, warmup=False):
+        self.client = client
+        self.cache = cache
+        self.warmup = warmup
+        self._held_back = {}
+        self._warm_prefixes = set()
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.stats = stats or RunStats()
+        self._pending = asyncio.PriorityQueue()
+        self._results = asyncio.Queue()
+        self._outstanding = 0
+        self._order = itertools.count()
+
+    def submit(self, unit, priority=0):
+        """Queue a unit, before or while `stream` runs; units with a lower `priority` are sent first."""
+        self._outstanding += 1
+        key = unit.get('prefix_key') if self.warmup else None
+        if key is None or key in self._warm_prefixes:
+            self._enqueue(unit, priority)
+        elif key in self._held_back:
+            self._held_back[key].append((unit, priority))
+        else:
+            self._held_back[key] = []
+            self._enqueue(unit, priority, is_warmup=True)
+
+    def _enqueue(self, unit, priority=0, is_warmup=False):
+        self._pending.put_nowait(
+            (priority, 0 if is_warmup else 1, -unit_token_estimate(unit), next(self._order), unit)
+        )
+
+    def _release(self, unit):
+        key = unit.get('prefix_key') if self.warmup else None
+        if key is None or key in self._warm_prefixes:
+            return
+        self._warm_prefixes.add(key)
+        for sibling, priority in self._held_back.pop(key, []):
+            self._enqueue(sibling, priority)
+
+    async def process_item(self, item_info):
+        """Process a single processing unit, retrying transient failures; the retries are counted in `item_info['retries']`."""
+        item_info['retries'] = 0
+        if self.cache is not None:
+            cached_response = self.cache.get(item_info['create_params'])
+            if cached_response is not None:
+                return cached_response
+        estimated_tokens = unit_token_estimate(item_info)
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.stats.throttled_seconds += await self.limiter.acquire(estimated_tokens)
+            self.stats.requests += 1
+            try:
+                response = await self.client.chat.completions.create(**item_info['create_params'])
+            except Exception as e:
+                if attempt < self.max_retries and is_retryable_error(e):
+                    delay = backoff_delay(attempt, get_retry_after(e))
+                    if getattr(e, 'status_code', None) == 429:
+                        self.stats.throttled_seconds += delay
+                        if self.limiter is not None:
+                            self.limiter.pause(delay)
+                    self.stats.retries += 1
+                    item_info['retries'] += 1
+                    await asyncio.sleep(delay)
+                    continue
+                self.stats.failures += 1
+                print(f"API Error: {describe_unit(item_info)} - {e}")
+                return None
+            self.stats.record_usage(response.usage)
+            if self.limiter is not None and response.usage is not None:
+                self.limiter.debit(response.usage.total_tokens - estimated_tokens)
+            response = response.model_dump()
+            if self.cache is not None:
+                self.cache.put(item_info['create_params'], response)
+            return response
+        return None
+
+    async def _worker(self):
+        while True:
+            *_, unit = await self._pending.get()
+            start = time.perf_counter()
+            try:
+                response = await self.process_item(unit)
+            except Exception as e:
+                # Any other failure (e.g. of the response cache) fails this unit only; a dead worker would stall `stream`.
+                self.stats.failures += 1
+                print(f"Dispatch Error: {describe_unit(unit)} - {type(e).__name__}: {e}")
+                response = None
+            unit['latency_seconds'] = time.perf_counter() - start
+            self._release(unit)
+            await self._results.put((unit, response))
+
+    async def stream(self, units=(), lookahead=None):
+        """Yield `(unit, response)` pairs as soon as each request finishes, until no submitted unit is left.
+
+        `units` may be a lazy iterable: with `lookahead`, it is only consumed while fewer than
+        `lookahead` units are queued or in flight, so the largest-first order applies within that window.
+        """
+        units = iter(units)
+        is_exhausted = False
+
+        def refill():
+            nonlocal is_exhausted
+            while not is_exhausted and (lookahead is None or self._outstanding < lookahead):
+                unit = next(units, None)
+                if unit is None:
+                    is_exhausted = True
+                else:
+                    self.submit(unit)
+
+        refill()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            while self._outstanding > 0:
+                unit, response = await self._results.get()
+                self._outstanding -= 1
+                yield unit, response
+                refill()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.stats.finish()
+
+
+async def _run(units, concurrency, on_result, rpm, tpm, max_retries, cache, warmup, lookahead):
+    client = get_async_client()
+    try:
+        limiter = RateLimiter(rpm=rpm, tpm=tpm) if rpm or tpm else None
+        dispatcher = LLMDispatcher(
+            client,
+            concurrency=concurrency,
+            limiter=limiter,
+            max_retries=max_retries,
+            cache=cache,
+            warmup=warmup,
+        )
+        with tqdm(total=len(units) if hasattr(units, '__len__') else None) as pbar:
+            async for unit, response in dispatcher.stream(units, lookahead):
+                for follow_up in on_result(unit, response) or ():
+                    dispatcher.submit(follow_up, priority=FOLLOW_UP_PRIORITY)
+                    if pbar.total is not None:
+                        pbar.total += 1
+                        pbar.refresh()
+                pbar.update(1)
+        return dispatcher.stats
+    finally:
+        await client.close()
+
+
+def run_units(
+    units,
+    concurrency,
+    on_result,
+    rpm=None,
+    tpm=None,
+    max_retries=6,
+    cache_path=None,
+    cache_mode='off',
+    cache_max_mb=1024,
+    warmup=False,
+    lookahead=None,
+):
+    """Dispatch all units and call `on_result(unit, response)` for each one as it completes.
+
+    `on_result` may return follow-up units (e.g. a cascade's escalations to a larger model); they are
+    dispatched in the same run, ahead of the units still queued.
+    `units` can be a generator, consumed `lookahead` units ahead of the requests (see `LLMDispatcher.stream`).
+    Returns the `RunStats` of the run.
+    """
+    cache = get_response_cache(cache_path, cache_mode, cache_max_mb)
+    try:
+        stats = asyncio.run(_run(units, concurrency, on_result, rpm, tpm, max_retries, cache, warmup, lookahead))
+    finally:
+        if cache is not None:
+            print(f"Response cache ({cache.mode}): {cache.summary()}")
+            cache.close()
+    print(f"Dispatch stats: {stats.summary()}")
+    return stats
@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+
+
+def fingerprint(*parts):
+    """Stable short hash of JSON-serializable inputs."""
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def document_fingerprint(sections, *extra):
+    """Fingerprint of a document's sections in order, plus any other per document inputs."""
+    digest = hashlib.sha256()
+    for each_section in sections:
+        digest.update(json.dumps(each_section, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(b"\n")
+    if extra:
+        digest.update(fingerprint(*extra).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class Manifest:
+    """Fingerprints of the inputs of a step's last run: run config, documents, line items and (doc, line item) units.
+
+    A unit's fingerprint covers the config, its document, its line item and any per unit inputs,
+    so comparing it with the previous manifest tells which units have to be recomputed.
+    """
+
+    def __init__(self, config, documents=None, line_items=None, units=None):
+        self.config = config
+        self.documents = documents or {}
+        self.line_items = line_items or {}
+        self.units = units or {}
+
+    @staticmethod
+    def unit_key(doc_name, line_item_name):
+        return f"{doc_name}::{line_item_name}"
+
+    def add_unit(self, doc_name, line_item_name, *inputs):
+        self.units[self.unit_key(doc_name, line_item_name)] = fingerprint(
+            self.config, self.documents[doc_name], self.line_items[line_item_name], *inputs
+        )
+
+    @classmethod
+    def load(cls, path):
+        """The manifest saved at `path`, or None if there is none."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls(data['config'], data['documents'], data['line_items'], data['units'])
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "config": self.config,
+                "documents": self.documents,
+                "line_items": self.line_items,
+                "units": self.units,
+            }, f, indent=4)
+        os.replace(tmp_path, path)
+
+    def is_changed(self, key, previous):
+        """Whether the fingerprint of unit `key` differs from (or is missing in) `previous`."""
+        return previous is None or previous.units.get(key) != self.units[key]
+
+    def changed_units(self, previous):
+        """Keys of the units whose fingerprint differs from (or is missing in) `previous`."""
+        return {key for key in self.units if self.is_changed(key, previous)}
+
+    def describe_changes(self, previous, changed_units):
+        if previous is None:
+            return f"no previous manifest, all {len(self.units)} units are recomputed"
+        changed_documents = [d for d, value in self.documents.items() if previous.documents.get(d) != value]
+        changed_line_items = [i for i, value in self.line_items.items() if previous.line_items.get(i) != value]
+        description = (
+            f"{len(changed_units)} of {len(self.units)} (document, line item) units changed: "
+            f"{len(changed_documents)} documents and {len(changed_line_items)} line items changed or added"
+        )
+        if previous.config != self.config:
+            description += ", run config changed"
+        return description
@@ -0,0 +1,287 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SECTION_ID_PATTERN = re.compile(r"==== SECTION ID: (.+?) ====")
+# Prompt caching is simulated like the provider does it: prefixes of at least 1024 tokens,
+# in 128 token increments (~4 characters per token).
+CACHE_MIN_CHARS = 4096
+CACHE_INCREMENT_CHARS = 512
+# Like the provider's cache, only the most recently used prefixes are kept.
+MAX_SEEN_PREFIXES = 100_000
+
+
+def _stable_fraction(*parts):
+    digest = hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) / 0xFFFFFFFF
+
+
+def fake_value(schema, prompt, name=""):
+    """Build a deterministic value that satisfies a (simple) JSON schema."""
+    if not isinstance(schema, dict):
+        return None
+    if name == "relevant_sections":
+        section_ids = SECTION_ID_PATTERN.findall(prompt)
+        return [s for s in section_ids if _stable_fraction(prompt[-500:], s) < 0.3]
+    if name == "uncertain_sections":
+        section_ids = SECTION_ID_PATTERN.findall(prompt)
+        return [s for s in section_ids if 0.3 <= _stable_fraction(prompt[-500:], s) < 0.4]
+    if 'enum' in schema:
+        return schema['enum'][0]
+    schema_type = schema.get('type')
+    if isinstance(schema_type, list):
+        schema_type = [t for t in schema_type if t != 'null'][0] if schema_type else None
+    if schema_type == 'object':
+        return {
+            key: fake_value(value, prompt, key)
+            for key, value in schema.get('properties', {}).items()
+        }
+    if schema_type == 'array':
+        item_schema = schema.get('items', {})
+        for key, value in item_schema.get('properties', {}).items():
+            if 'enum' in value:
+                # One entry per enum value, e.g. one result per line item of a batched call.
+                entries = []
+                for option in value['enum']:
+                    entry = fake_value(item_schema, prompt + option, name)
+                    entry[key] = option
+                    entries.append(entry)
+                return entries
+        return []
+    if schema_type == 'integer':
+        return 0
+    if schema_type == 'number':
+        return 0.0
+    if schema_type == 'boolean':
+        return False
+    if schema_type == 'string':
+        return f"mock {name}".strip()
+    return None
+
+
+def prompt_prefix_keys(prompt):
+    """`(prefix length, hash)` of every cacheable prefix of `prompt`."""
+    prefix_keys = []
+    digest = hashlib.sha256()
+    for end in range(CACHE_INCREMENT_CHARS, len(prompt) + 1, CACHE_INCREMENT_CHARS):
+        digest.update(prompt[end - CACHE_INCREMENT_CHARS:end].encode("utf-8"))
+        if end >= CACHE_MIN_CHARS:
+            prefix_keys.append((end, digest.hexdigest()))
+    return prefix_keys
+
+
+def remember_prefixes(seen_prefixes, keys, max_size=MAX_SEEN_PREFIXES):
+    """Mark `keys` as most recently used in the `seen_prefixes` LRU, evicting the oldest beyond `max_size`."""
+    for key in keys:
+        seen_prefixes[key] = None
+        seen_prefixes.move_to_end(key)
+    while len(seen_prefixes) > max_size:
+        seen_prefixes.popitem(last=False)
+
+
+def get_prompt(create_params):
+    return "\n".join(
+        m['content'] for m in create_params.get('messages', []) if isinstance(m.get('content'), str)
+    )
+
+
+def build_completion(create_params, seen_prefixes=None):
+    """Build a chat.completion payload answering `create_params` with a call to its first tool.
+
+    Prompt prefixes found in `seen_prefixes` are reported as `cached_tokens`.
+    """
+    prompt = get_prompt(create_params)
+    prompt_tokens = max(1, len(prompt) // 4)
+    cached_tokens = 0
+    if seen_prefixes is not None:
+        cached_chars = [end for end, key in prompt_prefix_keys(prompt) if key in seen_prefixes]
+        cached_tokens = max(cached_chars, default=0) // 4
+    message = {"role": "assistant", "content": None, "tool_calls": None}
+    finish_reason = "stop"
+    completion_tokens = 1
+    if create_params.get('tools'):
+        function = create_params['tools'][0]['function']
+        arguments = json.dumps(fake_value(function['parameters'], prompt))
+        message['tool_calls'] = [{
+            "id": "call_" + hashlib.sha256(arguments.encode("utf-8")).hexdigest()[:24],
+            "type": "function",
+            "function": {"name": function['name'], "arguments": arguments},
+        }]
+        finish_reason = "tool_calls"
+        completion_tokens = max(1, len(arguments) // 4)
+    else:
+        message['content'] = "mock"
+    return {
+        "id": "chatcmpl-mock" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:20],
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": create_params.get('model', 'mock'),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+class ServerBehavior:
+    """Simulated provider latency and failures.
+
+    Latency is lognormal with median `latency_ms` and shape `latency_sigma` (0 keeps it constant).
+    A fraction `error_rate` of requests fails, half with a 429 carrying a `retry-after-ms` header
+    and half with a 500. `lock` also guards the server's counters and remembered prefixes.
+    """
+
+    def __init__(self, latency_ms=0.0, latency_sigma=0.0, error_rate=0.0, retry_after_ms=100, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.retry_after_ms = retry_after_ms
+        self._rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """`(latency seconds, error status or None)` of the next request."""
+        with self.lock:
+            latency = self.latency_ms / 1000
+            if self.latency_sigma > 0:
+                latency *= self._rng.lognormvariate(0, self.latency_sigma)
+            status = None
+            if self.error_rate > 0 and self._rng.random() < self.error_rate:
+                status = 429 if self._rng.random() < 0.5 else 500
+        return latency, status
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        create_params = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+            return
+        lock = self.server.behavior.lock
+        with lock:
+            self.server.request_count += 1
+        latency, status = self.server.behavior.sample()
+        if latency > 0:
+            time.sleep(latency)
+        if status is not None:
+            with lock:
+                self.server.error_count += 1
+        if status == 429:
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_exceeded"}},
+                {"retry-after-ms": str(self.server.behavior.retry_after_ms)},
+            )
+            return
+        if status is not None:
+            self._send_json(status, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+            return
+        with lock:
+            completion = build_completion(create_params, self.server.seen_prefixes)
+        self._send_json(200, completion)
+        # Like the provider, a prefix is only cached once a request using it has finished.
+        keys = [key for _, key in prompt_prefix_keys(get_prompt(create_params))]
+        with lock:
+            remember_prefixes(self.server.seen_prefixes, keys)
+
+
+def make_server(host="127.0.0.1", port=0, behavior=None):
+    server = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.request_count = 0
+    server.error_count = 0
+    server.seen_prefixes = OrderedDict()
+    server.behavior = behavior or ServerBehavior()
+    return server
+
+
+def start_mock_server(host="127.0.0.1", port=0, behavior=None):
+    """Start the mock server in a background thread; returns the server, its base url is `server.base_url`."""
+    server = make_server(host, port, behavior)
+    server.base_url = f"http://{host}:{server.server_address[1]}/v1"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server for offline runs")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        required=False,
+        help="Host to bind"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        required=False,
+        help="Port to bind"
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Median simulated latency of a request in milliseconds"
+    )
+    parser.add_argument(
+        "--latency-sigma",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Shape of the lognormal latency distribution, 0 for a constant latency"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Fraction of requests answered with a 429 or a 500"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        required=False,
+        help="Random seed of the simulated latency and errors"
+    )
+
+    args = parser.parse_args()
+
+    server = make_server(
+        args.host,
+        args.port,
+        ServerBehavior(args.latency_ms, args.latency_sigma, args.error_rate, seed=args.seed),
+    )
+    print(f"Mock OpenAI server listening on http://{args.host}:{args.port}/v1")
+    print(f"Point the pipeline at it with: export OPENAI_BASE_URL=http://{args.host}:{args.port}/v1 OPENAI_API_KEY=mock")
+    server.serve_forever()
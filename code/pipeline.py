@@ -0,0 +1,456 @@
+import json
+import time
+import asyncio
+import argparse
+from tqdm import tqdm
+from llm_dispatch import LLMDispatcher, get_async_client
+from rate_limiter import RateLimiter
+from response_cache import get_response_cache
+from checkpoint import Checkpoint
+from run_log import write_log
+from document_store import DocumentStore, open_document
+from prompt_cache import CachedTokenReport
+from token_counter import get_token_counter
+import telemetry
+from step_3_retrieval import (
+    aggregate_retrieval_results,
+    build_retrieval_units,
+    collect_retrieval_records,
+    group_result_entry,
+    merge_group_results,
+    parse_retrieval_response,
+)
+from step_4_extraction import (
+    ContextModeReport,
+    DocumentPromptBuilder,
+    LineItemFragments,
+    build_extraction_unit,
+    collect_extraction_records,
+    parse_extraction_response,
+    process_metadata,
+)
+
+
+# Extraction calls go ahead of queued retrieval calls, so a finished line item never waits for the rest of retrieval.
+# Retrieval calls are served document by document (priority = document rank), so line items complete early.
+EXTRACTION_PRIORITY = -1
+
+
+class StreamingPipeline:
+    """Tracks the retrieval records of every (doc, line item) pair and builds its extraction unit once all are in."""
+
+    def __init__(self, retrieval_units, line_items, instruction_dct, args, store=None):
+        self.fragments = LineItemFragments(instruction_dct, args.reasoning_model)
+        self.args = args
+        self.store = store
+        self.pending_records = {}
+        self.group_results = {}
+        self.pending_pairs_per_doc = {}
+        self.documents = {}
+        for each_unit in retrieval_units:
+            if 'batch_items' in each_unit:
+                item_names = [b['item_name'] for b in each_unit['batch_items']]
+            else:
+                item_names = [each_unit['item_name']]
+            for record_id, item_name in zip(each_unit['record_ids'], item_names):
+                if item_name in line_items:
+                    self.pending_records.setdefault((each_unit['doc_name'], item_name), set()).add(record_id)
+        for doc_name in {doc_name for doc_name, _ in self.pending_records}:
+            self.pending_pairs_per_doc[doc_name] = 0
+        for doc_name, item_name in self.pending_records:
+            self.pending_pairs_per_doc[doc_name] += 1
+            self.group_results[(doc_name, item_name)] = []
+
+    def pairs(self):
+        return list(self.pending_records)
+
+    def add_record(self, record):
+        """Register a retrieval record; returns the extraction unit of its pair once the pair is complete."""
+        pair = (record['doc_name'], record['item_name'])
+        if pair not in self.pending_records or record['unit_id'] not in self.pending_records[pair]:
+            return None
+        self.pending_records[pair].discard(record['unit_id'])
+        self.group_results[pair].append(group_result_entry(record))
+        if len(self.pending_records[pair]) > 0:
+            return None
+        return self.extraction_unit(*pair)
+
+    def _open(self, doc_name):
+        if doc_name not in self.documents:
+            document = open_document(doc_name, self.store)
+            policy_metadata_block = json.dumps(process_metadata(document.metadata), indent=4)
+            self.documents[doc_name] = {
+                "document": document,
+                "builder": DocumentPromptBuilder(
+                    doc_name,
+                    list(document.iter_sections()),
+                    policy_metadata_block,
+                    self.fragments,
+                    prefix_first=self.args.prompt_cache_warmup,
+                ),
+            }
+        return self.documents[doc_name]
+
+    def extraction_unit(self, doc_name, item_name):
+        """Extraction unit of a pair over the sections its retrieval found relevant."""
+        opened = self._open(doc_name)
+        relevant_section_ids, _ = merge_group_results(self.group_results.pop((doc_name, item_name)))
+        section_ids, context_mode = opened['builder'].choose_context(
+            relevant_section_ids,
+            self.args.context_mode,
+            self.args.full_context_ratio,
+        )
+        if context_mode == 'full' and self.args.context_mode == 'retrieved':
+            print(f"No relevant sections retrieved for {doc_name} - {item_name}, extracting from the full document")
+        each_sample = opened['builder'].sample(
+            item_name,
+            section_ids,
+            context_mode,
+            ground_truth=opened['document'].ground_truth(item_name),
+        )
+        self.pending_pairs_per_doc[doc_name] -= 1
+        if self.pending_pairs_per_doc[doc_name] == 0:
+            self.documents.pop(doc_name)['document'].close()
+        return build_extraction_unit(each_sample, self.args.model_name)
+
+
+async def _run_pipeline(retrieval_units, ready_units, num_pairs, on_retrieval, on_extraction, args, cache):
+    client = get_async_client()
+    try:
+        limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm) if args.rpm or args.tpm else None
+        dispatcher = LLMDispatcher(
+            client,
+            concurrency=args.n_jobs,
+            limiter=limiter,
+            max_retries=args.max_retries,
+            cache=cache,
+            warmup=args.prompt_cache_warmup,
+        )
+        for each_unit in ready_units:
+            dispatcher.submit(each_unit, priority=EXTRACTION_PRIORITY)
+        doc_rank = {}
+        for each_unit in retrieval_units:
+            doc_rank.setdefault(each_unit['doc_name'], len(doc_rank))
+            dispatcher.submit(each_unit, priority=doc_rank[each_unit['doc_name']])
+        start = time.perf_counter()
+        retrieval_left = len(retrieval_units)
+        retrieval_seconds = 0.0
+        first_extraction_seconds = None
+        with tqdm(total=len(retrieval_units) + num_pairs) as pbar:
+            async for each_unit, response in dispatcher.stream():
+                if 'line_item_name' in each_unit:
+                    on_extraction(each_unit, response)
+                else:
+                    for extraction_unit in on_retrieval(each_unit, response):
+                        if first_extraction_seconds is None:
+                            first_extraction_seconds = time.perf_counter() - start
+                        dispatcher.submit(extraction_unit, priority=EXTRACTION_PRIORITY)
+                    retrieval_left -= 1
+                    if retrieval_left == 0:
+                        retrieval_seconds = time.perf_counter() - start
+                pbar.update(1)
+        total_seconds = time.perf_counter() - start
+        print(f"Pipeline: retrieval finished after {retrieval_seconds:.1f}s, first extraction enqueued after {first_extraction_seconds or 0.0:.1f}s, all done after {total_seconds:.1f}s")
+        return dispatcher.stats
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run retrieval and extraction as one streaming pipeline")
+    parser.add_argument(
+        "--test-run",
+        type=bool,
+        default=True,
+        required=False,
+        help="Test run"
+    )
+    parser.add_argument(
+        "--docs",
+        type=str,
+        default=None,
+        required=False,
+        help="Comma separated document names to run on instead of the default documents, e.g. a synthetic corpus"
+    )
+    parser.add_argument(
+        "--model-name",
+        type=str,
+        default="gpt-4.1",
+        required=False,
+        help="Model name"
+    )
+    parser.add_argument(
+        "--reasoning-model",
+        choices=['YES', 'NO'],
+        default='NO',
+        required=False,
+        help="Use reasoning model for extraction: YES or NO"
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=16,
+        required=False,
+        help="Maximum number of in-flight API requests, shared by retrieval and extraction"
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Requests per minute budget (0 for no limit)"
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Tokens per minute budget (0 for no limit)"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=6,
+        required=False,
+        help="Retries per request on rate limits and transient API errors"
+    )
+    parser.add_argument(
+        "--cache-mode",
+        choices=['readwrite', 'readonly', 'refresh', 'off'],
+        default='readwrite',
+        required=False,
+        help="Response cache mode: readwrite, readonly (never write), refresh (ignore hits, overwrite) or off"
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default="processed_data/response_cache.sqlite",
+        required=False,
+        help="Path of the SQLite response cache"
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=1024,
+        required=False,
+        help="Size bound of the response cache in MB, least recently used entries are evicted first"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the JSONL checkpoints of an interrupted run, skipping units already completed"
+    )
+    parser.add_argument(
+        "--log-format",
+        type=str,
+        default="json",
+        choices=['json', 'compact'],
+        required=False,
+        help="Log format: json writes one indented JSON array, compact writes a directory (..._log_<model>_compact/) that stores each distinct prompt block once and compresses responses"
+    )
+    parser.add_argument(
+        "--doc-store",
+        type=str,
+        default="",
+        required=False,
+        help="Directory of the indexed document store, converted from raw_data on first use (empty: read the raw JSON files)"
+    )
+    parser.add_argument(
+        "--context-mode",
+        choices=['retrieved', 'full', 'adaptive'],
+        default='retrieved',
+        required=False,
+        help="Extraction context: the retrieved sections, the full document, or adaptive (full document when retrieval saves little or found nothing)"
+    )
+    parser.add_argument(
+        "--full-context-ratio",
+        type=float,
+        default=0.8,
+        required=False,
+        help="Adaptive mode uses the full document when the retrieved sections hold at least this fraction of its tokens"
+    )
+    parser.add_argument(
+        "--prefilter",
+        choices=['none', 'bm25'],
+        default='none',
+        required=False,
+        help="Lexical pre-filter that prunes sections before LLM retrieval"
+    )
+    parser.add_argument(
+        "--prefilter-top-k",
+        type=int,
+        default=20,
+        required=False,
+        help="Number of best ranked sections kept per line item by the pre-filter"
+    )
+    parser.add_argument(
+        "--prefilter-threshold",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Also keep sections scoring at least this fraction of the best BM25 score"
+    )
+    parser.add_argument(
+        "--prefilter-margin",
+        type=int,
+        default=5,
+        required=False,
+        help="Recall safety margin: extra next-ranked sections kept beyond the cutoff"
+    )
+    parser.add_argument(
+        "--items-per-call",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of line items asked about in one retrieval call over the same section group"
+    )
+    parser.add_argument(
+        "--token-counter",
+        choices=['hf', 'estimate'],
+        default='hf',
+        required=False,
+        help="hf: exact counts with the Qwen/Qwen3-0.6B tokenizer, estimate: calibrated pure Python estimate (see code/token_counter.py)"
+    )
+    parser.add_argument(
+        "--prompt-cache-warmup",
+        action="store_true",
+        help="Send one warm-up call per shared prompt prefix before releasing the calls that reuse it"
+    )
+
+    args = parser.parse_args()
+    telemetry.start_run("pipeline")
+
+    docs = [
+        "adventis",
+        "ancora_heart",
+        "andrian",
+        "anomali",
+        "at_bay",
+        "bitgo",
+        "corium",
+        "gardner",
+        "jfrog",
+        "park_place",
+        "people_ai",
+        "sprout",
+        "standard_biotools",
+        "sylabs",
+    ]
+    if args.docs:
+        docs = args.docs.split(",")
+    if args.test_run:
+        docs = docs[:1]
+    with open("raw_data/retrieval_instructions.json", "r") as f:
+        line_item_descs = json.load(f)
+    with open("raw_data/extraction_instructions.json", "r") as f:
+        extraction_instructions = json.load(f)
+    if args.test_run:
+        line_item_descs = line_item_descs[:1]
+        extraction_instructions = extraction_instructions[:1]
+    line_item_descs_dct = {d['Line item name']: d for d in line_item_descs}
+    instruction_dct = {each_item['Line item name']: each_item for each_item in extraction_instructions}
+    line_items = [item_name for item_name in line_item_descs_dct if item_name in instruction_dct]
+
+    store = DocumentStore(args.doc_store) if args.doc_store else None
+    if store is not None:
+        print(f"Document store: converted {store.build(docs)} of {len(docs)} documents")
+    token_counter = get_token_counter(args.token_counter, conservative=True)
+    with telemetry.phase("build_units"):
+        retrieval_units = build_retrieval_units(docs, line_item_descs_dct, args, token_counter, store)
+    pipeline = StreamingPipeline(retrieval_units, set(line_items), instruction_dct, args, store)
+    pairs = pipeline.pairs()
+
+    retrieval_checkpoint = Checkpoint(f"processed_data/step_3_retrieval_checkpoint_{args.model_name}.jsonl", resume=args.resume)
+    extraction_suffix = args.model_name if args.context_mode == 'retrieved' else f"{args.model_name}_{args.context_mode}"
+    extraction_checkpoint = Checkpoint(f"processed_data/step_4_extraction_checkpoint_{extraction_suffix}.jsonl", resume=args.resume)
+    retrieval_ids = [record_id for each_unit in retrieval_units for record_id in each_unit['record_ids']]
+    extraction_ids = [f"{doc_name}::{item_name}" for doc_name, item_name in pairs]
+    completed_retrieval_ids = retrieval_checkpoint.completed_ids()
+    completed_extraction_ids = extraction_checkpoint.completed_ids()
+    pending_units = [
+        each_unit for each_unit in retrieval_units
+        if not all(record_id in completed_retrieval_ids for record_id in each_unit['record_ids'])
+    ]
+    # Pairs whose retrieval is already checkpointed are extracted right away, unless that is checkpointed too.
+    ready_units = []
+    for record in retrieval_checkpoint.iter_records([r for r in retrieval_ids if r in completed_retrieval_ids]):
+        extraction_unit = pipeline.add_record(record)
+        if extraction_unit is not None and extraction_unit['unit_id'] not in completed_extraction_ids:
+            ready_units.append(extraction_unit)
+    num_pending_pairs = len([
+        pair for pair in pairs if f"{pair[0]}::{pair[1]}" not in completed_extraction_ids
+    ])
+    if args.resume:
+        print(f"Resuming: {len(retrieval_units) - len(pending_units)} retrieval units and {len(pairs) - num_pending_pairs} extraction units already in checkpoint")
+
+    retrieval_report = CachedTokenReport("retrieval")
+    extraction_report = CachedTokenReport("extraction")
+
+    def on_retrieval(each_unit, response):
+        retrieval_report.add(each_unit['doc_name'], response)
+        telemetry.observe_unit("retrieval", each_unit, response)
+        extraction_units = []
+        for record in parse_retrieval_response(each_unit, response):
+            with telemetry.phase("checkpoint"):
+                retrieval_checkpoint.append(record)
+            extraction_unit = pipeline.add_record(record)
+            if extraction_unit is not None and extraction_unit['unit_id'] not in completed_extraction_ids:
+                extraction_units.append(extraction_unit)
+        return extraction_units
+
+    def on_extraction(each_unit, response):
+        extraction_report.add(each_unit['doc_name'], response)
+        telemetry.observe_unit("extraction", each_unit, response)
+        records = parse_extraction_response(each_unit, response)
+        with telemetry.phase("checkpoint"):
+            for record in records:
+                extraction_checkpoint.append(record)
+
+    cache = get_response_cache(args.cache_path, args.cache_mode, args.cache_max_mb)
+    try:
+        with telemetry.phase("dispatch"):
+            stats = asyncio.run(_run_pipeline(
+                pending_units, ready_units, num_pending_pairs, on_retrieval, on_extraction, args, cache
+            ))
+    finally:
+        if cache is not None:
+            print(f"Response cache ({cache.mode}): {cache.summary()}")
+            cache.close()
+    print(f"Dispatch stats: {stats.summary()}")
+    telemetry.add_stats(stats)
+    retrieval_report.print_summary()
+    extraction_report.print_summary()
+    print("\n\nGathering results...")
+
+    recall_results = {doc_name: {} for doc_name in docs}
+    with telemetry.phase("write_log"):
+        write_log(
+            f"processed_data/step_3_retrieval_log_{args.model_name}",
+            collect_retrieval_records(retrieval_checkpoint, retrieval_ids, recall_results),
+            args.log_format,
+        )
+    retrieval_checkpoint.close()
+    with telemetry.phase("aggregate"):
+        aggregate_retrieval_results(recall_results, token_counter, store)
+    with telemetry.phase("write_result"):
+        with open(f"processed_data/step_3_retrieval_result_{args.model_name}.json", 'w') as f:
+            json.dump(recall_results, f, indent=4)
+
+    extraction_results = {doc_name: {} for doc_name in docs}
+    context_mode_report = ContextModeReport()
+    with telemetry.phase("write_log"):
+        write_log(
+            f"processed_data/step_4_extraction_log_{extraction_suffix}",
+            collect_extraction_records(extraction_checkpoint, extraction_ids, extraction_results, context_mode_report),
+            args.log_format,
+        )
+    extraction_checkpoint.close()
+    context_mode_report.print_summary()
+    with telemetry.phase("write_result"):
+        with open(f"processed_data/step_4_extraction_result_{extraction_suffix}.json", "w") as f:
+            json.dump(extraction_results, f, indent=4)
+    telemetry.get_telemetry().write(f"processed_data/pipeline_run_report_{extraction_suffix}.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import hashlib
+
+
+# Providers only cache prompt prefixes from about this many tokens on.
+MIN_CACHEABLE_PREFIX_TOKENS = 1024
+
+
+def prefix_key(prefix):
+    """Key shared by all units whose prompts start with the byte-identical `prefix`."""
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+
+
+def get_cached_tokens(response):
+    usage = (response or {}).get('usage') or {}
+    details = usage.get('prompt_tokens_details') or {}
+    return usage.get('prompt_tokens') or 0, details.get('cached_tokens') or 0
+
+
+class CachedTokenReport:
+    """Prompt and provider-cached prompt tokens per document, read from `response.usage`."""
+
+    def __init__(self, step_name):
+        self.step_name = step_name
+        self.per_doc = {}
+
+    def add(self, doc_name, response):
+        prompt_tokens, cached_tokens = get_cached_tokens(response)
+        doc_stats = self.per_doc.setdefault(doc_name, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        doc_stats['calls'] += 1
+        doc_stats['prompt_tokens'] += prompt_tokens
+        doc_stats['cached_tokens'] += cached_tokens
+
+    def print_summary(self):
+        print(f"Prompt cache report ({self.step_name}):")
+        total_prompt_tokens = 0
+        total_cached_tokens = 0
+        for doc_name, doc_stats in self.per_doc.items():
+            total_prompt_tokens += doc_stats['prompt_tokens']
+            total_cached_tokens += doc_stats['cached_tokens']
+            ratio = doc_stats['cached_tokens'] / max(1, doc_stats['prompt_tokens'])
+            print(f"  {doc_name}: calls {doc_stats['calls']}, prompt tokens {doc_stats['prompt_tokens']}, cached tokens {doc_stats['cached_tokens']} ({ratio:.1%})")
+        ratio = total_cached_tokens / max(1, total_prompt_tokens)
+        print(f"  total: prompt tokens {total_prompt_tokens}, cached tokens {total_cached_tokens} ({ratio:.1%})")
@@ -0,0 +1,221 @@
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from llm_dispatch import run_units
+from work_queue import QUEUE_BACKENDS, get_work_queue
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LeaseRenewer:
+    """Context manager renewing the leases of a worker every `lease_seconds / 4` from a background thread.
+
+    The thread has its own connection to the queue, so that leases stay alive while the dispatcher
+    waits on slow requests, retries or rate limits and no unit completes for a while.
+    """
+
+    def __init__(self, work_queue, worker_id, lease_seconds):
+        self.work_queue = work_queue
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        work_queue = get_work_queue(self.work_queue.backend, self.work_queue.path)
+        try:
+            while not self._stop.wait(self.lease_seconds / 4):
+                try:
+                    work_queue.renew(self.worker_id, self.lease_seconds)
+                except Exception as e:
+                    # Tried again at the next interval, well before the leases expire.
+                    print(f"Worker {self.worker_id}: lease renewal failed - {type(e).__name__}: {e}")
+        finally:
+            work_queue.disconnect()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name=f"lease-renewer-{self.worker_id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def retry_when_locked(operation, worker_id, poll_seconds):
+    """Run a queue operation, retrying it after `poll_seconds` for as long as the queue database is locked.
+
+    A coordinator enqueueing a large run or another busy host can hold the lock beyond the connection timeout.
+    """
+    while True:
+        try:
+            return operation()
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            print(f"Worker {worker_id}: {e}, retrying in {poll_seconds}s")
+            time.sleep(poll_seconds)
+
+
+def run_worker(work_queue, worker_id, n_jobs, lease_seconds=600, poll_seconds=1.0, wait=False, coordinator_pid=0, **dispatch_kwargs):
+    """Lease units from the work queue, send their requests and write the responses back.
+
+    Leases are renewed by a `LeaseRenewer` for as long as the dispatcher runs.
+
+    Returns once no coordinator is waiting for results anymore, or never with `wait`. A worker
+    started by a coordinator on the same host (`coordinator_pid`) also returns once that process is gone.
+    `dispatch_kwargs` are passed to `run_units` (rate budgets, retries, response cache).
+    """
+    num_units = 0
+    while True:
+        units = retry_when_locked(lambda: work_queue.lease(worker_id, 2 * n_jobs, lease_seconds), worker_id, poll_seconds)
+        if not units:
+            if not wait and retry_when_locked(work_queue.is_drained, worker_id, poll_seconds):
+                print(f"Worker {worker_id}: queue drained after {num_units} units")
+                return num_units
+            if coordinator_pid and not is_process_alive(coordinator_pid):
+                print(f"Worker {worker_id}: coordinator {coordinator_pid} exited after {num_units} units")
+                return num_units
+            time.sleep(poll_seconds)
+            continue
+
+        def on_result(unit, response):
+            nonlocal num_units
+            retry_when_locked(lambda: work_queue.complete(unit, response), worker_id, poll_seconds)
+            num_units += 1
+            # Lease the next unit right away instead of waiting for the slowest unit of this lease.
+            return retry_when_locked(lambda: work_queue.lease(worker_id, 1, lease_seconds), worker_id, poll_seconds)
+
+        with LeaseRenewer(work_queue, worker_id, lease_seconds):
+            run_units(units, n_jobs, on_result, **dispatch_kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Worker answering the processing units of a work queue (steps 3 and 4 with --mode queue)')
+    parser.add_argument(
+        "--queue-backend",
+        choices=QUEUE_BACKENDS,
+        default='sqlite',
+        required=False,
+        help="Work queue backend"
+    )
+    parser.add_argument(
+        "--queue-path",
+        type=str,
+        default="processed_data/work_queue.sqlite",
+        required=False,
+        help="Path of the work queue, shared with the coordinator (e.g. on a shared volume)"
+    )
+    parser.add_argument(
+        "--worker-id",
+        type=str,
+        default="",
+        required=False,
+        help="Name of this worker in the leases (default: <host>-<pid>)"
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=600,
+        required=False,
+        help="Visibility timeout: units leased by a worker that stopped renewing its leases for this long are leased again by another worker"
+    )
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=1.0,
+        required=False,
+        help="Seconds between two lease attempts while the queue is empty"
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Keep polling for new units when no coordinator is running instead of exiting"
+    )
+    parser.add_argument(
+        "--coordinator-pid",
+        type=int,
+        default=0,
+        required=False,
+        help="Exit when idle once this process is gone (set for the workers a step starts with --local-workers)"
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=16,
+        required=False,
+        help="Maximum number of in-flight API requests of this worker"
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Requests per minute budget of this worker (0 for no limit)"
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Tokens per minute budget of this worker (0 for no limit)"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=6,
+        required=False,
+        help="Retries per request on rate limits and transient API errors"
+    )
+    parser.add_argument(
+        "--cache-mode",
+        choices=['readwrite', 'readonly', 'refresh', 'off'],
+        default='readwrite',
+        required=False,
+        help="Response cache mode: readwrite, readonly (never write), refresh (ignore hits, overwrite) or off"
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default="processed_data/response_cache.sqlite",
+        required=False,
+        help="Path of the SQLite response cache"
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=1024,
+        required=False,
+        help="Size bound of the response cache in MB, least recently used entries are evicted first"
+    )
+
+    args = parser.parse_args()
+    work_queue = get_work_queue(args.queue_backend, args.queue_path)
+    run_worker(
+        work_queue,
+        args.worker_id or f"{socket.gethostname()}-{os.getpid()}",
+        args.n_jobs,
+        lease_seconds=args.lease_seconds,
+        poll_seconds=args.poll_seconds,
+        wait=args.wait,
+        coordinator_pid=args.coordinator_pid,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        max_retries=args.max_retries,
+        cache_path=args.cache_path,
+        cache_mode=args.cache_mode,
+        cache_max_mb=args.cache_max_mb,
+    )
+    work_queue.disconnect()
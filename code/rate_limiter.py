@@ -0,0 +1,172 @@
+import json
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+from token_counter import estimate_tokens
+
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def estimate_prompt_tokens(create_params):
+    """Estimated prompt size, without a tokenizer, for units that carry no tokenizer count."""
+    num_tokens = sum(estimate_tokens(m.get('content') or "") for m in create_params.get('messages', []))
+    return num_tokens + estimate_tokens(json.dumps(create_params.get('tools', [])))
+
+
+def is_retryable_error(e):
+    import openai
+    if isinstance(e, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def get_retry_after(e):
+    """Seconds the server asked us to wait, read from `retry-after-ms` / `retry-after` headers."""
+    response = getattr(e, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base_delay=1.0, max_delay=60.0):
+    """Full-jitter exponential backoff, never shorter than the server's `Retry-After`."""
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class RunStats:
+    """Per-run counters of the scheduler."""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttled_seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+        details = getattr(usage, 'prompt_tokens_details', None)
+        if details is not None:
+            self.cached_tokens += getattr(details, 'cached_tokens', None) or 0
+
+    def finish(self):
+        self.end_time = time.monotonic()
+
+    @property
+    def elapsed_seconds(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    @property
+    def achieved_tpm(self):
+        minutes = max(self.elapsed_seconds, 1e-9) / 60
+        return (self.prompt_tokens + self.completion_tokens) / minutes
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "achieved_tpm": round(self.achieved_tpm, 1),
+        }
+
+    def summary(self):
+        return ", ".join(f"{key}: {value}" for key, value in self.to_dict().items())
+
+
+class RateLimiter:
+    """Token buckets for requests per minute and tokens per minute.
+
+    A request reserves its estimated prompt tokens up front; once the response
+    arrives `debit` charges the difference to the real usage (including the
+    completion), so the budget adapts to what the API actually counts. A 429
+    pauses every waiting request via `pause`.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm or None
+        self.tpm = tpm or None
+        self._request_allowance = float(self.rpm or 0)
+        self._token_allowance = float(self.tpm or 0)
+        self._updated = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._request_allowance = min(self.rpm, self._request_allowance + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._token_allowance = min(self.tpm, self._token_allowance + elapsed * self.tpm / 60)
+        return now
+
+    def _wait_time(self, tokens):
+        now = self._refill()
+        wait = self._resume_at - now
+        if self.rpm and self._request_allowance < 1:
+            wait = max(wait, (1 - self._request_allowance) * 60 / self.rpm)
+        if self.tpm and self._token_allowance < tokens:
+            wait = max(wait, (tokens - self._token_allowance) * 60 / self.tpm)
+        return wait
+
+    async def acquire(self, tokens):
+        """Wait until one request of `tokens` fits in both budgets; returns the seconds waited."""
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        waited = 0.0
+        async with self._lock:
+            wait = self._wait_time(tokens)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                waited += wait
+                wait = self._wait_time(tokens)
+            if self.rpm:
+                self._request_allowance -= 1
+            if self.tpm:
+                self._token_allowance -= tokens
+        return waited
+
+    def debit(self, tokens):
+        if self.tpm:
+            self._refill()
+            self._token_allowance -= tokens
+
+    def pause(self, seconds):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
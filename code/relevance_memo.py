@@ -0,0 +1,203 @@
+import os
+import re
+import zlib
+import sqlite3
+import hashlib
+import numpy as np
+
+
+MEMO_MODES = ['readwrite', 'readonly', 'off']
+NUM_PERMUTATIONS = 64
+# 16 bands of 4 rows: sections at Jaccard 0.8 share a band with probability > 0.99, at 0.5 with 0.64.
+NUM_BANDS = 16
+SHINGLE_SIZE = 3
+_rng = np.random.default_rng(1234)
+_MULTIPLIERS = _rng.integers(1, np.iinfo(np.uint64).max, NUM_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _rng.integers(0, np.iinfo(np.uint64).max, NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def normalize_section(section):
+    """Section title and text, lower cased, without punctuation and whitespace differences and with every number as 0.
+
+    Amounts and dates do not change whether a section is relevant to a line item.
+    """
+    words = re.findall(r"[a-z0-9]+", f"{section['title']}\n{section['text']}".lower())
+    return " ".join("0" if word.isdigit() else word for word in words)
+
+
+def content_hash(normalized):
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+
+
+def minhash_signature(normalized):
+    """MinHash signature of the word 3-shingles of a normalized section, None for an empty one."""
+    tokens = normalized.split()
+    if not tokens:
+        return None
+    shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # Multiply-shift hashing; uint64 products wrap around, the high 32 bits are the permuted value.
+    return ((hashes[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)).min(axis=0).astype(np.uint32)
+
+
+def band_buckets(signature):
+    rows = NUM_PERMUTATIONS // NUM_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(NUM_BANDS)]
+
+
+class RelevanceMemo:
+    """Persistent SQLite memo of the per line item relevance decisions of previous retrieval runs.
+
+    Sections are keyed by a hash of their normalized title and text, so the same standard form
+    wording is recognized across documents. Sections that are not exact copies are matched to
+    known ones through MinHash signatures of their word shingles (LSH banding finds candidates,
+    which are kept if their estimated Jaccard similarity is at least `min_similarity`).
+    A decision is served only if every previous answer for that (line item, section) agreed.
+    Line items are keyed by the caller, e.g. by a fingerprint of their instruction and the model.
+
+    Modes:
+        readwrite: serve known decisions, record the model's new ones.
+        readonly: serve known decisions, never write.
+    """
+
+    def __init__(self, path, mode='readwrite', min_similarity=0.8):
+        assert mode in MEMO_MODES and mode != 'off', f"Unknown memo mode {mode}"
+        self.path = path
+        self.mode = mode
+        self.min_similarity = min_similarity
+        self._hashes = {}
+        self._signatures = {}
+        self._matches = {}
+        self._decisions = {}
+        self.candidate_sections = 0
+        self.candidate_tokens = 0
+        self.served_sections = 0
+        self.served_tokens = 0
+        self.near_duplicate_sections = 0
+        self.recorded = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sections (hash TEXT PRIMARY KEY, signature BLOB)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS bands ("
+            "band INTEGER NOT NULL, bucket BLOB NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (band, bucket, hash)) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS decisions ("
+            "item TEXT NOT NULL, hash TEXT NOT NULL, relevant INTEGER NOT NULL, seen INTEGER NOT NULL, PRIMARY KEY (item, hash))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS decisions_hash ON decisions (hash)")
+        self.conn.commit()
+
+    def index_document(self, doc_name, sections):
+        """Fingerprint the sections of a document and find the known sections each of them matches."""
+        for each_section in sections:
+            normalized = normalize_section(each_section)
+            section_hash = content_hash(normalized)
+            self._hashes[(doc_name, each_section['id'])] = section_hash
+            if section_hash not in self._matches:
+                self._signatures[section_hash] = minhash_signature(normalized)
+                self._matches[section_hash] = self._find_matches(section_hash)
+
+    def _find_matches(self, section_hash):
+        """`(similarity, known hash)` of the exact and near duplicate known sections, most similar first."""
+        matches = []
+        if self.conn.execute("SELECT 1 FROM sections WHERE hash = ?", (section_hash,)).fetchone() is not None:
+            matches.append((1.0, section_hash))
+        signature = self._signatures[section_hash]
+        if signature is not None:
+            candidates = set()
+            for band, bucket in band_buckets(signature):
+                rows = self.conn.execute("SELECT hash FROM bands WHERE band = ? AND bucket = ?", (band, bucket))
+                candidates.update(row[0] for row in rows)
+            candidates.discard(section_hash)
+            for candidate in candidates:
+                row = self.conn.execute("SELECT signature FROM sections WHERE hash = ?", (candidate,)).fetchone()
+                similarity = float(np.mean(np.frombuffer(row[0], dtype=np.uint32) == signature))
+                if similarity >= self.min_similarity:
+                    matches.append((similarity, candidate))
+        matches.sort(key=lambda match: (match[1] != section_hash, -match[0]))
+        for _, known_hash in matches:
+            if known_hash not in self._decisions:
+                self._decisions[known_hash] = {
+                    item: (relevant, seen)
+                    for item, relevant, seen in self.conn.execute(
+                        "SELECT item, relevant, seen FROM decisions WHERE hash = ?", (known_hash,)
+                    )
+                }
+        return matches
+
+    def lookup(self, doc_name, section_id, item_key):
+        """Known relevance of an indexed section for a line item, or None if the model has to be asked."""
+        section_hash = self._hashes[(doc_name, section_id)]
+        for _, known_hash in self._matches[section_hash]:
+            relevant, seen = self._decisions[known_hash].get(item_key, (0, 0))
+            if seen > 0 and relevant in (0, seen):
+                if known_hash != section_hash:
+                    self.near_duplicate_sections += 1
+                return relevant == seen
+        return None
+
+    def split(self, doc_name, item_key, section_ids, section_token_counts):
+        """Split the sections of a line item into the ids to ask the model about and `{section id: known relevance}`."""
+        to_ask = []
+        known_relevance = {}
+        for section_id in section_ids:
+            is_relevant = self.lookup(doc_name, section_id, item_key)
+            self.candidate_sections += 1
+            self.candidate_tokens += section_token_counts[section_id]
+            if is_relevant is None:
+                to_ask.append(section_id)
+            else:
+                known_relevance[section_id] = is_relevant
+                self.served_sections += 1
+                self.served_tokens += section_token_counts[section_id]
+        return to_ask, known_relevance
+
+    def record(self, doc_name, item_key, section_ids, relevant_section_ids):
+        """Add the model's decision for every indexed section of an answered section group."""
+        if self.mode == 'readonly':
+            return
+        relevant_section_ids = set(relevant_section_ids)
+        for section_id in section_ids:
+            section_hash = self._hashes.get((doc_name, section_id))
+            if section_hash is None:
+                continue
+            signature = self._signatures[section_hash]
+            is_new = self.conn.execute(
+                "INSERT OR IGNORE INTO sections (hash, signature) VALUES (?, ?)",
+                (section_hash, signature.tobytes() if signature is not None else None),
+            ).rowcount > 0
+            if is_new and signature is not None:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO bands (band, bucket, hash) VALUES (?, ?, ?)",
+                    [(band, bucket, section_hash) for band, bucket in band_buckets(signature)],
+                )
+            self.conn.execute(
+                "INSERT INTO decisions (item, hash, relevant, seen) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (item, hash) DO UPDATE SET relevant = relevant + excluded.relevant, seen = seen + 1",
+                (item_key, section_hash, int(section_id in relevant_section_ids)),
+            )
+            self.recorded += 1
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def summary(self):
+        num_sections = self.conn.execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+        return (
+            f"served {self.served_sections}/{self.candidate_sections} (doc, line item, section) pairs "
+            f"({self.served_sections / max(1, self.candidate_sections):.1%}) and {self.served_tokens}/{self.candidate_tokens} "
+            f"section tokens ({self.served_tokens / max(1, self.candidate_tokens):.1%}), "
+            f"{self.near_duplicate_sections} through near duplicates; recorded {self.recorded} decisions, {num_sections} known sections"
+        )
+
+
+def get_relevance_memo(path, mode, min_similarity=0.8):
+    if mode == 'off' or not path:
+        return None
+    return RelevanceMemo(path, mode=mode, min_similarity=min_similarity)
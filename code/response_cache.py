@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+
+
+CACHE_MODES = ['readwrite', 'readonly', 'refresh', 'off']
+
+
+def cache_key(create_params):
+    """Stable content hash of the request (model, messages, tools, temperature, max_tokens, ...)."""
+    canonical = json.dumps(create_params, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Persistent SQLite cache of chat completion responses keyed by `cache_key(create_params)`.
+
+    Modes:
+        readwrite: serve hits, store misses.
+        readonly: serve hits, never write.
+        refresh: ignore existing entries, store fresh responses.
+    The total stored size is bounded by `max_bytes`; least recently used entries are evicted first.
+    """
+
+    def __init__(self, path, mode='readwrite', max_bytes=1024 ** 3):
+        assert mode in CACHE_MODES and mode != 'off', f"Unknown cache mode {mode}"
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, create_params):
+        if self.mode == 'refresh':
+            self.misses += 1
+            return None
+        key = cache_key(create_params)
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.mode != 'readonly':
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, create_params, response):
+        if self.mode == 'readonly' or response is None:
+            return
+        key = cache_key(create_params)
+        blob = zlib.compress(json.dumps(response).encode("utf-8"))
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.total_bytes -= row[0]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+            (key, blob, len(blob), time.time()),
+        )
+        self.total_bytes += len(blob)
+        self.writes += 1
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is back under 90% of `max_bytes`."""
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self.evictions += len(to_delete)
+
+    def close(self):
+        self.conn.close()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"hits: {self.hits}, misses: {self.misses}, hit rate: {hit_rate:.2%}, writes: {self.writes}, "
+            f"evictions: {self.evictions}, size: {self.total_bytes / 1024 ** 2:.1f} MB"
+        )
+
+
+def get_response_cache(path, mode, max_mb):
+    if mode == 'off' or not path:
+        return None
+    return ResponseCache(path, mode=mode, max_bytes=int(max_mb * 1024 ** 2))
@@ -0,0 +1,240 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+from collections.abc import Mapping
+
+from checkpoint import write_json_array
+
+
+SECTION_BLOCK_PATTERN = re.compile(r"==== SECTION ID: (.+?) ====\n.*?\n==== SECTION \1 END ====", re.DOTALL)
+# Prompt pieces shorter than this are stored inline, a reference would not be smaller.
+MIN_BLOCK_CHARS = 64
+UNITS_FILE = "units.jsonl"
+BLOCKS_FILE = "blocks.jsonl"
+BLOCK_INDEX_FILE = "blocks.index.json"
+RESPONSES_FILE = "responses.bin"
+
+
+def split_prompt(text):
+    """Split a prompt into pieces that concatenate back to it: every rendered section, and the
+    text between sections cut after each blank line (metadata block, line item detail, instructions)."""
+    pieces = []
+    position = 0
+    for match in SECTION_BLOCK_PATTERN.finditer(text):
+        pieces.extend(p for p in re.split(r"(?<=\n\n)", text[position:match.start()]) if p)
+        pieces.append(match.group(0))
+        position = match.end()
+    pieces.extend(p for p in re.split(r"(?<=\n\n)", text[position:]) if p)
+    return pieces
+
+
+class CompactLogWriter:
+    """Writes a run log as a directory of three files instead of one indented JSON array.
+
+    `blocks.jsonl` holds every distinct prompt piece (section, metadata block, line item detail,
+    instruction paragraph, tool definitions) once, keyed by hash. `units.jsonl` holds one line
+    per record in which prompts are lists of block references (`[hash]`) and short literal
+    strings, and `tools` is a `{"$block": hash}` reference. `responses.bin` holds every response
+    zlib-compressed on its own, referenced from its record as `{"$response": [offset, length]}`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._units = open(os.path.join(path, UNITS_FILE), "w")
+        self._blocks = open(os.path.join(path, BLOCKS_FILE), "wb")
+        self._responses = open(os.path.join(path, RESPONSES_FILE), "wb")
+        self._block_index = {}
+        self.num_records = 0
+        self.num_block_references = 0
+
+    def _block(self, text):
+        block_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        self.num_block_references += 1
+        if block_hash not in self._block_index:
+            line = (json.dumps({"hash": block_hash, "text": text}, ensure_ascii=False) + "\n").encode("utf-8")
+            self._block_index[block_hash] = [self._blocks.tell(), len(line)]
+            self._blocks.write(line)
+        return block_hash
+
+    def _compact_create_params(self, create_params):
+        compact = dict(create_params)
+        if 'messages' in compact:
+            compact['messages'] = []
+            for message in create_params['messages']:
+                message = dict(message)
+                if isinstance(message.get('content'), str):
+                    message['$content'] = [
+                        [self._block(piece)] if len(piece) >= MIN_BLOCK_CHARS else piece
+                        for piece in split_prompt(message.pop('content'))
+                    ]
+                compact['messages'].append(message)
+        if 'tools' in compact:
+            compact['tools'] = {"$block": self._block(json.dumps(create_params['tools'], ensure_ascii=False))}
+        return compact
+
+    def write(self, record):
+        compact = dict(record)
+        if isinstance(compact.get('create_params'), dict):
+            compact['create_params'] = self._compact_create_params(compact['create_params'])
+        if compact.get('response') is not None:
+            data = zlib.compress(json.dumps(compact['response'], ensure_ascii=False).encode("utf-8"))
+            compact['response'] = {"$response": [self._responses.tell(), len(data)]}
+            self._responses.write(data)
+        self._units.write(json.dumps(compact, ensure_ascii=False) + "\n")
+        self.num_records += 1
+
+    def close(self):
+        for f in [self._units, self._blocks, self._responses]:
+            f.close()
+        with open(os.path.join(self.path, BLOCK_INDEX_FILE), "w") as f:
+            json.dump(self._block_index, f)
+
+
+def write_compact_log(path, records):
+    """Write records (e.g. streamed from a checkpoint) as a compact log directory, see `CompactLogWriter`."""
+    writer = CompactLogWriter(path)
+    try:
+        for record in records:
+            writer.write(record)
+    finally:
+        writer.close()
+    print(f"Compact log {path}: {writer.num_records} records, {len(writer._block_index)} distinct blocks for {writer.num_block_references} references")
+
+
+class CompactLog:
+    """Reader of a compact log directory; files are opened on first use, so it can be sent to worker processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._block_index = None
+        self._blocks = None
+        self._responses = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def block(self, block_hash):
+        if self._block_index is None:
+            with open(os.path.join(self.path, BLOCK_INDEX_FILE), "r") as f:
+                self._block_index = json.load(f)
+            self._blocks = open(os.path.join(self.path, BLOCKS_FILE), "rb")
+        offset, length = self._block_index[block_hash]
+        self._blocks.seek(offset)
+        return json.loads(self._blocks.read(length))['text']
+
+    def response(self, reference):
+        if self._responses is None:
+            self._responses = open(os.path.join(self.path, RESPONSES_FILE), "rb")
+        offset, length = reference
+        self._responses.seek(offset)
+        return json.loads(zlib.decompress(self._responses.read(length)))
+
+    def create_params(self, compact):
+        create_params = dict(compact)
+        if 'messages' in compact:
+            create_params['messages'] = []
+            for message in compact['messages']:
+                message = dict(message)
+                if '$content' in message:
+                    message['content'] = "".join(
+                        self.block(piece[0]) if isinstance(piece, list) else piece for piece in message.pop('$content')
+                    )
+                create_params['messages'].append(message)
+        if isinstance(compact.get('tools'), dict) and '$block' in compact['tools']:
+            create_params['tools'] = json.loads(self.block(compact['tools']['$block']))
+        return create_params
+
+    def __iter__(self):
+        with open(os.path.join(self.path, UNITS_FILE), "r") as f:
+            for line in f:
+                yield CompactRecord(json.loads(line), self)
+
+
+class CompactRecord(Mapping):
+    """A record of a compact log; `create_params` and `response` are only rebuilt when accessed."""
+
+    def __init__(self, data, log):
+        self._data = data
+        self._log = log
+        self._rebuilt = {}
+
+    def __getitem__(self, key):
+        if key in self._rebuilt:
+            return self._rebuilt[key]
+        value = self._data[key]
+        if key == 'response' and isinstance(value, dict) and '$response' in value:
+            value = self._rebuilt[key] = self._log.response(value['$response'])
+        elif key == 'create_params' and isinstance(value, dict):
+            value = self._rebuilt[key] = self._log.create_params(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def to_dict(self):
+        return {key: self[key] for key in self._data}
+
+
+def iter_json_records(path, chunk_chars=1 << 20):
+    """Stream the records of a JSON array (e.g. a step 4 log) or a JSONL file (e.g. a checkpoint) without loading it whole."""
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = ""
+        position = 0
+        is_eof = False
+        while True:
+            # Skip the separators between records: whitespace, the array brackets and commas.
+            while position < len(buffer) and buffer[position] in " \t\r\n[],":
+                position += 1
+            if position == len(buffer) and is_eof:
+                return
+            try:
+                if position == len(buffer):
+                    raise ValueError("need more data")
+                record, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if is_eof:
+                    raise
+                chunk = f.read(chunk_chars)
+                is_eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            position = end
+            yield record
+
+
+def iter_log_records(path):
+    """Records of a run log in any format: compact log directory, JSON array or JSONL."""
+    if os.path.isdir(path):
+        return iter(CompactLog(path))
+    return iter_json_records(path)
+
+
+def log_output_prefix(path):
+    """`path` without its `.json` / `.jsonl` extension, used to name files derived from a log."""
+    path = path.rstrip("/")
+    for extension in [".jsonl", ".json"]:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+def write_log(path, records, log_format='json'):
+    """Write a step's log as an indented JSON array (`{path}.json`) or a compact log directory (`{path}_compact`)."""
+    if log_format == 'compact':
+        write_compact_log(f"{path}_compact", records)
+    else:
+        write_json_array(f"{path}.json", records)
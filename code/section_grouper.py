@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+
+
+def section_content(section):
+    """Text whose tokens are budgeted for a section."""
+    return json.dumps(section, indent=4)
+
+
+class SectionTokenCounter:
+    """Token counts of sections, batch counted with a `token_counter` and memoized on disk by content hash."""
+
+    def __init__(self, token_counter, cache_path=None):
+        self.token_counter = token_counter
+        self.cache_path = cache_path
+        self.namespace = token_counter.namespace
+        self.counts = {}
+        self.num_tokenized = 0
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.counts = json.load(f)
+
+    def _key(self, content):
+        return hashlib.sha256(f"{self.namespace}\n{content}".encode("utf-8")).hexdigest()
+
+    def count_sections(self, sections):
+        """Return `{section id: token count}`; only sections never seen before are tokenized, in one batch.
+
+        `sections` may be a stream, it is read once.
+        """
+        keys = {}
+        missing = {}
+        for section in sections:
+            content = section_content(section)
+            key = self._key(content)
+            keys[section['id']] = key
+            if key not in self.counts:
+                missing[key] = content
+        if missing:
+            for key, count in zip(missing, self.token_counter.count_batch(missing.values())):
+                self.counts[key] = count
+            self.num_tokenized += len(missing)
+        return {section_id: self.counts[key] for section_id, key in keys.items()}
+
+    def save(self):
+        if not self.cache_path:
+            return
+        if os.path.dirname(self.cache_path):
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.counts, f)
+        os.replace(tmp_path, self.cache_path)
+
+
+def _next_fit_boundaries(token_counts, capacity, max_sections):
+    """Start index of every group when filling groups in order up to `capacity` tokens."""
+    starts = [0]
+    group_tokens = 0
+    group_size = 0
+    for i, count in enumerate(token_counts):
+        if group_size > 0 and (group_tokens + count > capacity or group_size >= max_sections):
+            starts.append(i)
+            group_tokens = 0
+            group_size = 0
+        group_tokens += count
+        group_size += 1
+    return starts
+
+
+def pack_sections(section_ids, section_token_counts, max_tokens, max_sections):
+    """Pack the sections of `section_ids`, in document order, into groups that never exceed `max_tokens` or `max_sections`.
+
+    Filling each group as far as possible gives the minimum number of groups for an
+    order-preserving split. The per-group capacity is then lowered to the smallest value
+    that keeps that group count, which evens group sizes out instead of leaving a small
+    tail group. A single section larger than `max_tokens` gets a group of its own.
+    Returns the groups (lists of section ids) and their token counts.
+    """
+    if not section_ids:
+        return [], []
+    token_counts = [section_token_counts[section_id] for section_id in section_ids]
+    num_groups = len(_next_fit_boundaries(token_counts, max_tokens, max_sections))
+    low = min(max(token_counts), max_tokens)
+    high = max_tokens
+    while low < high:
+        capacity = (low + high) // 2
+        if len(_next_fit_boundaries(token_counts, capacity, max_sections)) <= num_groups:
+            high = capacity
+        else:
+            low = capacity + 1
+    starts = _next_fit_boundaries(token_counts, low, max_sections) + [len(section_ids)]
+    grouped_sections = [section_ids[starts[i]:starts[i + 1]] for i in range(len(starts) - 1)]
+    grouped_token_counts = [sum(token_counts[starts[i]:starts[i + 1]]) for i in range(len(starts) - 1)]
+    return grouped_sections, grouped_token_counts
+
+
+def count_overflow_groups(token_counts, max_tokens, max_sections):
+    """Number of groups the previous grouping produced (a group closed only after exceeding the budget)."""
+    num_groups = 0
+    group_tokens = 0
+    group_size = 0
+    for count in token_counts:
+        group_tokens += count
+        group_size += 1
+        if group_tokens > max_tokens or group_size >= max_sections:
+            num_groups += 1
+            group_tokens = 0
+            group_size = 0
+    return num_groups + (1 if group_size > 0 else 0)
+
+
+def fill_ratio(grouped_token_counts, max_tokens):
+    if not grouped_token_counts:
+        return 0.0
+    return sum(grouped_token_counts) / (len(grouped_token_counts) * max_tokens)
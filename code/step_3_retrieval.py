@@ -1,12 +1,29 @@
+import os
 import json
-import openai
 import argparse
-from transformers import AutoTokenizer
-from joblib import Parallel, delayed
-from tqdm import tqdm
+from collections import Counter
+from llm_dispatch import run_units
+from batch_api import get_batch_backend, run_batch
+from work_queue import QUEUE_BACKENDS, get_work_queue, local_worker_args, run_queue
+from checkpoint import Checkpoint
+from run_log import write_log
+import telemetry
+from lexical_index import BM25Index
+from manifest import Manifest, fingerprint
+from document_store import DocumentStore, open_document
+from prompt_cache import MIN_CACHEABLE_PREFIX_TOKENS, CachedTokenReport, prefix_key
+from telemetry import percentile
+from relevance_memo import MEMO_MODES, get_relevance_memo
+from section_grouper import SectionTokenCounter, count_overflow_groups, fill_ratio, pack_sections
+from token_counter import get_token_counter
 
 
-TOKENIZER = AutoTokenizer.from_pretrained("Qwen/Qwen3-0.6B")
+TEMPERATURE = 0.0
+MAX_TOKENS = 5000
+SECTION_BATCH_SIZE = 10
+SECTION_MAX_TOKENS = 10000
+SCREEN_MAX_TOKENS = 2000
+ESCALATION_POLICIES = ['group', 'sections', 'uncertain']
 
 tool_def = {
     "type": "function",
@@ -51,19 +68,705 @@ You MUST call `output` tool to output result.
 """.strip("\n ")
 
 
-def get_client():
-    client = openai.OpenAI()
-    return client
+BATCH_RECALL_INSTRUCTION = """
+**DOCUMENT SECTION LIST**
+{document_section_list}
+
+**LINE ITEM INSTRUCTIONS**
+{line_item_details}
+
+Your objective is to determine, for EACH line item in **LINE ITEM INSTRUCTIONS**, whether each section in **DOCUMENT SECTION LIST** contains the information that the line item is looking for. You MUST follow the guidelines below: 
+## MANDATORY THINKING PROCESS
+1. Read through every line item in **LINE ITEM INSTRUCTIONS** and understand the targets to look for in the document section.
+2. For EVERY line item, go through each section throughly and check whether it contains info related to the targets. For EVERY line item and section, write down the evidence and reasoning why it is related in the format of `- [Line item name] - [Section ID]: evidence: [Evidence in this section], reasoning: [Reasoning for this section].\n`.
+
+## OUTPUT
+You MUST call `output` tool to output result, with exactly one entry in `results` for EVERY line item.
+""".strip("\n ")
+
+
+def get_batch_tool_def(item_names):
+    """`output` tool returning the relevant section ids of every line item in a batched call."""
+    return {
+        "type": "function",
+        "function": {
+            "name": "output",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "think": {
+                        "type": "string",
+                        "description": "Output your detailed thinking."
+                    },
+                    "results": {
+                        "type": "array",
+                        "description": "One entry per line item.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "line_item_name": {
+                                    "type": "string",
+                                    "description": "Line item name",
+                                    "enum": list(item_names),
+                                },
+                                "relevant_sections": {
+                                    "type": "array",
+                                    "description": "List of section IDs that found evidence related to the targets of this line item.",
+                                    "items": {
+                                        "type": "string",
+                                        "description": "Section ID"
+                                    }
+                                },
+                            },
+                            "required": ["line_item_name", "relevant_sections"],
+                            "additionalProperties": False,
+                        }
+                    },
+                },
+                "required": ["think", "results"],
+                "additionalProperties": False,
+            }
+        }
+    }
+
+
+SCREEN_INSTRUCTION = """
+**DOCUMENT SECTION LIST**
+{document_section_list}
 
+**LINE ITEM INSTRUCTION**
+{line_item_detail}
+
+Your objective is to screen each section in **DOCUMENT SECTION LIST** for the information that **LINE ITEM INSTRUCTION** is looking for. The sections you flag are re-checked by a careful reviewer, so flag every section that might be related:
+- `relevant_sections`: sections that clearly contain info related to the targets.
+- `uncertain_sections`: sections that might contain info related to the targets, but you are not sure.
+Sections in neither list are treated as not related.
+
+## OUTPUT
+You MUST call `output` tool to output result.
+""".strip("\n ")
+
+screen_tool_def = {
+    "type": "function",
+    "function": {
+        "name": "output",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "relevant_sections": {
+                    "type": "array",
+                    "description": "List of section IDs that clearly contain evidence related to the targets.",
+                    "items": {
+                        "type": "string",
+                        "description": "Section ID"
+                    }
+                },
+                "uncertain_sections": {
+                    "type": "array",
+                    "description": "List of section IDs that might contain evidence related to the targets.",
+                    "items": {
+                        "type": "string",
+                        "description": "Section ID"
+                    }
+                },
+            },
+            "required": ["relevant_sections", "uncertain_sections"],
+            "additionalProperties": False,
+        }
+    }
+}
+
+
+def render_section_list(local_sections):
+    ref_sections = []
+    for each_section in local_sections:
+        ref_sections.append(f"==== SECTION ID: {each_section['id']} ====\n{each_section['title']}\n{each_section['text']}\n==== SECTION {each_section['id']} END ====")
+    return "\n\n".join(ref_sections)
+
+
+def split_batched_unit(each_unit):
+    """Split a batched unit into one record per line item, shaped like single line item units."""
+    results_per_item = {}
+    if each_unit['result'] is not None:
+        try:
+            for each_result in each_unit['result']['results']:
+                results_per_item[each_result['line_item_name']] = each_result['relevant_sections']
+        except Exception as e:
+            print(f"Error: {each_unit['doc_name']} - batch {each_unit['unit_id']} - {e}")
+    records = []
+    for batch_item in each_unit['batch_items']:
+        record = {
+            "unit_id": f"{each_unit['doc_name']}::{batch_item['item_name']}::{batch_item['section_group_idx']}",
+            "batch_unit_id": each_unit['unit_id'],
+            "doc_name": each_unit['doc_name'],
+            "item_name": batch_item['item_name'],
+            "section_group_idx": batch_item['section_group_idx'],
+            "section_ids": each_unit['section_ids'],
+            "create_params": each_unit['create_params'],
+            "response": each_unit['response'],
+            "result": None,
+            "reasoning": None,
+        }
+        if batch_item['item_name'] in results_per_item:
+            record['result'] = {
+                "think": each_unit['reasoning'],
+                "relevant_sections": results_per_item[batch_item['item_name']],
+            }
+            record['reasoning'] = each_unit['reasoning']
+        else:
+            print(f"Error: {each_unit['doc_name']} - {batch_item['item_name']} - {batch_item['section_group_idx']} - missing from batched output")
+        records.append(record)
+    return records
+
+
+def memo_item_key(item_desc, model_name):
+    """Key of a line item's decisions in the relevance memo: they hold for this instruction and model only."""
+    return fingerprint(RECALL_INSTRUCTION, item_desc, model_name)
+
+
+def section_group_id(group_section_ids):
+    """Id of a section group packed from part of a document's sections, derived from the sections it holds.
+
+    Which sections the pre-filter and the memo leave out changes between runs, so the index of such a
+    group would name different sections in a resumed run than in the checkpoint.
+    """
+    return f"g{fingerprint(sorted(group_section_ids))[:12]}"
+
+
+def build_memo_record(doc_name, item_name, known_relevance):
+    """Checkpoint record of the sections of a line item whose relevance the memo served, shaped like a group record.
+
+    Its id changes with the decisions served, so that a resumed run serving more of them checkpoints a new record.
+    """
+    relevant_section_ids = [section_id for section_id, is_relevant in known_relevance.items() if is_relevant]
+    reasoning = f"Relevance of {len(known_relevance)} sections served from the relevance memo ({len(relevant_section_ids)} relevant)."
+    return {
+        "unit_id": f"{doc_name}::{item_name}::memo-{fingerprint(sorted(known_relevance.items()))[:12]}",
+        "doc_name": doc_name,
+        "item_name": item_name,
+        "section_group_idx": "memo",
+        "section_ids": list(known_relevance),
+        "memo": True,
+        "create_params": None,
+        "response": None,
+        "result": {
+            "think": reasoning,
+            "relevant_sections": relevant_section_ids,
+        },
+        "reasoning": reasoning,
+    }
+
+
+def build_group_unit(doc_name, item_name, group_id, local_sections, item_instruction, group_token_count, item_token_count, model_name, warmup=False):
+    """Unit asking `model_name` which sections of one section group are relevant to a line item."""
+    with telemetry.phase("build_prompts"):
+        document_section_list = render_section_list(local_sections)
+        prompt = RECALL_INSTRUCTION.format(
+            document_section_list=document_section_list,
+            line_item_detail=item_instruction,
+        )
+
+    create_params = {
+        "model": model_name,
+        "messages": [{'role': 'user', 'content': prompt}],
+        "temperature": TEMPERATURE,
+        "tools": [tool_def],
+        "max_tokens": MAX_TOKENS,
+    }
+    each_unit = {
+        "unit_id": f"{doc_name}::{item_name}::{group_id}",
+        "doc_name": doc_name,
+        "item_name": item_name,
+        "section_group_idx": group_id,
+        "section_ids": [s['id'] for s in local_sections],
+        "estimated_tokens": group_token_count + item_token_count,
+        'create_params': create_params,
+    }
+    if warmup and group_token_count >= MIN_CACHEABLE_PREFIX_TOKENS:
+        each_unit['prefix_key'] = prefix_key(document_section_list)
+    return each_unit
 
-def process_item(item_info):
-    """Process a single schema item for a document."""
-    # print(f"Processing {item_info['doc_name']} - {item_info['item_name']} - {item_info['section_group_idx']}...")
+
+def build_screen_unit(doc_name, item_name, group_id, local_sections, item_instruction, section_token_counts, item_token_count, cascade_model):
+    """Cascade unit screening a section group with the cheaper `cascade_model`.
+
+    It keeps the sections and token counts of the group, to build the main model unit if the group is escalated
+    (see `settle_screened_group`).
+    """
+    with telemetry.phase("build_prompts"):
+        prompt = SCREEN_INSTRUCTION.format(
+            document_section_list=render_section_list(local_sections),
+            line_item_detail=item_instruction,
+        )
+    group_token_counts = {s['id']: section_token_counts[s['id']] for s in local_sections}
+    return {
+        "unit_id": f"{doc_name}::{item_name}::{group_id}",
+        "doc_name": doc_name,
+        "item_name": item_name,
+        "section_group_idx": group_id,
+        "section_ids": [s['id'] for s in local_sections],
+        "cascade_tier": "screen",
+        "estimated_tokens": sum(group_token_counts.values()) + item_token_count,
+        'create_params': {
+            "model": cascade_model,
+            "messages": [{'role': 'user', 'content': prompt}],
+            "temperature": TEMPERATURE,
+            "tools": [screen_tool_def],
+            "max_tokens": SCREEN_MAX_TOKENS,
+        },
+        "sections": local_sections,
+        "section_token_counts": group_token_counts,
+        "item_instruction": item_instruction,
+        "item_token_count": item_token_count,
+    }
+
+
+def screen_decision(each_unit, response, policy):
+    """`(section ids to re-check with the main model, section ids kept as relevant, screen result)` of a screened group.
+
+    Escalation policies:
+        group: re-check the whole group if the screen flagged any of its sections.
+        sections: re-check only the flagged (relevant or uncertain) sections.
+        uncertain: keep the sections the screen found relevant, re-check only the uncertain ones.
+    A failed screen call re-checks the whole group.
+    """
+    group_ids = each_unit['section_ids']
+    try:
+        with telemetry.phase("parse_tool_calls"):
+            result = json.loads(response['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
+        relevant = set(result['relevant_sections'])
+        uncertain = set(result['uncertain_sections'])
+    except Exception as e:
+        print(f"Error: screen {each_unit['doc_name']} - {each_unit['item_name']} - {each_unit['section_group_idx']} - {e}. Escalating the whole group")
+        return group_ids, [], None
+    if policy == 'group':
+        return (group_ids if any(s in relevant or s in uncertain for s in group_ids) else []), [], result
+    if policy == 'sections':
+        return [s for s in group_ids if s in relevant or s in uncertain], [], result
+    return [s for s in group_ids if s in uncertain and s not in relevant], [s for s in group_ids if s in relevant], result
+
+
+def settle_screened_group(each_unit, response, args):
+    """Returns `(record, None)` if the screen's answer for the group is final, else `(None, main model unit)`.
+
+    The main model unit keeps the group's `section_ids`, so a failed call still counts the whole group
+    as relevant, and lists the sections actually in its prompt in `checked_section_ids`.
+    """
+    checked_ids, kept_ids, result = screen_decision(each_unit, response, args.cascade_escalation)
+    screen = {
+        "model": each_unit['create_params']['model'],
+        "result": result,
+        "usage": (response or {}).get('usage'),
+    }
+    if not checked_ids:
+        reasoning = f"Screened by {screen['model']}: {len(kept_ids)} relevant sections, none left for the main model."
+        return {
+            "unit_id": each_unit['unit_id'],
+            "doc_name": each_unit['doc_name'],
+            "item_name": each_unit['item_name'],
+            "section_group_idx": each_unit['section_group_idx'],
+            "section_ids": each_unit['section_ids'],
+            "cascade_tier": "screen",
+            "create_params": each_unit['create_params'],
+            "response": response,
+            "result": {
+                "think": reasoning,
+                "relevant_sections": kept_ids,
+            },
+            "reasoning": reasoning,
+            "screen": screen,
+        }, None
+    checked_sections = [s for s in each_unit['sections'] if s['id'] in checked_ids]
+    escalation = build_group_unit(
+        each_unit['doc_name'],
+        each_unit['item_name'],
+        each_unit['section_group_idx'],
+        checked_sections,
+        each_unit['item_instruction'],
+        sum(each_unit['section_token_counts'][s['id']] for s in checked_sections),
+        each_unit['item_token_count'],
+        args.model_name,
+        args.prompt_cache_warmup,
+    )
+    escalation.update({
+        "section_ids": each_unit['section_ids'],
+        "checked_section_ids": checked_ids,
+        "kept_section_ids": kept_ids,
+        "cascade_tier": "main",
+        "screen": screen,
+        "record_ids": each_unit['record_ids'],
+    })
+    return None, escalation
+
+
+def parse_escalated_response(each_unit, response):
+    """`parse_retrieval_response` for a group escalated by the cascade, adding the sections the screen kept as relevant."""
+    records = parse_retrieval_response(each_unit, response)
+    for record in records:
+        if record['result'] is not None and isinstance(record['result'].get('relevant_sections'), list):
+            record['result']['relevant_sections'] += [
+                s for s in record.pop('kept_section_ids') if s not in record['result']['relevant_sections']
+            ]
+    return records
+
+
+class CascadeReport:
+    """Calls, tokens and latency per cascade tier, and how many screened section groups were escalated."""
+
+    def __init__(self):
+        self.per_tier = {}
+        self.screened_groups = 0
+        self.escalated_groups = 0
+        self.group_sections = 0
+        self.checked_sections = 0
+
+    def add(self, each_unit, response):
+        tier_stats = self.per_tier.setdefault(
+            each_unit['cascade_tier'], {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latencies": []}
+        )
+        usage = (response or {}).get('usage') or {}
+        tier_stats['calls'] += 1
+        tier_stats['prompt_tokens'] += usage.get('prompt_tokens') or 0
+        tier_stats['completion_tokens'] += usage.get('completion_tokens') or 0
+        if each_unit.get('latency_seconds') is not None:
+            tier_stats['latencies'].append(each_unit['latency_seconds'])
+
+    def add_screened(self, each_unit, escalation):
+        self.screened_groups += 1
+        self.group_sections += len(each_unit['section_ids'])
+        if escalation is not None:
+            self.escalated_groups += 1
+            self.checked_sections += len(escalation['checked_section_ids'])
+
+    def print_summary(self):
+        print(f"Cascade report (retrieval): escalated {self.escalated_groups}/{self.screened_groups} screened groups, {self.checked_sections}/{self.group_sections} sections re-checked by the main model")
+        for tier, tier_stats in self.per_tier.items():
+            latencies = sorted(tier_stats['latencies'])
+            latency = f"p50 {percentile(latencies, 50):.2f}s, p95 {percentile(latencies, 95):.2f}s" if latencies else "n/a"
+            print(f"  {tier}: calls {tier_stats['calls']}, prompt tokens {tier_stats['prompt_tokens']}, completion tokens {tier_stats['completion_tokens']}, latency {latency}")
+        telemetry.count("cascade_screened_groups", self.screened_groups)
+        telemetry.count("cascade_escalated_groups", self.escalated_groups)
+        telemetry.count("cascade_group_sections", self.group_sections)
+        telemetry.count("cascade_checked_sections", self.checked_sections)
+
+
+def cascade_agreement(recall_results, reference_results):
+    """Agreement of the relevant sections of a cascade run with a full main model run, over their common (document, line item) pairs."""
+    agreement = {"line_items": 0, "identical_line_items": 0, "reference_sections": 0, "found_sections": 0, "selected_sections": 0}
+    for doc_name, items_per_doc in recall_results.items():
+        for item_name, item_info in items_per_doc.items():
+            reference = reference_results.get(doc_name, {}).get(item_name)
+            if reference is None:
+                continue
+            reference_ids = set(reference['relevant_sections'])
+            selected_ids = set(item_info['relevant_sections'])
+            agreement['line_items'] += 1
+            agreement['identical_line_items'] += int(reference_ids == selected_ids)
+            agreement['reference_sections'] += len(reference_ids)
+            agreement['found_sections'] += len(reference_ids & selected_ids)
+            agreement['selected_sections'] += len(selected_ids)
+    return agreement
+
+
+def build_document_units(doc_name, document, line_item_descs_dct, args, token_counter, section_token_counter, instruction_token_count, memo=None, cascade_model=None, counts=None):
+    """Units of one document, see `build_retrieval_units`; `counts` (a Counter) collects the grouping and pre-filter statistics.
+
+    The token counts, pre-filter and memo indexes are built from one stream of the sections each; only
+    section ids are kept, and every prompt fetches the sections of its group from `document`.
+    """
+    if counts is None:
+        counts = Counter()
+    processing_units = []
+
+    def fetch_sections(group_section_ids):
+        with telemetry.phase("load_documents"):
+            return list(document.iter_sections(set(group_section_ids)))
+
+    section_ids = document.section_ids()
+    with telemetry.phase("tokenize"):
+        section_token_counts = section_token_counter.count_sections(document.iter_sections())
+    with telemetry.phase("group_sections"):
+        grouped_sections, grouped_token_counts = pack_sections(
+            section_ids, section_token_counts, SECTION_MAX_TOKENS, SECTION_BATCH_SIZE
+        )
+    num_overflow_groups = count_overflow_groups(
+        [section_token_counts[section_id] for section_id in section_ids], SECTION_MAX_TOKENS, SECTION_BATCH_SIZE
+    )
+    counts['groups'] += len(grouped_sections)
+    counts['overflow_groups'] += num_overflow_groups
+    print(f"{doc_name} Grouped {len(section_ids)} sections into {len(grouped_sections)} groups (previously {num_overflow_groups}, allowed to overshoot the budget), fill ratio {fill_ratio(grouped_token_counts, SECTION_MAX_TOKENS):.1%}")
+    if args.prefilter == 'bm25':
+        with telemetry.phase("prefilter"):
+            lexical_index = BM25Index(document.iter_sections())
+    if memo is not None:
+        with telemetry.phase("relevance_memo"):
+            memo.index_document(doc_name, document.iter_sections())
+    batch_groups = {}
+
+    for item_name in line_item_descs_dct:
+        item_instruction = line_item_descs_dct[item_name]['Line item instruction']
+        with telemetry.phase("tokenize"):
+            item_token_count = instruction_token_count + token_counter.count(item_instruction)
+        item_section_ids = section_ids
+        if args.prefilter == 'bm25':
+            with telemetry.phase("prefilter"):
+                kept_ids = set(lexical_index.select(
+                    f"{item_name}\n{item_instruction}",
+                    top_k=args.prefilter_top_k,
+                    threshold=args.prefilter_threshold,
+                    margin=args.prefilter_margin,
+                ))
+            counts['prefilter_kept_sections'] += len(kept_ids)
+            counts['prefilter_total_sections'] += len(section_ids)
+            item_section_ids = [section_id for section_id in section_ids if section_id in kept_ids]
+        if memo is not None:
+            with telemetry.phase("relevance_memo"):
+                item_section_ids, known_relevance = memo.split(
+                    doc_name, memo_item_key(line_item_descs_dct[item_name], args.model_name), item_section_ids, section_token_counts
+                )
+            if known_relevance:
+                processing_units.append(build_memo_record(doc_name, item_name, known_relevance))
+        item_grouped_sections, item_grouped_token_counts = grouped_sections, grouped_token_counts
+        is_repacked = len(item_section_ids) < len(section_ids)
+        if is_repacked:
+            item_grouped_sections, item_grouped_token_counts = pack_sections(
+                item_section_ids,
+                section_token_counts,
+                SECTION_MAX_TOKENS,
+                SECTION_BATCH_SIZE,
+            )
+        for group_idx, group_section_ids in enumerate(item_grouped_sections):
+            group_id = section_group_id(group_section_ids) if is_repacked else group_idx
+            if args.items_per_call > 1:
+                group_key = tuple(group_section_ids)
+                if group_key not in batch_groups:
+                    batch_groups[group_key] = {
+                        "token_count": item_grouped_token_counts[group_idx],
+                        "items": [],
+                    }
+                batch_groups[group_key]['items'].append({
+                    "item_name": item_name,
+                    "section_group_idx": group_id,
+                    "token_count": item_token_count,
+                })
+                continue
+            if cascade_model:
+                processing_units.append(build_screen_unit(
+                    doc_name, item_name, group_id, fetch_sections(group_section_ids), item_instruction, section_token_counts, item_token_count, cascade_model
+                ))
+                continue
+            processing_units.append(build_group_unit(
+                doc_name,
+                item_name,
+                group_id,
+                fetch_sections(group_section_ids),
+                item_instruction,
+                item_grouped_token_counts[group_idx],
+                item_token_count,
+                args.model_name,
+                args.prompt_cache_warmup,
+            ))
+
+    for batch_group_idx, (group_key, batch_group) in enumerate(batch_groups.items()):
+        with telemetry.phase("build_prompts"):
+            document_section_list = render_section_list(fetch_sections(group_key))
+        for batch_start in range(0, len(batch_group['items']), args.items_per_call):
+            batch_items = batch_group['items'][batch_start:batch_start + args.items_per_call]
+            item_names = [batch_item['item_name'] for batch_item in batch_items]
+            line_item_details = "\n\n".join(
+                f"### {item_name}\n{line_item_descs_dct[item_name]['Line item instruction']}"
+                for item_name in item_names
+            )
+            with telemetry.phase("build_prompts"):
+                prompt = BATCH_RECALL_INSTRUCTION.format(
+                    document_section_list=document_section_list,
+                    line_item_details=line_item_details,
+                )
+            create_params = {
+                "model": args.model_name,
+                "messages": [{'role': 'user', 'content': prompt}],
+                "temperature": TEMPERATURE,
+                "tools": [get_batch_tool_def(item_names)],
+                "max_tokens": MAX_TOKENS,
+            }
+            each_unit = {
+                "unit_id": f"{doc_name}::batch::{batch_group_idx}::{batch_start // args.items_per_call}",
+                "doc_name": doc_name,
+                "item_names": item_names,
+                "batch_items": [
+                    {"item_name": b['item_name'], "section_group_idx": b['section_group_idx']} for b in batch_items
+                ],
+                "section_ids": list(group_key),
+                "estimated_tokens": batch_group['token_count'] + sum(b['token_count'] for b in batch_items),
+                'create_params': create_params,
+            }
+            if args.prompt_cache_warmup and batch_group['token_count'] >= MIN_CACHEABLE_PREFIX_TOKENS:
+                each_unit['prefix_key'] = prefix_key(document_section_list)
+            processing_units.append(each_unit)
+    return processing_units
+
+
+def build_retrieval_units(docs, line_item_descs_dct, args, token_counter, store=None, memo=None, cascade_model=None):
+    """Pack the sections of every document into groups and build one unit per (line item, section group).
+
+    With `args.items_per_call > 1` line items sharing a section group are asked about in one call.
+    With a `cascade_model`, every group is first screened by that model (see `settle_screened_group`).
+    With a relevance `memo`, sections whose relevance for a line item is already known are left out of
+    its groups and returned in one memo record per (document, line item) instead (`unit['memo']`).
+    Every unit lists the ids of the per line item records it produces in `record_ids`.
+    """
+    with telemetry.phase("tokenize"):
+        instruction_token_count = token_counter.count(RECALL_INSTRUCTION)
+    processing_units = []
+    counts = Counter()
+    section_token_counter = SectionTokenCounter(token_counter, cache_path="processed_data/section_token_counts.json")
+    for doc_name in docs:
+        with telemetry.phase("load_documents"):
+            document = open_document(doc_name, store)
+        try:
+            processing_units.extend(build_document_units(
+                doc_name, document, line_item_descs_dct, args, token_counter, section_token_counter,
+                instruction_token_count, memo, cascade_model, counts,
+            ))
+        finally:
+            document.close()
+
+    section_token_counter.save()
+    print(f"Grouped all documents into {counts['groups']} groups (previously {counts['overflow_groups']}), {counts['groups'] / max(1, len(docs)):.1f} groups/doc, {section_token_counter.num_tokenized} sections tokenized")
+    if args.prefilter == 'bm25':
+        print(f"BM25 pre-filter kept {counts['prefilter_kept_sections']}/{counts['prefilter_total_sections']} (doc, line item, section) pairs, {sum(1 for u in processing_units if not u.get('memo'))} units to send")
+    if memo is not None:
+        telemetry.count("memo_candidate_sections", memo.candidate_sections)
+        telemetry.count("memo_served_sections", memo.served_sections)
+        telemetry.count("memo_candidate_tokens", memo.candidate_tokens)
+        telemetry.count("memo_served_tokens", memo.served_tokens)
+        telemetry.count("memo_near_duplicate_sections", memo.near_duplicate_sections)
+    for each_unit in processing_units:
+        if 'batch_items' in each_unit:
+            each_unit['record_ids'] = [
+                f"{each_unit['doc_name']}::{b['item_name']}::{b['section_group_idx']}" for b in each_unit['batch_items']
+            ]
+        else:
+            each_unit['record_ids'] = [each_unit['unit_id']]
+    return processing_units
+
+
+def build_retrieval_manifest(docs, line_item_descs_dct, args, token_counter, store=None, memo_records=()):
+    """Fingerprints of the inputs of every (document, line item) retrieval, see `manifest.Manifest`.
+
+    The decisions served from the relevance memo are inputs of their unit, as they change its section groups.
+    """
+    config = [
+        RECALL_INSTRUCTION,
+        BATCH_RECALL_INSTRUCTION,
+        tool_def,
+        TEMPERATURE,
+        MAX_TOKENS,
+        SECTION_BATCH_SIZE,
+        SECTION_MAX_TOKENS,
+        token_counter.namespace,
+        args.model_name,
+        args.prefilter,
+        args.prefilter_top_k,
+        args.prefilter_threshold,
+        args.prefilter_margin,
+        args.items_per_call,
+    ]
+    if args.cascade_model:
+        config += [SCREEN_INSTRUCTION, screen_tool_def, SCREEN_MAX_TOKENS, args.cascade_model, args.cascade_escalation]
+    manifest = Manifest(fingerprint(*config))
+    for doc_name in docs:
+        document = open_document(doc_name, store)
+        manifest.documents[doc_name] = document.fingerprint()
+        document.close()
+    for item_name, item_desc in line_item_descs_dct.items():
+        manifest.line_items[item_name] = fingerprint(item_desc)
+    memo_decisions = {
+        (record['doc_name'], record['item_name']): [record['section_ids'], record['result']['relevant_sections']]
+        for record in memo_records
+    }
+    for doc_name in docs:
+        for item_name in line_item_descs_dct:
+            if (doc_name, item_name) in memo_decisions:
+                manifest.add_unit(doc_name, item_name, memo_decisions[(doc_name, item_name)])
+            else:
+                manifest.add_unit(doc_name, item_name)
+    return manifest
+
+
+def parse_retrieval_response(each_unit, response):
+    """Attach the response and parsed tool call to the unit; returns its per line item checkpoint records."""
+    each_unit['response'] = response
     try:
-        response = get_client().chat.completions.create(**item_info['create_params'])
-        return response.model_dump()
+        with telemetry.phase("parse_tool_calls"):
+            each_unit['result'] = json.loads(response['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
+        each_unit['reasoning'] = each_unit['result']['think']
     except Exception as e:
-        return None
+        each_unit['result'] = None
+        each_unit['reasoning'] = None
+        print(f"Error: {each_unit['doc_name']} - {each_unit.get('item_name', each_unit.get('item_names'))} - {each_unit.get('section_group_idx')} - {e}")
+    if 'batch_items' in each_unit:
+        return split_batched_unit(each_unit)
+    each_unit.pop('record_ids')
+    return [each_unit]
+
+
+def merge_group_results(result_lst):
+    """Union of the relevant sections found in every section group of a line item.
+
+    Groups whose call failed are counted as entirely relevant. Returns `(relevant_section_ids, reasoning)`.
+    """
+    relevant_section_ids = []
+    reasoning_lst = []
+    for each_unit in result_lst:
+        try:
+            assert isinstance(each_unit['result']['relevant_sections'], list)
+            relevant_section_ids.extend(each_unit['result']['relevant_sections'])
+            reasoning_lst.append(each_unit['reasoning'])
+        except Exception as e:
+            print(f"Aggregate results Error: {each_unit['doc_name']} - {each_unit['item_name']} - {each_unit['section_group_idx']} - {e}. Adding all section ids: {each_unit['section_ids']}")
+            relevant_section_ids.extend(each_unit['section_ids'])
+    return sorted(list(set(relevant_section_ids))), "\n\n".join(reasoning_lst)
+
+
+def group_result_entry(record):
+    """The part of a retrieval record that aggregation needs."""
+    return {
+        key: record[key]
+        for key in ['doc_name', 'item_name', 'section_group_idx', 'section_ids', 'result', 'reasoning']
+    }
+
+
+def collect_retrieval_records(checkpoint, unit_ids, recall_results):
+    """Stream checkpoint records into the log while keeping only what aggregation needs in `recall_results`."""
+    for record in checkpoint.iter_records(unit_ids):
+        items_per_doc = recall_results[record['doc_name']]
+        if record['item_name'] not in items_per_doc:
+            items_per_doc[record['item_name']] = {'result_lst': []}
+        items_per_doc[record['item_name']]['result_lst'].append(group_result_entry(record))
+        yield record
+
+
+def aggregate_retrieval_results(recall_results, token_counter, store=None):
+    """Replace the per group results of every line item with its relevant sections and their token count."""
+    for doc_name, items_per_doc in recall_results.items():
+        document = open_document(doc_name, store)
+        for item_name, item_info in items_per_doc.items():
+            relevant_section_ids, reasoning = merge_group_results(item_info.pop('result_lst'))
+            item_info['reasoning'] = reasoning
+            item_info['relevant_sections'] = relevant_section_ids
+            recall_sections = []
+            for section_id in item_info['relevant_sections']:
+                each_section = document.get_section(section_id)
+                if each_section is not None:
+                    recall_sections.append(each_section)
+                else:
+                    print(f"Section ID {section_id} not found in {doc_name}")
+            with telemetry.phase("tokenize"):
+                token_count = token_counter.count(json.dumps(recall_sections, indent=4))
+            item_info['token_count'] = token_count
+        document.close()
+    return recall_results
 
 
 if __name__ == "__main__":
@@ -75,6 +778,13 @@ if __name__ == "__main__":
         required=False,
         help="Test run"
     )
+    parser.add_argument(
+        "--docs",
+        type=str,
+        default=None,
+        required=False,
+        help="Comma separated document names to run on instead of the default documents, e.g. a synthetic corpus"
+    )
     parser.add_argument(
         "--model-name",
         type=str,
@@ -87,17 +797,224 @@ if __name__ == "__main__":
         type=int,
         default=16,
         required=False,
-        help="Number of jobs"
+        help="Maximum number of in-flight API requests"
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Requests per minute budget (0 for no limit)"
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Tokens per minute budget (0 for no limit)"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=6,
+        required=False,
+        help="Retries per request on rate limits and transient API errors"
+    )
+    parser.add_argument(
+        "--cache-mode",
+        choices=['readwrite', 'readonly', 'refresh', 'off'],
+        default='readwrite',
+        required=False,
+        help="Response cache mode: readwrite, readonly (never write), refresh (ignore hits, overwrite) or off"
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default="processed_data/response_cache.sqlite",
+        required=False,
+        help="Path of the SQLite response cache"
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=1024,
+        required=False,
+        help="Size bound of the response cache in MB, least recently used entries are evicted first"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the JSONL checkpoint of an interrupted run, skipping units already completed"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rerun the (document, line item) units whose document, instruction or run config changed since the last run, keeping the others from its checkpoint"
+    )
+    parser.add_argument(
+        "--log-format",
+        type=str,
+        default="json",
+        choices=['json', 'compact'],
+        required=False,
+        help="Log format: json writes one indented JSON array, compact writes a directory (..._log_<model>_compact/) that stores each distinct prompt block once and compresses responses"
+    )
+    parser.add_argument(
+        "--doc-store",
+        type=str,
+        default="",
+        required=False,
+        help="Directory of the indexed document store, converted from raw_data on first use (empty: read the raw JSON files)"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=['online', 'batch', 'queue'],
+        default='online',
+        required=False,
+        help="online: interactive chat.completions calls, batch: submit all units through a Batch API backend, queue: enqueue all units into a work queue answered by queue_worker.py processes"
+    )
+    parser.add_argument(
+        "--batch-backend",
+        choices=['openai', 'local'],
+        default='openai',
+        required=False,
+        help="Batch backend: the OpenAI Batch API or a local file-based stand-in answering with mock responses"
+    )
+    parser.add_argument(
+        "--batch-dir",
+        type=str,
+        default="processed_data/batches",
+        required=False,
+        help="Directory of the batch request files and submitted batch ids"
+    )
+    parser.add_argument(
+        "--batch-poll-seconds",
+        type=float,
+        default=60,
+        required=False,
+        help="Seconds between two batch status polls"
+    )
+    parser.add_argument(
+        "--queue-backend",
+        choices=QUEUE_BACKENDS,
+        default='sqlite',
+        required=False,
+        help="Work queue backend of --mode queue"
+    )
+    parser.add_argument(
+        "--queue-path",
+        type=str,
+        default="processed_data/work_queue.sqlite",
+        required=False,
+        help="Path of the work queue, shared with the workers (e.g. on a shared volume)"
+    )
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        required=False,
+        help="Number of queue_worker.py processes to start on this host, each with --n-jobs requests in flight and a share of --rpm/--tpm (0: only workers started separately)"
+    )
+    parser.add_argument(
+        "--queue-poll-seconds",
+        type=float,
+        default=1.0,
+        required=False,
+        help="Seconds between two polls of the work queue for completed units"
+    )
+    parser.add_argument(
+        "--prefilter",
+        choices=['none', 'bm25'],
+        default='none',
+        required=False,
+        help="Lexical pre-filter that prunes sections before LLM retrieval"
+    )
+    parser.add_argument(
+        "--prefilter-top-k",
+        type=int,
+        default=20,
+        required=False,
+        help="Number of best ranked sections kept per line item by the pre-filter"
+    )
+    parser.add_argument(
+        "--prefilter-threshold",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Also keep sections scoring at least this fraction of the best BM25 score"
+    )
+    parser.add_argument(
+        "--prefilter-margin",
+        type=int,
+        default=5,
+        required=False,
+        help="Recall safety margin: extra next-ranked sections kept beyond the cutoff"
+    )
+    parser.add_argument(
+        "--items-per-call",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of line items asked about in one call over the same section group"
+    )
+    parser.add_argument(
+        "--relevance-memo",
+        choices=MEMO_MODES,
+        default='off',
+        required=False,
+        help="Relevance memo mode: readwrite serves the relevance of sections already decided in previous runs (exact or near duplicate wording) and records new decisions, readonly never writes, off disables it"
+    )
+    parser.add_argument(
+        "--memo-path",
+        type=str,
+        default="processed_data/relevance_memo.sqlite",
+        required=False,
+        help="Path of the SQLite relevance memo"
+    )
+    parser.add_argument(
+        "--memo-min-similarity",
+        type=float,
+        default=0.8,
+        required=False,
+        help="Minimum estimated Jaccard similarity of word shingles for a known section to count as a near duplicate"
+    )
+    parser.add_argument(
+        "--cascade-model",
+        type=str,
+        default="",
+        required=False,
+        help="Cheaper model screening every section group first; only the groups it flags are re-checked by --model-name (empty: no cascade). Outputs are named step_3_retrieval_*_<model>_cascade_<cascade model>"
+    )
+    parser.add_argument(
+        "--cascade-escalation",
+        choices=ESCALATION_POLICIES,
+        default='group',
+        required=False,
+        help="Cascade escalation policy: group re-checks a whole group with any flagged section, sections re-checks only the flagged sections, uncertain keeps the sections screened as relevant and re-checks only the uncertain ones"
+    )
+    parser.add_argument(
+        "--cascade-reference",
+        type=str,
+        default="",
+        required=False,
+        help="Step 3 result of a full main model run to report the cascade's retrieval agreement against (default: step_3_retrieval_result_<model>.json if it exists)"
+    )
+    parser.add_argument(
+        "--token-counter",
+        choices=['hf', 'estimate'],
+        default='hf',
+        required=False,
+        help="hf: exact counts with the Qwen/Qwen3-0.6B tokenizer, estimate: calibrated pure Python estimate (see code/token_counter.py)"
+    )
+    parser.add_argument(
+        "--prompt-cache-warmup",
+        action="store_true",
+        help="Send one warm-up call per shared section group prefix before releasing the calls that reuse it"
     )
     
     args = parser.parse_args()
+    telemetry.start_run("step_3_retrieval")
     
-    TEMPERATURE = 0.0
-    MAX_TOKENS = 5000
-    N_JOBS = 30
-    SECTION_BATCH_SIZE = 10
-    SECTION_MAX_TOKENS = 10000
-
     docs = [
         "adventis",
         "ancora_heart",
@@ -114,110 +1031,172 @@ if __name__ == "__main__":
         "standard_biotools",
         "sylabs",
     ]
+    if args.docs:
+        docs = args.docs.split(",")
     if args.test_run:
         docs = docs[:1]
     with open("raw_data/retrieval_instructions.json", "r") as f:
         line_item_descs = json.load(f)
     if args.test_run:
         line_item_descs = line_item_descs[:1]
+    if args.cascade_model and args.items_per_call > 1:
+        parser.error("--cascade-model screens one line item per call, it cannot be combined with --items-per-call > 1")
+    output_name = f"{args.model_name}_cascade_{args.cascade_model}" if args.cascade_model else args.model_name
     line_item_descs_dct = {d['Line item name']: d for d in line_item_descs}
 
-    processing_units = []
-    all_sections = {}
-    for doc_name in docs:
-        with open(f"raw_data/outputs/{doc_name}.json", "r") as f:
-            chunker_result = json.load(f)['chunker_result']
-        sections = chunker_result['document_sections']
-        all_sections[doc_name] = {s['id']: s for s in sections}
-        grouped_sections = []
-        current_section_index = 0
-        last_local_group = []
-        last_local_group_token_count = 0
-        while current_section_index < len(sections):
-            last_local_group.append(sections[current_section_index])
-            last_local_group_token_count += len(TOKENIZER.encode(json.dumps(sections[current_section_index], indent=4)))
-            if last_local_group_token_count > SECTION_MAX_TOKENS or len(last_local_group) >= SECTION_BATCH_SIZE:
-                grouped_sections.append(last_local_group)
-                last_local_group = []
-                last_local_group_token_count = 0
-            current_section_index += 1
-        if len(last_local_group) > 0:
-            grouped_sections.append(last_local_group)
-        print(f"{doc_name} Grouped {len(grouped_sections)} sections")
+    store = DocumentStore(args.doc_store) if args.doc_store else None
+    if store is not None:
+        print(f"Document store: converted {store.build(docs)} of {len(docs)} documents")
+    token_counter = get_token_counter(args.token_counter, conservative=True)
+    memo = get_relevance_memo(args.memo_path, args.relevance_memo, args.memo_min_similarity)
+    with telemetry.phase("build_units"):
+        processing_units = build_retrieval_units(docs, line_item_descs_dct, args, token_counter, store, memo, args.cascade_model)
+    unit_ids = [record_id for each_unit in processing_units for record_id in each_unit['record_ids']]
+    memo_records = [each_unit for each_unit in processing_units if each_unit.get('memo')]
+    processing_units = [each_unit for each_unit in processing_units if not each_unit.get('memo')]
+    manifest_path = f"processed_data/step_3_retrieval_manifest_{output_name}.json"
+    manifest = build_retrieval_manifest(docs, line_item_descs_dct, args, token_counter, store, memo_records)
+    checkpoint = Checkpoint(
+        f"processed_data/step_3_retrieval_checkpoint_{output_name}.jsonl",
+        resume=args.resume or args.incremental,
+    )
+    completed_ids = checkpoint.completed_ids()
+    if args.incremental:
+        previous_manifest = Manifest.load(manifest_path)
+        changed_units = manifest.changed_units(previous_manifest)
+        print(f"Incremental: {manifest.describe_changes(previous_manifest, changed_units)}")
+        # Records are `{doc}::{item}::{group}`; the rerun appends newer records that supersede the stale ones.
+        completed_ids = {
+            record_id for record_id in completed_ids if record_id.rsplit("::", 1)[0] not in changed_units
+        }
+    pending_units = [
+        each_unit for each_unit in processing_units
+        if not all(record_id in completed_ids for record_id in each_unit['record_ids'])
+    ]
+    if args.resume or args.incremental:
+        print(f"{'Incremental' if args.incremental else 'Resuming'}: skipping {len(processing_units) - len(pending_units)} units already in checkpoint, {len(pending_units)} to run")
+    with telemetry.phase("checkpoint"):
+        for record in memo_records:
+            if record['unit_id'] not in completed_ids:
+                record.pop('record_ids')
+                checkpoint.append(record)
 
-        for item_name in line_item_descs_dct:
-            item_instruction = line_item_descs_dct[item_name]['Line item instruction']
-            for group_idx, local_sections in enumerate(grouped_sections):
-                ref_sections = []
-                for each_section in local_sections:
-                    ref_sections.append(f"==== SECTION ID: {each_section['id']} ====\n{each_section['title']}\n{each_section['text']}\n==== SECTION {each_section['id']} END ====")
-                document_section_list = "\n\n".join(ref_sections)
-                prompt = RECALL_INSTRUCTION.format(
-                    document_section_list=document_section_list,
-                    line_item_detail=item_instruction,
-                )
+    cache_report = CachedTokenReport("retrieval")
+    memo_item_keys = {item_name: memo_item_key(item_desc, args.model_name) for item_name, item_desc in line_item_descs_dct.items()}
 
-                create_params = {
-                    "model": args.model_name,
-                    "messages": [{'role': 'user', 'content': prompt}],
-                    "temperature": TEMPERATURE,
-                    "tools": [tool_def],
-                    "max_tokens": MAX_TOKENS,
-                }
-                each_unit = {
-                    "doc_name": doc_name,
-                    "item_name": item_name,
-                    "section_group_idx": group_idx,
-                    "section_ids": [s['id'] for s in local_sections],
-                    'create_params': create_params,
-                }
-                processing_units.append(each_unit)
-
-    results = Parallel(n_jobs=N_JOBS)(
-        delayed(process_item)(item_info)
-        for item_info in tqdm(processing_units)
-    )
-    print(f"\n\nGathering results...")
-    for i, each_unit in enumerate(processing_units):
-        each_unit['response'] = results[i]
-        try:
-            each_unit['result'] = json.loads(results[i]['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
-            each_unit['reasoning'] = each_unit['result']['think']
-        except Exception as e:
-            each_unit['result'] = None
-            each_unit['reasoning'] = None
-            print(f"Error: {each_unit['doc_name']} - {each_unit['item_name']} - {each_unit['section_group_idx']} - {e}")
-    
+    cascade_report = CascadeReport() if args.cascade_model else None
+
+    def on_result(each_unit, response):
+        """Checkpoint the records of a finished unit; returns the main model unit of a screened group to escalate."""
+        cache_report.add(each_unit['doc_name'], response)
+        if cascade_report is not None:
+            cascade_report.add(each_unit, response)
+        if each_unit.get('cascade_tier') == 'screen':
+            telemetry.observe_unit("retrieval_screen", each_unit, response)
+            record, escalation = settle_screened_group(each_unit, response, args)
+            cascade_report.add_screened(each_unit, escalation)
+            if escalation is not None:
+                return [escalation]
+            records = [record]
+        else:
+            telemetry.observe_unit("retrieval", each_unit, response)
+            if each_unit.get('cascade_tier') == 'main':
+                records = parse_escalated_response(each_unit, response)
+            else:
+                records = parse_retrieval_response(each_unit, response)
+        with telemetry.phase("checkpoint"):
+            for record in records:
+                checkpoint.append(record)
+        if memo is not None:
+            with telemetry.phase("relevance_memo"):
+                for record in records:
+                    # Only the main model's decisions are recorded, for the sections that were in its prompt.
+                    if record.get('cascade_tier') == 'screen':
+                        continue
+                    if record['result'] is not None and isinstance(record['result'].get('relevant_sections'), list):
+                        memo.record(
+                            record['doc_name'],
+                            memo_item_keys[record['item_name']],
+                            record.get('checked_section_ids', record['section_ids']),
+                            record['result']['relevant_sections'],
+                        )
+
+    with telemetry.phase("dispatch"):
+        if args.mode == 'batch':
+            # Escalations of a cascade are submitted as a second round of batches once the screens are back.
+            batch_units, batch_round = pending_units, 0
+            while batch_units:
+                follow_ups = []
+                run_batch(
+                    batch_units,
+                    get_batch_backend(args.batch_backend, args.batch_dir),
+                    f"{args.batch_dir}/step_3_retrieval_{output_name}" + ("_escalated" if batch_round > 0 else ""),
+                    lambda each_unit, response: follow_ups.extend(on_result(each_unit, response) or ()),
+                    poll_seconds=args.batch_poll_seconds,
+                    cache_path=args.cache_path,
+                    cache_mode=args.cache_mode,
+                    cache_max_mb=args.cache_max_mb,
+                )
+                batch_units, batch_round = follow_ups, batch_round + 1
+        elif args.mode == 'queue':
+            work_queue = get_work_queue(args.queue_backend, args.queue_path)
+            run_queue(
+                pending_units,
+                work_queue,
+                f"step_3_retrieval_{output_name}",
+                on_result,
+                poll_seconds=args.queue_poll_seconds,
+                local_workers=args.local_workers,
+                worker_args=local_worker_args(args),
+            )
+            work_queue.disconnect()
+        else:
+            telemetry.add_stats(run_units(
+                pending_units,
+                args.n_jobs,
+                on_result,
+                rpm=args.rpm,
+                tpm=args.tpm,
+                max_retries=args.max_retries,
+                cache_path=args.cache_path,
+                cache_mode=args.cache_mode,
+                cache_max_mb=args.cache_max_mb,
+                warmup=args.prompt_cache_warmup,
+            ))
+    cache_report.print_summary()
+    if cascade_report is not None:
+        cascade_report.print_summary()
+    if memo is not None:
+        print(f"Relevance memo ({memo.mode}): {memo.summary()}")
+        memo.close()
+    print("\n\nGathering results...")
     recall_results = {doc_name: {} for doc_name in docs}
-    for each_unit in processing_units:
-        if each_unit['item_name'] not in recall_results[each_unit['doc_name']]:
-            recall_results[each_unit['doc_name']][each_unit['item_name']] = {'result_lst': []}
-        recall_results[each_unit['doc_name']][each_unit['item_name']]['result_lst'].append(each_unit)
-    # Aggregate results
-    for doc_name, items_per_doc in recall_results.items():
-        for item_name, item_info in items_per_doc.items():
-            relevant_section_ids = []
-            reasoning_lst = []
-            for each_unit in item_info['result_lst']:
-                try:
-                    assert isinstance(each_unit['result']['relevant_sections'], list)
-                    relevant_section_ids.extend(each_unit['result']['relevant_sections'])
-                    reasoning_lst.append(each_unit['reasoning'])
-                except Exception as e:
-                    print(f"Aggregate results Error: {each_unit['doc_name']} - {each_unit['item_name']} - {each_unit['section_group_idx']} - {e}. Adding all section ids: {each_unit['section_ids']}")
-                    relevant_section_ids.extend(each_unit['section_ids'])
-            item_info['reasoning'] = "\n\n".join(reasoning_lst)
-            item_info['relevant_sections'] = sorted(list(set(relevant_section_ids)))
-            item_info.pop('result_lst')
-            recall_sections = []
-            for section_id in item_info['relevant_sections']:
-                if section_id in all_sections[doc_name]:
-                    recall_sections.append(all_sections[doc_name][section_id])
-                else:
-                    print(f"Section ID {section_id} not found in {doc_name}")
-            token_count = len(TOKENIZER.encode(json.dumps(recall_sections, indent=4)))
-            item_info['token_count'] = token_count
-    with open(f"processed_data/step_3_retrieval_result_{args.model_name}.json", 'w') as f:
-        json.dump(recall_results, f, indent=4)
-    with open(f"processed_data/step_3_retrieval_log_{args.model_name}.json", "w") as f:
-        json.dump(processing_units, f, indent=4)
+
+    with telemetry.phase("write_log"):
+        write_log(
+            f"processed_data/step_3_retrieval_log_{output_name}",
+            collect_retrieval_records(checkpoint, unit_ids, recall_results),
+            args.log_format,
+        )
+    checkpoint.close()
+    with telemetry.phase("aggregate"):
+        aggregate_retrieval_results(recall_results, token_counter, store)
+    with telemetry.phase("write_result"):
+        with open(f"processed_data/step_3_retrieval_result_{output_name}.json", 'w') as f:
+            json.dump(recall_results, f, indent=4)
+    if args.cascade_model:
+        reference_path = args.cascade_reference or f"processed_data/step_3_retrieval_result_{args.model_name}.json"
+        if os.path.exists(reference_path):
+            with open(reference_path, "r") as f:
+                agreement = cascade_agreement(recall_results, json.load(f))
+            for key, value in agreement.items():
+                telemetry.count(f"cascade_agreement_{key}", value)
+            print(
+                f"Cascade agreement with {reference_path}: {agreement['identical_line_items']}/{agreement['line_items']} (doc, line item) pairs identical, "
+                f"recall {agreement['found_sections']}/{agreement['reference_sections']} ({agreement['found_sections'] / max(1, agreement['reference_sections']):.1%}), "
+                f"precision {agreement['found_sections']}/{agreement['selected_sections']} ({agreement['found_sections'] / max(1, agreement['selected_sections']):.1%})"
+            )
+        else:
+            print(f"Cascade agreement: no main model result at {reference_path}, run step 3 without --cascade-model to compare against")
+    manifest.save(manifest_path)
+    telemetry.get_telemetry().write(f"processed_data/step_3_retrieval_run_report_{output_name}.json")
@@ -1,11 +1,17 @@
 import json
 import argparse
-from copy import deepcopy
-import json
-import openai
-from joblib import Parallel, delayed
-from tqdm import tqdm
-import argparse
+from collections import Counter
+from llm_dispatch import run_units
+from batch_api import get_batch_backend, run_batch
+from work_queue import QUEUE_BACKENDS, get_work_queue, local_worker_args, run_queue
+from checkpoint import Checkpoint, format_array_item
+from run_log import write_log
+from document_store import DocumentStore, open_document
+from manifest import Manifest, fingerprint
+from prompt_cache import MIN_CACHEABLE_PREFIX_TOKENS, CachedTokenReport, get_cached_tokens, prefix_key
+from token_counter import estimate_tokens
+import telemetry
+from telemetry import percentile
 
 
 EXTRACTION_INSTRUCTION = """
@@ -32,6 +38,47 @@ Once you have all the information, call `extract` tool to output result.
     "\n "
 )
 
+# Same prompt with the per-document blocks first, so that all line items of a document
+# share a byte-identical prefix that the provider's prompt cache can reuse.
+PREFIX_FIRST_EXTRACTION_INSTRUCTION = EXTRACTION_INSTRUCTION.replace(
+    "**POLICY DOCUMENT**\n{document_sections}\n\n**POLICY METADATA**\n{policy_metadata}\n\n",
+    "**POLICY METADATA**\n{policy_metadata}\n\n**POLICY DOCUMENT**\n{document_sections}\n\n",
+)
+
+
+BATCH_EXTRACTION_INSTRUCTION = """
+**POLICY DOCUMENT**
+{document_sections}
+
+**POLICY METADATA**
+{policy_metadata}
+
+**LINE ITEM DEFINITIONS**
+{line_item_details}
+
+Your objective is to extract EVERY line item in **LINE ITEM DEFINITIONS** from the policy document. You must follow the guidelines below:
+
+1. For each line item, follow exactly the extraction instructions defined in its `Line item instruction` field within **LINE ITEM DEFINITIONS**
+2. Go through each section in the **POLICY DOCUMENT** throughly and check whether it contains definitions or phrases related to each extraction item, list ALL the evidence that supports your reasoning for each extraction task.
+3. Refer to **POLICY METADATA** for policy-level information and the coverage limits.
+4. (IMPORTANT) In insurance policies, endorsement can modify earlier definitions, if there exists endorsement that modifies the parameters of an extraction item, list ALL the evidence and your reasoning how this endorsement affects the extraction item.
+5. (IMPORTANT) There is NO DEFAULT VALUE for the line item parameters. If you cannot find the values for the parameters, you must leave the parameters as null and DO NOT ASSUME ANY VALUES.
+
+## OUTPUT
+Once you have all the information, call `extract` tool to output result, with one entry in `extractions` for EVERY line item, keyed by its `Line item name`.
+""".strip(
+    "\n "
+)
+
+PREFIX_FIRST_BATCH_EXTRACTION_INSTRUCTION = BATCH_EXTRACTION_INSTRUCTION.replace(
+    "**POLICY DOCUMENT**\n{document_sections}\n\n**POLICY METADATA**\n{policy_metadata}\n\n",
+    "**POLICY METADATA**\n{policy_metadata}\n\n**POLICY DOCUMENT**\n{document_sections}\n\n",
+)
+
+# Start of both prefix-first prompts, up to the line item definitions: identical for every prompt of a
+# document extracting from the same sections.
+PREFIX_FIRST_SHARED_PREFIX = PREFIX_FIRST_EXTRACTION_INSTRUCTION[:PREFIX_FIRST_EXTRACTION_INSTRUCTION.index("**LINE ITEM DEFINITION")]
+
 
 def process_metadata(extractor_results):
     policy_conditions = extractor_results['policy_conditions']
@@ -60,15 +107,559 @@ def process_metadata(extractor_results):
     }
 
 
-def process_item(item_info):
-    """Process a single schema item for a document."""
-    client = openai.OpenAI()
+def render_document_sections(document_sections, section_ids=None):
+    """Section blocks of the document in order, optionally only those in `section_ids`."""
+    ref_sections = []
+    for each_section in document_sections:
+        if section_ids is None or each_section['id'] in section_ids:
+            ref_sections.append(f"==== SECTION ID: {each_section['id']} ====\n{each_section['title']}\n{each_section['text']}\n==== SECTION {each_section['id']} END ====")
+    return ref_sections
+
+
+def build_extract_tool(reasoning_model, think_description, output_name, output_schema):
+    """`extract` tool returning `output_name`, preceded by a `think` property for non-reasoning models."""
+    tool_properties = {}
+    required_fields = []
+    if reasoning_model == 'NO':
+        tool_properties["think"] = {
+            "type": "string",
+            "description": think_description,
+        }
+        required_fields.append("think")
+    tool_properties[output_name] = output_schema
+    required_fields.append(output_name)
+    return {
+        "type": "function",
+        "function": {
+            "name": "extract",
+            "parameters": {
+                "type": "object",
+                "properties": tool_properties,
+                "required": required_fields,
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+class LineItemFragments:
+    """Line item definition blocks and `extract` tools, built once per line item and shared by every document of a run.
+
+    Units share these objects instead of deep copies of the schemas, as nothing modifies `create_params` once built.
+    """
+
+    def __init__(self, instruction_dct, reasoning_model):
+        self.instruction_dct = instruction_dct
+        self.reasoning_model = reasoning_model
+        self._details = {}
+        self._batch_details = {}
+        self._tools = {}
+        self._batch_schemas = {}
+
+    def _schema(self, line_item_name, description):
+        # Only the top level description is replaced, so a shallow copy leaves the instruction intact.
+        return {**self.instruction_dct[line_item_name]['Line item schema'], "description": description}
+
+    def detail(self, line_item_name):
+        """**LINE ITEM DEFINITION** block of a single line item prompt."""
+        if line_item_name not in self._details:
+            instruction = self.instruction_dct[line_item_name]
+            self._details[line_item_name] = json.dumps({
+                "Line item instruction": instruction['Line item instruction'],
+                "Line item schema": instruction['Line item schema'],
+            }, indent=4)
+        return self._details[line_item_name]
+
+    def batch_details(self, line_item_names):
+        """**LINE ITEM DEFINITIONS** block: the indented JSON list of the line items, joined from per line item entries."""
+        for line_item_name in line_item_names:
+            if line_item_name not in self._batch_details:
+                instruction = self.instruction_dct[line_item_name]
+                self._batch_details[line_item_name] = format_array_item({
+                    "Line item name": line_item_name,
+                    "Line item instruction": instruction['Line item instruction'],
+                    "Line item schema": instruction['Line item schema'],
+                })
+        return "[\n" + ",\n".join(self._batch_details[name] for name in line_item_names) + "\n]"
+
+    def tool(self, line_item_name):
+        if line_item_name not in self._tools:
+            self._tools[line_item_name] = build_extract_tool(
+                self.reasoning_model,
+                "Output your detailed thinking process for the extraction task.",
+                "extraction",
+                self._schema(line_item_name, "The extracted object for this line item. If the conclusion in your thinking process is `No evidence found`, output null."),
+            )
+        return self._tools[line_item_name]
+
+    def batch_tool(self, line_item_names):
+        """Combined `extract` tool with one property per line item schema."""
+        for line_item_name in line_item_names:
+            if line_item_name not in self._batch_schemas:
+                self._batch_schemas[line_item_name] = self._schema(
+                    line_item_name,
+                    f"The extracted object for `{line_item_name}`. If the conclusion in your thinking process is `No evidence found`, output null.",
+                )
+        return build_extract_tool(
+            self.reasoning_model,
+            "Output your detailed thinking process for the extraction task of every line item.",
+            "extractions",
+            {
+                "type": "object",
+                "description": "One extracted object per line item, keyed by line item name.",
+                "properties": {name: self._batch_schemas[name] for name in line_item_names},
+                "required": list(line_item_names),
+                "additionalProperties": False,
+            },
+        )
+
+
+class DocumentPromptBuilder:
+    """Extraction prompts of one document, assembled from fragments rendered once.
+
+    Every section block, the policy metadata block and the whole document block are rendered once
+    per document, and every prompt joins them with the line item blocks of the run's `LineItemFragments`.
+    With `prefix_first`, samples carry the `prefix_key` of their shared prefix (see `shared_prefix_key`).
+    """
+
+    def __init__(self, doc_name, document_sections, policy_metadata_block, fragments, prefix_first=False):
+        self.doc_name = doc_name
+        self.policy_metadata_block = policy_metadata_block
+        self.fragments = fragments
+        self.prefix_first = prefix_first
+        self._prefix_keys = {}
+        with telemetry.phase("build_prompts"):
+            self.section_blocks = list(zip(
+                [each_section['id'] for each_section in document_sections],
+                render_document_sections(document_sections),
+            ))
+        with telemetry.phase("tokenize"):
+            self.section_tokens = {section_id: estimate_tokens(block) for section_id, block in self.section_blocks}
+        self._full_document = None
+
+    def document_block(self, section_ids=None):
+        """**POLICY DOCUMENT** block of the sections in `section_ids` (default: all of them), in document order."""
+        if section_ids is None or self.section_tokens.keys() <= section_ids:
+            if self._full_document is None:
+                self._full_document = "\n\n".join(block for _, block in self.section_blocks)
+            return self._full_document
+        return "\n\n".join(block for section_id, block in self.section_blocks if section_id in section_ids)
+
+    def shared_prefix_key(self, document_sections):
+        """`prefix_key` of the prefix-first prompts over the `document_sections` block, if long enough to be cached.
+
+        The prompts of all line items extracted from the same sections, e.g. every full document prompt, share
+        this prefix. It is counted with `estimate_tokens` once per distinct block.
+        """
+        if not self.prefix_first:
+            return None
+        shared_prefix = PREFIX_FIRST_SHARED_PREFIX.format(
+            document_sections=document_sections,
+            policy_metadata=self.policy_metadata_block,
+        )
+        key = prefix_key(shared_prefix)
+        if key not in self._prefix_keys:
+            with telemetry.phase("tokenize"):
+                is_cacheable = estimate_tokens(shared_prefix) >= MIN_CACHEABLE_PREFIX_TOKENS
+            self._prefix_keys[key] = key if is_cacheable else None
+        return self._prefix_keys[key]
+
+    def choose_context(self, relevant_section_ids, context_mode, full_context_ratio=0.8):
+        """Ids of the sections to extract from, and whether they are the `retrieved` sections or the `full` document.
+
+        `adaptive` uses the full document when the retrieved sections hold at least `full_context_ratio`
+        of its estimated tokens, since retrieval then saves little. Every mode falls back to the full
+        document when retrieval found no relevant section.
+        """
+        if context_mode != 'full':
+            section_ids = {section_id for section_id in relevant_section_ids if section_id in self.section_tokens}
+            retrieved_tokens = sum(self.section_tokens[section_id] for section_id in section_ids)
+            if len(section_ids) > 0 and (
+                context_mode == 'retrieved' or retrieved_tokens < full_context_ratio * sum(self.section_tokens.values())
+            ):
+                return section_ids, 'retrieved'
+        return set(self.section_tokens), 'full'
+
+    def sample(self, line_item_name, section_ids, context_mode, ground_truth=None):
+        """Sample asking for `line_item_name` over the sections in `section_ids`."""
+        instruction_template = PREFIX_FIRST_EXTRACTION_INSTRUCTION if self.prefix_first else EXTRACTION_INSTRUCTION
+        with telemetry.phase("build_prompts"):
+            document_sections = self.document_block(section_ids)
+            prompt = instruction_template.format(
+                document_sections=document_sections,
+                policy_metadata=self.policy_metadata_block,
+                line_item_detail=self.fragments.detail(line_item_name),
+            )
+            tool = self.fragments.tool(line_item_name)
+        return build_extraction_sample(
+            self.doc_name,
+            line_item_name,
+            prompt,
+            tool,
+            self.fragments.reasoning_model,
+            ground_truth=ground_truth,
+            prefix_key=self.shared_prefix_key(document_sections),
+            context_mode=context_mode,
+        )
+
+    def batch_sample(self, batch_idx, line_item_names, section_ids, context_mode, ground_truths=None):
+        """One sample asking for all of `line_item_names` over the sections in `section_ids`."""
+        instruction_template = PREFIX_FIRST_BATCH_EXTRACTION_INSTRUCTION if self.prefix_first else BATCH_EXTRACTION_INSTRUCTION
+        with telemetry.phase("build_prompts"):
+            document_sections = self.document_block(section_ids)
+            prompt = instruction_template.format(
+                document_sections=document_sections,
+                policy_metadata=self.policy_metadata_block,
+                line_item_details=self.fragments.batch_details(line_item_names),
+            )
+            tool = self.fragments.batch_tool(line_item_names)
+        return build_batch_extraction_sample(
+            self.doc_name,
+            batch_idx,
+            line_item_names,
+            prompt,
+            tool,
+            self.fragments.reasoning_model,
+            ground_truths=ground_truths,
+            prefix_key=self.shared_prefix_key(document_sections),
+            context_mode=context_mode,
+        )
+
+
+def build_extraction_sample(
+    doc_name,
+    line_item_name,
+    prompt,
+    tool,
+    reasoning_model,
+    ground_truth=None,
+    prefix_key=None,
+    context_mode='retrieved',
+):
+    """Sample with the prompt and `extract` tool asking for `line_item_name`, see `DocumentPromptBuilder.sample`."""
+    temperature = 0.0 if reasoning_model == 'NO' else 0.6
+    max_tokens = 10000 if reasoning_model == 'NO' else 32000
+    return {
+        "doc_name": doc_name,
+        "line_item_name": line_item_name,
+        "context_mode": context_mode,
+        "prefix_key": prefix_key,
+        "ground_truth": ground_truth,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ],
+        "temperature": temperature,
+        "tools": [tool],
+        "max_tokens": max_tokens,
+    }
+
+
+def cluster_line_items(item_section_ids, section_tokens, items_per_call, max_union_tokens, min_overlap=0.5):
+    """Group line items whose context sections overlap, to extract each group in one call.
+
+    Greedy: the line item with the largest context seeds a group, then the line item with the
+    highest Jaccard overlap with the group's union of sections joins it, as long as that overlap
+    is at least `min_overlap`, the group holds fewer than `items_per_call` line items and the union
+    stays within `max_union_tokens`. Returns the groups, each in the order of `item_section_ids`.
+    """
+    order = {item_name: i for i, item_name in enumerate(item_section_ids)}
+
+    def union_tokens(section_ids):
+        return sum(section_tokens.get(section_id, 0) for section_id in section_ids)
+
+    remaining = list(item_section_ids)
+    clusters = []
+    while remaining:
+        seed = max(remaining, key=lambda item_name: (union_tokens(item_section_ids[item_name]), -order[item_name]))
+        remaining.remove(seed)
+        cluster = [seed]
+        union = set(item_section_ids[seed])
+        while len(cluster) < items_per_call:
+            best_item, best_overlap = None, min_overlap
+            for item_name in remaining:
+                section_ids = item_section_ids[item_name]
+                overlap = len(union & section_ids) / max(1, len(union | section_ids))
+                if overlap >= best_overlap and union_tokens(union | section_ids) <= max_union_tokens:
+                    if best_item is None or overlap > best_overlap:
+                        best_item, best_overlap = item_name, overlap
+            if best_item is None:
+                break
+            remaining.remove(best_item)
+            cluster.append(best_item)
+            union |= item_section_ids[best_item]
+        clusters.append(sorted(cluster, key=order.get))
+    return sorted(clusters, key=lambda cluster: order[cluster[0]])
+
+
+def build_batch_extraction_sample(
+    doc_name,
+    batch_idx,
+    line_item_names,
+    prompt,
+    tool,
+    reasoning_model,
+    ground_truths=None,
+    prefix_key=None,
+    context_mode='retrieved',
+):
+    """Sample with one prompt and combined `extract` tool asking for all of `line_item_names`."""
+    temperature = 0.0 if reasoning_model == 'NO' else 0.6
+    max_tokens = min(10000 * len(line_item_names), 32000) if reasoning_model == 'NO' else 32000
+    return {
+        "doc_name": doc_name,
+        "batch_idx": batch_idx,
+        "line_item_names": list(line_item_names),
+        "context_mode": context_mode,
+        "prefix_key": prefix_key,
+        "ground_truths": ground_truths or {},
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ],
+        "temperature": temperature,
+        "tools": [tool],
+        "max_tokens": max_tokens,
+    }
+
+
+def build_extraction_unit(each_sample, model_name):
+    create_params = {
+        "messages": each_sample['messages'],
+        "tools": each_sample['tools'],
+        "max_tokens": each_sample['max_tokens'],
+        "temperature": each_sample['temperature'],
+        "model": model_name,
+    }
+    if 'line_item_names' in each_sample:
+        each_unit = {
+            "unit_id": f"{each_sample['doc_name']}::batch::{each_sample['batch_idx']}",
+            "doc_name": each_sample['doc_name'],
+            "line_item_names": each_sample['line_item_names'],
+            "context_mode": each_sample['context_mode'],
+            'create_params': create_params,
+            "ground_truths": each_sample['ground_truths'],
+            "record_ids": [f"{each_sample['doc_name']}::{line_item_name}" for line_item_name in each_sample['line_item_names']],
+        }
+        if each_sample.get('prefix_key') is not None:
+            each_unit['prefix_key'] = each_sample['prefix_key']
+        return each_unit
+    each_unit = {
+        "unit_id": f"{each_sample['doc_name']}::{each_sample['line_item_name']}",
+        "doc_name": each_sample['doc_name'],
+        "line_item_name": each_sample['line_item_name'],
+        "context_mode": each_sample['context_mode'],
+        'create_params': create_params,
+    }
+    if 'ground_truth' in each_sample:
+        each_unit['ground_truth'] = each_sample['ground_truth']
+    if each_sample.get('prefix_key') is not None:
+        each_unit['prefix_key'] = each_sample['prefix_key']
+    return each_unit
+
+
+def split_batched_extraction(each_unit):
+    """Split a multi line item unit into one record per line item, shaped like single line item units."""
+    extractions = {}
+    if each_unit['result'] is not None:
+        try:
+            extractions = dict(each_unit['result']['extractions'])
+        except Exception as e:
+            print(f"Extraction Error: {each_unit['doc_name']} - batch {each_unit['unit_id']} - {e}")
+    records = []
+    for line_item_name in each_unit['line_item_names']:
+        record = {
+            "unit_id": f"{each_unit['doc_name']}::{line_item_name}",
+            "batch_unit_id": each_unit['unit_id'],
+            "batch_size": len(each_unit['line_item_names']),
+            "doc_name": each_unit['doc_name'],
+            "line_item_name": line_item_name,
+            "context_mode": each_unit['context_mode'],
+            "create_params": each_unit['create_params'],
+            "ground_truth": each_unit['ground_truths'].get(line_item_name),
+            "latency_seconds": each_unit.get('latency_seconds'),
+            "response": each_unit['response'],
+            "result": None,
+            "reasoning": None,
+        }
+        if line_item_name in extractions:
+            record['result'] = {}
+            if each_unit['reasoning'] is not None:
+                record['result']['think'] = each_unit['reasoning']
+            record['result']['extraction'] = extractions[line_item_name]
+            record['reasoning'] = each_unit['reasoning']
+        elif each_unit['result'] is not None:
+            print(f"Extraction Error: {each_unit['doc_name']} - {line_item_name} - missing from batched output")
+        records.append(record)
+    return records
+
+
+def parse_extraction_response(each_unit, response):
+    """Attach the response and parsed tool call to the unit; returns its per line item checkpoint records."""
+    each_unit['response'] = response
     try:
-        response = client.chat.completions.create(**item_info['create_params'])
-        return response.model_dump()
+        with telemetry.phase("parse_tool_calls"):
+            each_unit['result'] = json.loads(response['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
+        if 'think' in each_unit['result']:
+            each_unit['reasoning'] = each_unit['result']['think']
+        else:
+            each_unit['reasoning'] = None
     except Exception as e:
-        print(f"API Error: {item_info['doc_name']} - {item_info['item_name']} - {e}")
-        return None
+        each_unit['result'] = None
+        each_unit['reasoning'] = None
+        print(f"Extraction Error: {each_unit['doc_name']} - {each_unit.get('line_item_name', each_unit.get('line_item_names'))} - {e}")
+    if 'line_item_names' in each_unit:
+        return split_batched_extraction(each_unit)
+    return [each_unit]
+
+
+class ContextModeReport:
+    """Calls, prompt tokens and latency of the extraction units per context mode."""
+
+    def __init__(self):
+        self.per_mode = {}
+
+    def add(self, record):
+        mode_stats = self.per_mode.setdefault(
+            record.get('context_mode', 'retrieved'), {"calls": 0, "prompt_tokens": 0, "latencies": []}
+        )
+        # Line items extracted together share the prompt tokens of their call.
+        mode_stats['calls'] += 1 / record.get('batch_size', 1)
+        mode_stats['prompt_tokens'] += get_cached_tokens(record['response'])[0] / record.get('batch_size', 1)
+        if record.get('latency_seconds') is not None:
+            mode_stats['latencies'].append(record['latency_seconds'])
+
+    def print_summary(self):
+        print("Context mode report (extraction):")
+        for context_mode, mode_stats in sorted(self.per_mode.items()):
+            latencies = sorted(mode_stats['latencies'])
+            latency = f"p50 {percentile(latencies, 50):.2f}s, p95 {percentile(latencies, 95):.2f}s" if latencies else "n/a"
+            print(f"  {context_mode}: calls {mode_stats['calls']:.0f}, prompt tokens {mode_stats['prompt_tokens']:.0f} ({mode_stats['prompt_tokens'] / max(1, mode_stats['calls']):.0f}/call), latency {latency}")
+
+
+def collect_extraction_records(checkpoint, unit_ids, extraction_results, context_mode_report=None):
+    for record in checkpoint.iter_records(unit_ids):
+        if context_mode_report is not None:
+            context_mode_report.add(record)
+        extraction_results[record['doc_name']][record['line_item_name']] = {
+            "reasoning": record['reasoning'],
+            "result": record['result'],
+        }
+        yield record
+
+
+def iter_extraction_units(docs, line_items, instruction_dct, retrieval_results, manifest, is_pending, args, store=None, counts=None):
+    """Yield the extraction units of every document whose records are pending, one document at a time.
+
+    Only one document's sections and prompt fragments are held at once, and units are built as the
+    dispatcher consumes them. Every (document, line item) unit is fingerprinted into `manifest` before
+    `is_pending(record_ids)` is asked. `counts` (a Counter) collects line items, calls, full context
+    line items and calls skipped as not pending.
+    """
+    if counts is None:
+        counts = Counter()
+    fragments = LineItemFragments(instruction_dct, args.reasoning_model)
+    for doc_name in docs:
+        with telemetry.phase("load_documents"):
+            document = open_document(doc_name, store)
+            extraction_input = document.metadata
+        try:
+            relevant_sections_per_line_item = {}
+            if retrieval_results is not None:
+                for line_item_name, item_info in retrieval_results.get(doc_name, {}).items():
+                    relevant_sections_per_line_item[line_item_name] = item_info['relevant_sections']
+            else:
+                for each_line_item_result in extraction_input['results']:
+                    line_item_name = each_line_item_result['retrieval_result']['line_item_name']
+                    relevant_sections_per_line_item[line_item_name] = each_line_item_result['retrieval_result']['relevant_sections']
+            with telemetry.phase("load_documents"):
+                document_sections = None
+                if args.context_mode == 'retrieved':
+                    # Only the retrieved sections are read, unless a line item falls back to the full document.
+                    retrieved_ids = set()
+                    for line_item_name in line_items:
+                        retrieved_ids.update(relevant_sections_per_line_item.get(line_item_name, []))
+                    document_sections = list(document.iter_sections(retrieved_ids))
+                    loaded_ids = {each_section['id'] for each_section in document_sections}
+                    if any(loaded_ids.isdisjoint(relevant_sections_per_line_item.get(line_item_name, [])) for line_item_name in line_items):
+                        document_sections = None
+                if document_sections is None:
+                    document_sections = list(document.iter_sections())
+
+            policy_metadata_block = json.dumps(process_metadata(extraction_input), indent=4)
+            builder = DocumentPromptBuilder(
+                doc_name,
+                document_sections,
+                policy_metadata_block,
+                fragments,
+                prefix_first=args.prompt_cache_warmup,
+            )
+            manifest.documents[doc_name] = fingerprint(document.fingerprint(), policy_metadata_block)
+            for line_item_name in line_items:
+                manifest.add_unit(
+                    doc_name,
+                    line_item_name,
+                    sorted(relevant_sections_per_line_item.get(line_item_name, [])),
+                    document.ground_truth(line_item_name),
+                )
+
+            item_contexts = {}
+            with telemetry.phase("route_context"):
+                for line_item_name in line_items:
+                    context_section_ids, context_mode = builder.choose_context(
+                        relevant_sections_per_line_item.get(line_item_name, []), args.context_mode, args.full_context_ratio
+                    )
+                    if context_mode == 'full' and args.context_mode == 'retrieved':
+                        print(f"No relevant sections retrieved for {doc_name} - {line_item_name}, extracting from the full document")
+                    item_contexts[line_item_name] = (context_section_ids, context_mode)
+
+                clusters = [[line_item_name] for line_item_name in line_items]
+                if args.items_per_call > 1:
+                    # Only line items extracted from the same kind of context are grouped together.
+                    clusters = []
+                    for context_mode in ['retrieved', 'full']:
+                        clusters.extend(cluster_line_items(
+                            {name: ids for name, (ids, mode) in item_contexts.items() if mode == context_mode},
+                            builder.section_tokens,
+                            args.items_per_call,
+                            args.max_union_tokens,
+                            args.min_section_overlap,
+                        ))
+            for batch_idx, line_item_names in enumerate(clusters):
+                context_mode = item_contexts[line_item_names[0]][1]
+                counts['line_items'] += len(line_item_names)
+                counts['calls'] += 1
+                if context_mode == 'full':
+                    counts['full_context'] += len(line_item_names)
+                if not is_pending([f"{doc_name}::{line_item_name}" for line_item_name in line_item_names]):
+                    counts['skipped_calls'] += 1
+                    continue
+                if len(line_item_names) == 1:
+                    line_item_name = line_item_names[0]
+                    each_sample = builder.sample(
+                        line_item_name,
+                        item_contexts[line_item_name][0],
+                        context_mode,
+                        ground_truth=document.ground_truth(line_item_name),
+                    )
+                else:
+                    union_section_ids = set()
+                    for line_item_name in line_item_names:
+                        union_section_ids |= item_contexts[line_item_name][0]
+                    each_sample = builder.batch_sample(
+                        batch_idx,
+                        line_item_names,
+                        union_section_ids,
+                        context_mode,
+                        ground_truths={name: document.ground_truth(name) for name in line_item_names},
+                    )
+                yield build_extraction_unit(each_sample, args.model_name)
+        finally:
+            document.close()
 
 
 def main():
@@ -80,6 +671,13 @@ def main():
         required=False,
         help="Test run"
     )
+    parser.add_argument(
+        "--docs",
+        type=str,
+        default=None,
+        required=False,
+        help="Comma separated document names to run on instead of the default documents, e.g. a synthetic corpus"
+    )
     parser.add_argument(
         "--model-name",
         type=str,
@@ -99,10 +697,188 @@ def main():
         type=int,
         default=16,
         required=False,
-        help="Number of jobs"
+        help="Maximum number of in-flight API requests"
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Requests per minute budget (0 for no limit)"
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=0,
+        required=False,
+        help="Tokens per minute budget (0 for no limit)"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=6,
+        required=False,
+        help="Retries per request on rate limits and transient API errors"
+    )
+    parser.add_argument(
+        "--cache-mode",
+        choices=['readwrite', 'readonly', 'refresh', 'off'],
+        default='readwrite',
+        required=False,
+        help="Response cache mode: readwrite, readonly (never write), refresh (ignore hits, overwrite) or off"
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default="processed_data/response_cache.sqlite",
+        required=False,
+        help="Path of the SQLite response cache"
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=1024,
+        required=False,
+        help="Size bound of the response cache in MB, least recently used entries are evicted first"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the JSONL checkpoint of an interrupted run, skipping units already completed"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rerun the (document, line item) units whose document, retrieved sections, instruction or run config changed since the last run, keeping the others from its checkpoint"
+    )
+    parser.add_argument(
+        "--log-format",
+        type=str,
+        default="json",
+        choices=['json', 'compact'],
+        required=False,
+        help="Log format: json writes one indented JSON array, compact writes a directory (..._log_<model>_compact/) that stores each distinct prompt block once and compresses responses"
+    )
+    parser.add_argument(
+        "--doc-store",
+        type=str,
+        default="",
+        required=False,
+        help="Directory of the indexed document store, converted from raw_data on first use (empty: read the raw JSON files)"
+    )
+    parser.add_argument(
+        "--retrieval-result",
+        type=str,
+        default="",
+        required=False,
+        help="Step 3 result JSON to take the relevant sections from (empty: the retrieval results in raw_data/outputs)"
+    )
+    parser.add_argument(
+        "--context-mode",
+        choices=['retrieved', 'full', 'adaptive'],
+        default='retrieved',
+        required=False,
+        help="Extraction context: the retrieved sections, the full document, or adaptive (full document when retrieval saves little or found nothing)"
+    )
+    parser.add_argument(
+        "--full-context-ratio",
+        type=float,
+        default=0.8,
+        required=False,
+        help="Adaptive mode uses the full document when the retrieved sections hold at least this fraction of its tokens"
+    )
+    parser.add_argument(
+        "--items-per-call",
+        type=int,
+        default=1,
+        required=False,
+        help="Maximum number of line items of a document extracted in one call over the union of their sections"
+    )
+    parser.add_argument(
+        "--max-union-tokens",
+        type=int,
+        default=16000,
+        required=False,
+        help="Token cap of the union of sections sent in a multi line item call"
+    )
+    parser.add_argument(
+        "--min-section-overlap",
+        type=float,
+        default=0.5,
+        required=False,
+        help="Minimum Jaccard overlap of retrieved section ids for line items to share a call"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=['online', 'batch', 'queue'],
+        default='online',
+        required=False,
+        help="online: interactive chat.completions calls, batch: submit all units through a Batch API backend, queue: enqueue all units into a work queue answered by queue_worker.py processes"
+    )
+    parser.add_argument(
+        "--batch-backend",
+        choices=['openai', 'local'],
+        default='openai',
+        required=False,
+        help="Batch backend: the OpenAI Batch API or a local file-based stand-in answering with mock responses"
+    )
+    parser.add_argument(
+        "--batch-dir",
+        type=str,
+        default="processed_data/batches",
+        required=False,
+        help="Directory of the batch request files and submitted batch ids"
+    )
+    parser.add_argument(
+        "--batch-poll-seconds",
+        type=float,
+        default=60,
+        required=False,
+        help="Seconds between two batch status polls"
+    )
+    parser.add_argument(
+        "--queue-backend",
+        choices=QUEUE_BACKENDS,
+        default='sqlite',
+        required=False,
+        help="Work queue backend of --mode queue"
+    )
+    parser.add_argument(
+        "--queue-path",
+        type=str,
+        default="processed_data/work_queue.sqlite",
+        required=False,
+        help="Path of the work queue, shared with the workers (e.g. on a shared volume)"
+    )
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        required=False,
+        help="Number of queue_worker.py processes to start on this host, each with --n-jobs requests in flight and a share of --rpm/--tpm (0: only workers started separately)"
+    )
+    parser.add_argument(
+        "--queue-poll-seconds",
+        type=float,
+        default=1.0,
+        required=False,
+        help="Seconds between two polls of the work queue for completed units"
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=256,
+        required=False,
+        help="Number of units built ahead of the in-flight requests; largest prompts go first within this window (0: build every unit up front)"
+    )
+    parser.add_argument(
+        "--prompt-cache-warmup",
+        action="store_true",
+        help="Put the per-document blocks first in the prompt and send one warm-up call per document before its other line items"
     )
     
     args = parser.parse_args()
+    telemetry.start_run("step_4_extraction")
     
     docs = [
         "adventis",
@@ -120,6 +896,8 @@ def main():
         "standard_biotools",
         "sylabs",
     ]
+    if args.docs:
+        docs = args.docs.split(",")
     if args.test_run:
         docs = docs[:1]
     
@@ -132,157 +910,127 @@ def main():
     if args.test_run:
         print(f"This is a dry run. Only processing the first document and line item. {docs[0]} {line_items[0]}")
 
-    full_doc_samples = []
-    retrieved_doc_samples = []
-    for doc_name in docs:
-        with open(f"raw_data/ground_truths/{doc_name}.json", "r") as f:
-            gt = json.load(f)
-        with open(f"raw_data/outputs/{doc_name}.json", "r") as f:
-            extraction_input = json.load(f)
-        relevant_sections_per_line_item = {}
-        for each_line_item_result in extraction_input['results']:
-            line_item_name = each_line_item_result['retrieval_result']['line_item_name']
-            relevant_sections_per_line_item[line_item_name] = each_line_item_result['retrieval_result']['relevant_sections']
-
-        policy_metadata = process_metadata(extraction_input)
-
-        for line_item_name in line_items:
-            ground_truth = gt['synthesizer_result'][line_item_name]
-            ref_sections_full_doc = []
-            ref_sections_retrieved = []
-            for each_section in extraction_input['chunker_result']['document_sections']:
-                content = f"==== SECTION ID: {each_section['id']} ====\n{each_section['title']}\n{each_section['text']}\n==== SECTION {each_section['id']} END ===="
-                ref_sections_full_doc.append(content)
-                if each_section['id'] in relevant_sections_per_line_item[line_item_name]:
-                    ref_sections_retrieved.append(content)
-            assert len(ref_sections_full_doc) > 0 and len(ref_sections_retrieved) > 0
-            ref_content_full_doc = "\n\n".join(ref_sections_full_doc)
-            ref_content_retrieved = "\n\n".join(ref_sections_retrieved)
-            line_item_detail = {
-                "Line item instruction": instruction_dct[line_item_name]['Line item instruction'],
-                "Line item schema": instruction_dct[line_item_name]['Line item schema'],
-            }
-            prompt_full_doc = EXTRACTION_INSTRUCTION.format(
-                document_sections=ref_content_full_doc,
-                policy_metadata=json.dumps(policy_metadata, indent=4),
-                line_item_detail=json.dumps(line_item_detail, indent=4)
-            )
-            prompt_retrieved = EXTRACTION_INSTRUCTION.format(
-                document_sections=ref_content_retrieved,
-                policy_metadata=json.dumps(policy_metadata, indent=4),
-                line_item_detail=json.dumps(line_item_detail, indent=4)
-            )
-            this_extraction_obj = deepcopy(instruction_dct[line_item_name]['Line item schema'])
-            this_extraction_obj["description"] = "The extracted object for this line item. If the conclusion in your thinking process is `No evidence found`, output null."
-            
-            # Build tool properties based on reasoning flags
-            tool_properties = {}
-            required_fields = []
-            if args.reasoning_model == 'NO':
-                tool_properties["think"] = {
-                    "type": "string",
-                    "description": "Output your detailed thinking process for the extraction task.",
-                }
-                required_fields.append("think")
-            tool_properties["extraction"] = this_extraction_obj
-            required_fields.append("extraction")
-            this_tool = {
-                "type": "function",
-                "function": {
-                    "name": "extract",
-                    "parameters": {
-                        "type": "object",
-                        "properties": tool_properties,
-                        "required": required_fields,
-                        "additionalProperties": False,
-                    },
-                },
-            }
-            temperature = 0.0 if args.reasoning_model == 'NO' else 0.6
-            max_tokens = 10000 if args.reasoning_model == 'NO' else 32000
-            full_doc_samples.append({
-                "doc_name": doc_name,
-                "line_item_name": line_item_name,
-                "ground_truth": ground_truth,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt_full_doc,
-                    },
-                ],
-                "temperature": temperature,
-                "tools": [this_tool],
-                "max_tokens": max_tokens,
-            })
-            retrieved_doc_samples.append({
-                "doc_name": doc_name,
-                "line_item_name": line_item_name,
-                "ground_truth": ground_truth,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt_retrieved,
-                    },
-                ],
-                "temperature": temperature,
-                "tools": [this_tool],
-                "max_tokens": max_tokens,
-            })
-
-    print(f"Number of doc samples: {len(full_doc_samples)}")
-
-    # with open(f"processed_data/step_4_extraction_prompt_full_doc_reasoning_model_{args.reasoning_model}_tryrun_{args.test_run}.json", "w") as f:
-    #     json.dump(full_doc_samples, f, indent=4)
-    # with open(f"processed_data/step_4_extraction_prompt_retrieved_doc_reasoning_model_{args.reasoning_model}_tryrun_{args.test_run}.json", "w") as f:
-    #     json.dump(retrieved_doc_samples, f, indent=4)
-
-
-    print(f"Running model generation...")
+    retrieval_results = None
+    if args.retrieval_result:
+        with open(args.retrieval_result, "r") as f:
+            retrieval_results = json.load(f)
+
+    manifest = Manifest(fingerprint(
+        EXTRACTION_INSTRUCTION,
+        BATCH_EXTRACTION_INSTRUCTION,
+        args.model_name,
+        args.reasoning_model,
+        args.context_mode,
+        args.full_context_ratio,
+        args.items_per_call,
+        args.max_union_tokens,
+        args.min_section_overlap,
+        args.prompt_cache_warmup,
+    ))
+    for line_item_name in line_items:
+        manifest.line_items[line_item_name] = fingerprint(instruction_dct[line_item_name])
+
+    store = DocumentStore(args.doc_store) if args.doc_store else None
+    if store is not None:
+        print(f"Document store: converted {store.build(docs)} of {len(docs)} documents")
+
+    print("Running model generation...")
     extraction_results = {doc_name: {} for doc_name in docs}
-    processing_units = []
-    for each_sample in retrieved_doc_samples:
-        create_params = {
-            "messages": each_sample['messages'],
-            "tools": each_sample['tools'],
-            "max_tokens": each_sample['max_tokens'],
-            "temperature": each_sample['temperature'],
-            "model": args.model_name,
-        }
-        each_unit = {
-            "doc_name": each_sample['doc_name'],
-            "line_item_name": each_sample['line_item_name'],
-            'create_params': create_params,
-        }
-        if 'ground_truth' in each_sample:
-            each_unit['ground_truth'] = each_sample['ground_truth']
-        processing_units.append(each_unit)
 
-    results = Parallel(n_jobs=args.n_jobs)(
-        delayed(process_item)(item_info)
-        for item_info in tqdm(processing_units)
+    # Other context modes get their own files, so that their runs can be evaluated side by side.
+    output_suffix = args.model_name if args.context_mode == 'retrieved' else f"{args.model_name}_{args.context_mode}"
+    manifest_path = f"processed_data/step_4_extraction_manifest_{output_suffix}.json"
+    checkpoint = Checkpoint(
+        f"processed_data/step_4_extraction_checkpoint_{output_suffix}.jsonl",
+        resume=args.resume or args.incremental,
     )
-    print(f"\n\nGathering results...")
-    for i, each_unit in enumerate(processing_units):
-        each_unit['response'] = results[i]
-        try:
-            each_unit['result'] = json.loads(results[i]['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
-            if 'think' in each_unit['result']:
-                each_unit['reasoning'] = each_unit['result']['think']
-            else:
-                each_unit['reasoning'] = None
-        except Exception as e:
-            each_unit['result'] = None
-            each_unit['reasoning'] = None
-            print(f"Extraction Error: {each_unit['doc_name']} - {each_unit['line_item_name']} - {e}")
-        extraction_results[each_unit['doc_name']][each_unit['line_item_name']] = {
-            "reasoning": each_unit['reasoning'],
-            "result": each_unit['result'],
-        }
+    unit_ids = [f"{doc_name}::{line_item_name}" for doc_name in docs for line_item_name in line_items]
+    completed_ids = checkpoint.completed_ids()
+    previous_manifest = Manifest.load(manifest_path) if args.incremental else None
+
+    def is_pending(record_ids):
+        # Changed units are rerun incrementally; their newer records supersede the stale ones.
+        return not all(
+            record_id in completed_ids and not (args.incremental and manifest.is_changed(record_id, previous_manifest))
+            for record_id in record_ids
+        )
+
+    unit_counts = Counter()
+    pending_units = iter_extraction_units(
+        docs, line_items, instruction_dct, retrieval_results, manifest, is_pending, args, store, unit_counts
+    )
+
+    cache_report = CachedTokenReport("extraction")
+
+    def on_result(each_unit, response):
+        cache_report.add(each_unit['doc_name'], response)
+        telemetry.observe_unit("extraction", each_unit, response)
+        records = parse_extraction_response(each_unit, response)
+        with telemetry.phase("checkpoint"):
+            for record in records:
+                checkpoint.append(record)
+
+    with telemetry.phase("dispatch"):
+        if args.mode == 'batch':
+            # Batch request files hold every pending unit, so they are all built up front.
+            run_batch(
+                list(pending_units),
+                get_batch_backend(args.batch_backend, args.batch_dir),
+                f"{args.batch_dir}/step_4_extraction_{output_suffix}",
+                on_result,
+                poll_seconds=args.batch_poll_seconds,
+                cache_path=args.cache_path,
+                cache_mode=args.cache_mode,
+                cache_max_mb=args.cache_max_mb,
+            )
+        elif args.mode == 'queue':
+            work_queue = get_work_queue(args.queue_backend, args.queue_path)
+            run_queue(
+                pending_units,
+                work_queue,
+                f"step_4_extraction_{output_suffix}",
+                on_result,
+                poll_seconds=args.queue_poll_seconds,
+                local_workers=args.local_workers,
+                worker_args=local_worker_args(args),
+            )
+            work_queue.disconnect()
+        else:
+            telemetry.add_stats(run_units(
+                pending_units,
+                args.n_jobs,
+                on_result,
+                rpm=args.rpm,
+                tpm=args.tpm,
+                max_retries=args.max_retries,
+                cache_path=args.cache_path,
+                cache_mode=args.cache_mode,
+                cache_max_mb=args.cache_max_mb,
+                warmup=args.prompt_cache_warmup,
+                lookahead=args.lookahead or None,
+            ))
+    print(f"Number of doc samples: {unit_counts['line_items']} ({unit_counts['full_context']} with full document context, context mode {args.context_mode}) in {unit_counts['calls']} calls")
+    if args.incremental:
+        print(f"Incremental: {manifest.describe_changes(previous_manifest, manifest.changed_units(previous_manifest))}")
+    if args.resume or args.incremental:
+        print(f"{'Incremental' if args.incremental else 'Resuming'}: skipped {unit_counts['skipped_calls']} units already in checkpoint, ran {unit_counts['calls'] - unit_counts['skipped_calls']}")
+    cache_report.print_summary()
+    print("\n\nGathering results...")
 
-    with open(f"processed_data/step_4_extraction_result_{args.model_name}.json", "w") as f:
-        json.dump(extraction_results, f, indent=4)
-    with open(f"processed_data/step_4_extraction_log_{args.model_name}.json", "w") as f:
-        json.dump(processing_units, f, indent=4)
+    context_mode_report = ContextModeReport()
+    with telemetry.phase("write_log"):
+        write_log(
+            f"processed_data/step_4_extraction_log_{output_suffix}",
+            collect_extraction_records(checkpoint, unit_ids, extraction_results, context_mode_report),
+            args.log_format,
+        )
+    checkpoint.close()
+    context_mode_report.print_summary()
+    with telemetry.phase("write_result"):
+        with open(f"processed_data/step_4_extraction_result_{output_suffix}.json", "w") as f:
+            json.dump(extraction_results, f, indent=4)
+    manifest.save(manifest_path)
+    telemetry.get_telemetry().write(f"processed_data/step_4_extraction_run_report_{output_suffix}.json")
 
 
 
@@ -1,8 +1,16 @@
 import json
 import argparse
-from typing import Any, Dict, List, Optional
-from copy import deepcopy
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from checkpoint import format_array_item, write_json_array
+from run_log import iter_log_records, log_output_prefix
+import telemetry
+
+
+RECORD_COLUMNS = ["doc_name", "line_item_name", "context_mode", "is_correct", "wrong_prediction_type", "prompt_tokens", "latency_seconds"]
+FIELD_COLUMNS = ["doc_name", "line_item_name", "field", "tp", "fp", "fn"]
 
 
 def maybe_clean_prediction_of_empty(
@@ -11,14 +19,173 @@ def maybe_clean_prediction_of_empty(
     if not isinstance(prediction, dict) or not isinstance(ground_truth, dict):
         return prediction
 
-    clean_prediction = deepcopy(prediction)
-    for key in prediction:
-        prediction_is_empty = prediction[key] == None or prediction[key] == ""
-        ground_truth_is_empty = key not in ground_truth
-        if prediction_is_empty and ground_truth_is_empty:
-            clean_prediction.pop(key)
+    # Only top level keys are dropped, so a shallow copy is enough.
+    return {
+        key: value for key, value in prediction.items()
+        if not ((value == None or value == "") and key not in ground_truth)
+    }
+
+
+def normalize_leaf(value: Any) -> Any:
+    """Comparable form of a scalar: numbers as floats, strings trimmed and case folded."""
+    if isinstance(value, bool):
+        return ("bool", value)
+    if isinstance(value, (int, float)):
+        return ("number", float(value))
+    if isinstance(value, str):
+        return ("string", " ".join(value.split()).casefold())
+    return ("other", json.dumps(value, sort_keys=True))
+
+
+def flatten_fields(value: Any, prefix: str = "") -> Dict[str, Any]:
+    """Normalized leaves of a nested extraction keyed by dotted path; empty values (None, "") are left out.
+
+    Lists of scalars are compared as a whole, ignoring order; lists of objects field by field by index.
+    """
+    if value is None or value == "":
+        return {}
+    if isinstance(value, dict):
+        fields = {}
+        for key, item in value.items():
+            fields.update(flatten_fields(item, f"{prefix}.{key}" if prefix else key))
+        return fields
+    if isinstance(value, list):
+        if all(not isinstance(item, (dict, list)) for item in value):
+            leaves = sorted(repr(normalize_leaf(item)) for item in value if item is not None and item != "")
+            return {prefix or "(value)": ("list", tuple(leaves))} if leaves else {}
+        fields = {}
+        for idx, item in enumerate(value):
+            fields.update(flatten_fields(item, f"{prefix}[{idx}]"))
+        return fields
+    return {prefix or "(value)": normalize_leaf(value)}
+
+
+def score_record(has_response: bool, has_extraction: bool, prediction: Any, ground_truth: Any) -> Tuple[bool, Optional[str], List[Tuple[str, int, int, int]]]:
+    """Whole-object verdict `(is_correct, wrong_prediction_type)` plus per field `(field, tp, fp, fn)` counts."""
+    is_correct = False
+    wrong_prediction_type = None
+    if not has_response:
+        wrong_prediction_type = "API error"
+        prediction = None
+    elif not has_extraction:
+        wrong_prediction_type = "Extraction error"
+        prediction = None
+    else:
+        clean_prediction = maybe_clean_prediction_of_empty(
+            prediction, ground_truth
+        )
+        if ground_truth is None and clean_prediction is None:
+            is_correct = True
+        elif ground_truth is None and clean_prediction is not None:
+            wrong_prediction_type = "False positive"
+        elif ground_truth is not None and clean_prediction is None:
+            wrong_prediction_type = "False negative"
+        elif ground_truth != clean_prediction:
+            wrong_prediction_type = "Incorrect value"
+        else:
+            is_correct = True
+    predicted_fields = flatten_fields(prediction)
+    true_fields = flatten_fields(ground_truth)
+    field_counts = []
+    for field in sorted(set(predicted_fields) | set(true_fields)):
+        is_match = field in predicted_fields and predicted_fields.get(field) == true_fields.get(field)
+        field_counts.append((
+            field,
+            int(is_match),
+            int(field in predicted_fields and not is_match),
+            int(field in true_fields and not is_match),
+        ))
+    return is_correct, wrong_prediction_type, field_counts
+
+
+def evaluate_chunk(records: List[Dict]) -> Tuple[List[str], List[Tuple], List[Tuple]]:
+    """Score a chunk of log records; returns their formatted evaluation entries, record rows and field rows."""
+    entries = []
+    record_rows = []
+    field_rows = []
+    for each_result in records:
+        result = each_result['result']
+        has_extraction = result is not None and 'extraction' in result
+        is_correct, wrong_prediction_type, field_counts = score_record(
+            each_result['response'] is not None,
+            has_extraction,
+            result['extraction'] if has_extraction else None,
+            each_result['ground_truth'],
+        )
+        doc_name, line_item_name = each_result['doc_name'], each_result['line_item_name']
+        record_rows.append((
+            doc_name,
+            line_item_name,
+            each_result.get('context_mode'),
+            is_correct,
+            wrong_prediction_type,
+            # Line items extracted together share the prompt tokens of their call.
+            ((each_result['response'] or {}).get('usage') or {}).get('prompt_tokens', 0) / each_result.get('batch_size', 1),
+            each_result.get('latency_seconds'),
+        ))
+        field_rows.extend((doc_name, line_item_name) + counts for counts in field_counts)
+        evaluation_result = {
+            "doc_name": doc_name,
+            "line_item_name": line_item_name,
+            "response": each_result['response'],
+            "ground_truth": each_result['ground_truth'],
+            "is_correct": is_correct,
+            "wrong_prediction_type": wrong_prediction_type,
+        }
+        if 'context_mode' in each_result:
+            evaluation_result['context_mode'] = each_result['context_mode']
+        entries.append(format_array_item(evaluation_result))
+    return entries, record_rows, field_rows
+
+
+def iter_chunks(records: Iterator[Dict], chunk_size: int) -> Iterator[List[Dict]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
-    return clean_prediction
+def evaluate_log(records: Iterator[Dict], record_rows: List[Tuple], field_rows: List[Tuple], n_jobs: int = 1, chunk_size: int = 2000) -> Iterator[str]:
+    """Yield the formatted evaluation entry of every log record in order, evaluating chunks of records on `n_jobs` workers.
+
+    Scoring and formatting the entries run in the workers; the rows of every chunk are appended to
+    `record_rows` (one per record) and `field_rows` (one per compared field).
+    """
+    tasks = (delayed(evaluate_chunk)(chunk) for chunk in iter_chunks(records, chunk_size))
+    for entries, chunk_record_rows, chunk_field_rows in Parallel(n_jobs=n_jobs, return_as="generator")(tasks):
+        record_rows.extend(chunk_record_rows)
+        field_rows.extend(chunk_field_rows)
+        yield from entries
+
+
+def add_field_scores(table: pd.DataFrame) -> pd.DataFrame:
+    tp, fp, fn = (table[column].to_numpy(dtype=float) for column in ["tp", "fp", "fn"])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['precision'] = np.where(tp + fp > 0, tp / (tp + fp), np.nan)
+        table['recall'] = np.where(tp + fn > 0, tp / (tp + fn), np.nan)
+        table['f1'] = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), np.nan)
+        table['field_exact_match'] = np.where(table['fields'] > 0, tp / table['fields'].to_numpy(dtype=float), np.nan)
+    return table
+
+
+def breakdown(record_df: pd.DataFrame, field_df: pd.DataFrame, key: List[str]) -> pd.DataFrame:
+    """Whole-object accuracy and field precision/recall/F1/exact match per `key` group."""
+    objects = record_df.groupby(key).agg(
+        line_items=('is_correct', 'size'),
+        exact_match=('is_correct', 'mean'),
+    )
+    fields = field_df.groupby(key).agg(
+        fields=('field', 'size'),
+        tp=('tp', 'sum'),
+        fp=('fp', 'sum'),
+        fn=('fn', 'sum'),
+    )
+    table = objects.join(fields, how='left').fillna({'fields': 0, 'tp': 0, 'fp': 0, 'fn': 0})
+    return add_field_scores(table)
 
 
 if __name__ == "__main__":
@@ -26,55 +193,83 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model-generation-path",
         type=str,
-        help="Path to the model generation JSON file"
+        help="Path to the model generation JSON file, a JSONL checkpoint or a compact log directory"
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of worker processes scoring chunks of records, -1 for one per CPU"
     )
-    
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=2000,
+        required=False,
+        help="Number of records scored per task"
+    )
+
     args = parser.parse_args()
-    
-
-    with open(args.model_generation_path) as f:
-        results = json.load(f)
-    evaluation_results = []
-    num_api_error = 0
-    num_extraction_error = 0
-    num_is_correct = 0
-    for each_result in results:
-        is_correct = False
-        wrong_prediction_type = None
-        if each_result['response'] is None:
-            wrong_prediction_type = "API error"
-            num_api_error += 1
-        elif each_result['result'] is None or 'extraction' not in each_result['result']:
-            wrong_prediction_type = "Extraction error"
-            num_extraction_error += 1
-        else:
-            prediction = each_result['result']['extraction']
-            ground_truth = each_result['ground_truth']
-            clean_prediction = maybe_clean_prediction_of_empty(
-                prediction, ground_truth
-            )
-            if ground_truth is None and clean_prediction is None:
-                is_correct = True
-            elif ground_truth is None and clean_prediction is not None:
-                wrong_prediction_type = "False positive"
-            elif ground_truth is not None and clean_prediction is None:
-                wrong_prediction_type = "False negative"
-            elif ground_truth != clean_prediction:
-                wrong_prediction_type = "Incorrect value"
-            else:
-                is_correct = True
-        if is_correct:
-            num_is_correct += 1
-        evaluation_results.append({
-            "doc_name": each_result['doc_name'],
-            "line_item_name": each_result['line_item_name'],
-            "response": each_result['response'],
-            "ground_truth": each_result['ground_truth'],
-            "is_correct": is_correct,
-            "wrong_prediction_type": wrong_prediction_type,
-        })
-    print(f"Num API error: {num_api_error}, percentage: {num_api_error / len(evaluation_results)}")
-    print(f"Num extraction error: {num_extraction_error}, percentage: {num_extraction_error / len(evaluation_results)}")
-    print(f"Num is correct: {num_is_correct}, percentage: {num_is_correct / len(evaluation_results)}")
-    with open(f"{args.model_generation_path.replace('.json', '_eval.json')}", 'w') as f:
-        json.dump(evaluation_results, f, indent=4)
\ No newline at end of file
+    telemetry.start_run("step_5_evaluation")
+
+    output_prefix = log_output_prefix(args.model_generation_path)
+    record_rows = []
+    field_rows = []
+    with telemetry.phase("evaluate"):
+        write_json_array(
+            f"{output_prefix}_eval.json",
+            evaluate_log(
+                iter_log_records(args.model_generation_path),
+                record_rows,
+                field_rows,
+                n_jobs=args.n_jobs,
+                chunk_size=args.chunk_size,
+            ),
+            preformatted=True,
+        )
+    with telemetry.phase("aggregate"):
+        record_df = pd.DataFrame(record_rows, columns=RECORD_COLUMNS)
+        field_df = pd.DataFrame(field_rows, columns=FIELD_COLUMNS)
+        num_records = max(1, len(record_df))
+        num_api_error = int((record_df['wrong_prediction_type'] == "API error").sum())
+        num_extraction_error = int((record_df['wrong_prediction_type'] == "Extraction error").sum())
+        num_is_correct = int(record_df['is_correct'].sum())
+        overall = add_field_scores(pd.DataFrame([{
+            "fields": len(field_df),
+            "tp": field_df['tp'].sum(),
+            "fp": field_df['fp'].sum(),
+            "fn": field_df['fn'].sum(),
+        }])).iloc[0]
+        by_line_item = breakdown(record_df, field_df, ['line_item_name'])
+        by_document = breakdown(record_df, field_df, ['doc_name'])
+        by_field = add_field_scores(field_df.groupby(['line_item_name', 'field']).agg(
+            fields=('field', 'size'),
+            tp=('tp', 'sum'),
+            fp=('fp', 'sum'),
+            fn=('fn', 'sum'),
+        ))
+    telemetry.count("line_items", len(record_df))
+    telemetry.count("fields", len(field_df))
+    telemetry.count("api_errors", num_api_error)
+    telemetry.count("extraction_errors", num_extraction_error)
+    telemetry.count("correct", num_is_correct)
+    print(f"Num API error: {num_api_error}, percentage: {num_api_error / num_records}")
+    print(f"Num extraction error: {num_extraction_error}, percentage: {num_extraction_error / num_records}")
+    print(f"Num is correct: {num_is_correct}, percentage: {num_is_correct / num_records}")
+    print(f"Fields: {int(overall['fields'])}, precision {overall['precision']:.3f}, recall {overall['recall']:.3f}, F1 {overall['f1']:.3f}, field exact match {overall['field_exact_match']:.3f}")
+    print(f"Per document:\n{by_document.to_string(float_format=lambda x: f'{x:.3f}')}")
+    if record_df['context_mode'].notna().any():
+        per_mode = record_df.fillna({'context_mode': 'retrieved'}).groupby('context_mode').agg(
+            line_items=('is_correct', 'size'),
+            accuracy=('is_correct', 'mean'),
+            prompt_tokens=('prompt_tokens', 'sum'),
+            latency_p50=('latency_seconds', 'median'),
+        )
+        print(f"Per context mode:\n{per_mode.to_string()}")
+    with telemetry.phase("write_tables"):
+        by_line_item.to_csv(f"{output_prefix}_eval_by_line_item.csv")
+        by_document.to_csv(f"{output_prefix}_eval_by_document.csv")
+        by_field.to_csv(f"{output_prefix}_eval_by_field.csv")
+    print(f"Per line item, per document and per field tables saved to {output_prefix}_eval_by_*.csv")
+    telemetry.get_telemetry().write(f"{output_prefix}_eval_run_report.json")
@@ -0,0 +1,132 @@
+import os
+import json
+import random
+import argparse
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VOCABULARY = (
+    "policy premium retention limit liability coverage insured insurer endorsement breach extortion "
+    "notification period waiting indemnity aggregate claim loss damages regulatory defense media privacy "
+    "network security business interruption dependent system failure forensic legal expenses pci fines "
+    "penalties ransomware social engineering funds transfer fraud reputational harm schedule declarations "
+    "exclusion condition definition amount usd each per occurrence sublimit deductible hours days"
+).split()
+
+
+def make_section(doc_name, section_idx, rng, min_words, max_words):
+    num_words = rng.randint(min_words, max_words)
+    return {
+        "id": f"{doc_name}.pdf{section_idx:03d}",
+        "title": " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(1, 4))).title(),
+        "text": " ".join(rng.choice(VOCABULARY) for _ in range(num_words)),
+    }
+
+
+def make_document(doc_name, rng, retrieval_instructions, extraction_instructions, num_sections=30, min_words=50, max_words=900):
+    """A synthetic policy in the `raw_data/outputs` and `raw_data/ground_truths` formats."""
+    sections = [make_section(doc_name, i, rng, min_words, max_words) for i in range(num_sections)]
+    results = []
+    for instruction in retrieval_instructions:
+        relevant = rng.sample(sections, min(3, len(sections)))
+        results.append({
+            "retrieval_result": {
+                "line_item_name": instruction['Line item name'],
+                "relevant_sections": sorted(s['id'] for s in relevant),
+            }
+        })
+    output = {
+        "chunker_result": {"document_sections": sections},
+        "results": results,
+        "policy_conditions": {
+            "aggregate_limit_of_liability": rng.choice([1000000, 5000000, 10000000]),
+            "premium": rng.randint(10, 900) * 1000,
+            "retention": rng.choice([10000, 25000, 50000]),
+            "waiting_period": rng.choice(["", "8 hours", "12 hours"]),
+            "indemnity_period": rng.choice(["", "90 days", "180 days"]),
+        },
+        "sub_limits": [
+            {"name": rng.choice(VOCABULARY).title(), "limit": rng.randint(1, 50) * 100000, "retention": None}
+            for _ in range(rng.randint(2, 8))
+        ],
+    }
+    ground_truth = {
+        "synthesizer_result": {
+            instruction['Line item name']: (
+                None if rng.random() < 0.5
+                else {"type": "LIMIT", "limit": {"amount": {"currencyCode": "USD", "units": rng.randint(1, 100) * 10000, "nanos": 0}}}
+            )
+            for instruction in extraction_instructions
+        }
+    }
+    return output, ground_truth
+
+
+def write_corpus(root, num_docs, num_sections=30, min_words=50, max_words=900, seed=0):
+    """Write `num_docs` synthetic documents plus the instruction files under `<root>/raw_data`; returns the doc names."""
+    rng = random.Random(seed)
+    with open(os.path.join(REPO_ROOT, "retrieval_instructions.json"), "r") as f:
+        retrieval_instructions = json.load(f)
+    with open(os.path.join(REPO_ROOT, "extraction_instructions.json"), "r") as f:
+        extraction_instructions = json.load(f)
+    os.makedirs(os.path.join(root, "raw_data", "outputs"), exist_ok=True)
+    os.makedirs(os.path.join(root, "raw_data", "ground_truths"), exist_ok=True)
+    os.makedirs(os.path.join(root, "processed_data"), exist_ok=True)
+    with open(os.path.join(root, "raw_data", "retrieval_instructions.json"), "w") as f:
+        json.dump(retrieval_instructions, f, indent=4)
+    with open(os.path.join(root, "raw_data", "extraction_instructions.json"), "w") as f:
+        json.dump(extraction_instructions, f, indent=4)
+    doc_names = []
+    for doc_idx in range(num_docs):
+        doc_name = f"synthetic_{doc_idx:05d}"
+        output, ground_truth = make_document(
+            doc_name,
+            rng,
+            retrieval_instructions,
+            extraction_instructions,
+            num_sections=rng.randint(max(1, num_sections // 2), num_sections * 3 // 2),
+            min_words=min_words,
+            max_words=max_words,
+        )
+        with open(os.path.join(root, "raw_data", "outputs", f"{doc_name}.json"), "w") as f:
+            json.dump(output, f)
+        with open(os.path.join(root, "raw_data", "ground_truths", f"{doc_name}.json"), "w") as f:
+            json.dump(ground_truth, f)
+        doc_names.append(doc_name)
+    return doc_names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic policy corpus in the raw_data format")
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=True,
+        help="Directory under which raw_data/ is created"
+    )
+    parser.add_argument(
+        "--num-docs",
+        type=int,
+        default=14,
+        required=False,
+        help="Number of documents"
+    )
+    parser.add_argument(
+        "--num-sections",
+        type=int,
+        default=30,
+        required=False,
+        help="Average number of sections per document"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        required=False,
+        help="Random seed"
+    )
+
+    args = parser.parse_args()
+
+    doc_names = write_corpus(args.output_dir, args.num_docs, num_sections=args.num_sections, seed=args.seed)
+    print(f"Wrote {len(doc_names)} documents to {os.path.join(args.output_dir, 'raw_data')}")
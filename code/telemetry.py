@@ -0,0 +1,135 @@
+import os
+import json
+import time
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values))) - 1))]
+
+
+class Telemetry:
+    """Phase wall times, counters and per-unit distributions of a run, reported as JSON.
+
+    Phases may nest (e.g. `parse_tool_calls` runs inside `dispatch`), so their times do not add up
+    to the wall time.
+    """
+
+    def __init__(self, run_name="run"):
+        self.run_name = run_name
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.samples = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase_stats = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            phase_stats['seconds'] += time.perf_counter() - start
+            phase_stats['calls'] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if value is not None:
+            self.samples.setdefault(name, []).append(value)
+
+    def observe_unit(self, stage, unit, response):
+        """Latency, retries and `usage` tokens of a finished unit of `stage` (retrieval, extraction)."""
+        self.count(f"{stage}_units")
+        if response is None:
+            self.count(f"{stage}_failed_units")
+        self.observe(f"{stage}_latency_seconds", unit.get('latency_seconds'))
+        self.observe(f"{stage}_retries", unit.get('retries'))
+        usage = (response or {}).get('usage') or {}
+        self.observe(f"{stage}_prompt_tokens", usage.get('prompt_tokens'))
+        self.observe(f"{stage}_completion_tokens", usage.get('completion_tokens'))
+        self.observe(f"{stage}_cached_tokens", (usage.get('prompt_tokens_details') or {}).get('cached_tokens'))
+
+    def add_stats(self, stats):
+        """Dispatcher `RunStats` (requests, retries, failures, throttling, ...) as counters."""
+        if stats is None:
+            return
+        for key, value in stats.to_dict().items():
+            if isinstance(value, (int, float)):
+                self.count(f"dispatch_{key}", value)
+
+    def report(self):
+        wall_seconds = time.perf_counter() - self.start
+        distributions = {}
+        for name, values in self.samples.items():
+            values = sorted(values)
+            distributions[name] = {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            }
+        return {
+            "run": self.run_name,
+            "started_at": self.started_at,
+            "wall_seconds": wall_seconds,
+            "phases": {
+                name: dict(phase_stats, share=phase_stats['seconds'] / max(wall_seconds, 1e-9))
+                for name, phase_stats in self.phases.items()
+            },
+            "counters": self.counters,
+            "distributions": distributions,
+        }
+
+    def write(self, path):
+        """Write the run report to `path` and print its summary."""
+        report = self.report()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Run report ({self.run_name}, {report['wall_seconds']:.1f}s wall) written to {path}")
+        for name, phase_stats in sorted(report['phases'].items(), key=lambda p: -p[1]['seconds']):
+            print(f"  {name:>30}: {phase_stats['seconds']:9.2f}s {phase_stats['share']:6.1%} ({phase_stats['calls']} calls)")
+        for name, distribution in report['distributions'].items():
+            print(f"  {name:>30}: p50 {distribution['p50']:.2f}, p95 {distribution['p95']:.2f}, p99 {distribution['p99']:.2f}, max {distribution['max']:.2f} (n={distribution['count']})")
+        return report
+
+
+_current = Telemetry()
+
+
+def start_run(run_name):
+    """Start recording a new run; the module level hooks below record into it."""
+    global _current
+    _current = Telemetry(run_name)
+    return _current
+
+
+def get_telemetry():
+    return _current
+
+
+def phase(name):
+    return _current.phase(name)
+
+
+def count(name, value=1):
+    _current.count(name, value)
+
+
+def observe_unit(stage, unit, response):
+    _current.observe_unit(stage, unit, response)
+
+
+def add_stats(stats):
+    _current.add_stats(stats)
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import math
+import random
+import hashlib
+import argparse
+
+
+DEFAULT_TOKENIZER = "Qwen/Qwen3-0.6B"
+DEFAULT_CALIBRATION_PATH = "processed_data/token_estimator_calibration.json"
+
+# Character classes counted by the estimator, see `estimate_features`.
+FEATURE_NAMES = ["constant", "words", "long_word_chars", "digits", "punctuation", "non_ascii", "newline_runs", "space_runs"]
+LONG_WORD_CHARS = 8
+WORD_PATTERN = re.compile(r"[A-Za-z]+")
+LONG_WORD_PATTERN = re.compile(r"[A-Za-z]{%d,}" % (LONG_WORD_CHARS + 1))
+DIGIT_PATTERN = re.compile(r"[0-9]")
+PUNCTUATION_PATTERN = re.compile(r"[!-/:-@\[-`{-~]")
+NON_ASCII_PATTERN = re.compile(r"[^\x00-\x7f]")
+NEWLINE_RUN_PATTERN = re.compile(r"\n+")
+SPACE_RUN_PATTERN = re.compile(r"[ \t]{2,}")
+# Uncalibrated defaults: one token per word, digit, symbol and whitespace run, plus one per 4 extra characters of long words.
+DEFAULT_COEFFICIENTS = [0.0, 1.0, 0.25, 1.0, 1.0, 1.0, 1.0, 1.0]
+DEFAULT_ERROR_BOUND = 0.25
+
+
+class HFTokenCounter:
+    """Exact token counts with a Hugging Face tokenizer, loaded (and `transformers` imported) on first use."""
+
+    def __init__(self, model_name=DEFAULT_TOKENIZER):
+        self.model_name = model_name
+        self.namespace = model_name
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        return self._tokenizer
+
+    def count(self, text):
+        return len(self.tokenizer.encode(text))
+
+    def count_batch(self, texts):
+        return [len(input_ids) for input_ids in self.tokenizer(list(texts))['input_ids']]
+
+
+def estimate_features(text):
+    long_words = LONG_WORD_PATTERN.findall(text)
+    return [
+        1,
+        len(WORD_PATTERN.findall(text)),
+        sum(len(w) for w in long_words) - LONG_WORD_CHARS * len(long_words),
+        len(DIGIT_PATTERN.findall(text)),
+        len(PUNCTUATION_PATTERN.findall(text)),
+        len(NON_ASCII_PATTERN.findall(text)),
+        len(NEWLINE_RUN_PATTERN.findall(text)),
+        len(SPACE_RUN_PATTERN.findall(text)),
+    ]
+
+
+class EstimatedTokenCounter:
+    """Pure Python token estimate, a linear model over character class counts fitted against a tokenizer.
+
+    `error_bound` is the relative error not exceeded on 99% of the held-out calibration texts.
+    With `conservative`, counts are inflated by that bound so that token budgets still hold.
+    """
+
+    def __init__(self, coefficients=None, error_bound=DEFAULT_ERROR_BOUND, conservative=False, reference=None):
+        self.coefficients = list(coefficients or DEFAULT_COEFFICIENTS)
+        self.error_bound = error_bound
+        self.conservative = conservative
+        self.reference = reference
+        digest = hashlib.sha256(json.dumps(self.coefficients).encode("utf-8")).hexdigest()[:12]
+        self.namespace = f"estimate:{digest}:{int(conservative)}"
+
+    @classmethod
+    def load(cls, path=DEFAULT_CALIBRATION_PATH, conservative=False):
+        """Calibrated estimator saved by `--calibrate`, or the uncalibrated defaults if there is none."""
+        if not path or not os.path.exists(path):
+            return cls(conservative=conservative)
+        with open(path, 'r') as f:
+            calibration = json.load(f)
+        return cls(
+            calibration['coefficients'],
+            error_bound=calibration['error_bound'],
+            conservative=conservative,
+            reference=calibration['reference'],
+        )
+
+    def estimate(self, text):
+        return max(1.0, sum(c * x for c, x in zip(self.coefficients, estimate_features(text))))
+
+    def count(self, text):
+        estimate = self.estimate(text)
+        if self.conservative:
+            estimate *= 1 + self.error_bound
+        return math.ceil(estimate)
+
+    def count_batch(self, texts):
+        return [self.count(text) for text in texts]
+
+    def save(self, path, num_samples):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                "reference": self.reference,
+                "features": FEATURE_NAMES,
+                "coefficients": self.coefficients,
+                "error_bound": self.error_bound,
+                "num_samples": num_samples,
+            }, f, indent=4)
+
+
+def calibrate(texts, reference_counter, holdout=0.2, quantile=0.99, seed=0):
+    """Fit the estimator on `texts` against `reference_counter`; returns it and the held-out relative errors."""
+    import numpy as np
+    texts = list(texts)
+    random.Random(seed).shuffle(texts)
+    num_holdout = max(1, int(len(texts) * holdout))
+    fit_texts, holdout_texts = texts[num_holdout:], texts[:num_holdout]
+    features = np.array([estimate_features(text) for text in fit_texts], dtype=float)
+    counts = np.array(reference_counter.count_batch(fit_texts), dtype=float)
+    coefficients, _, _, _ = np.linalg.lstsq(features, counts, rcond=None)
+    estimator = EstimatedTokenCounter(
+        [float(c) for c in np.clip(coefficients, 0.0, None)],
+        reference=reference_counter.namespace,
+    )
+    estimates = np.array([estimator.estimate(text) for text in holdout_texts])
+    holdout_counts = np.array(reference_counter.count_batch(holdout_texts), dtype=float)
+    relative_errors = np.abs(estimates - holdout_counts) / np.maximum(1.0, holdout_counts)
+    estimator.error_bound = float(np.quantile(relative_errors, quantile))
+    return estimator, relative_errors
+
+
+def get_token_counter(name, model_name=DEFAULT_TOKENIZER, calibration_path=DEFAULT_CALIBRATION_PATH, conservative=False):
+    """`hf`: exact counts with the tokenizer, `estimate`: the calibrated pure Python estimator."""
+    if name == 'hf':
+        return HFTokenCounter(model_name)
+    if name == 'estimate':
+        return EstimatedTokenCounter.load(calibration_path, conservative=conservative)
+    raise ValueError(f"Unknown token counter {name}")
+
+
+_DEFAULT_ESTIMATOR = None
+
+
+def estimate_tokens(text):
+    """Token estimate of `text` with the uncalibrated default coefficients, no tokenizer or file needed."""
+    global _DEFAULT_ESTIMATOR
+    if _DEFAULT_ESTIMATOR is None:
+        _DEFAULT_ESTIMATOR = EstimatedTokenCounter()
+    return _DEFAULT_ESTIMATOR.count(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the token estimator against the tokenizer on the raw_data sections")
+    parser.add_argument(
+        "--model-name",
+        type=str,
+        default=DEFAULT_TOKENIZER,
+        required=False,
+        help="Tokenizer the estimator is calibrated against"
+    )
+    parser.add_argument(
+        "--raw-dir",
+        type=str,
+        default="raw_data",
+        required=False,
+        help="Directory holding outputs/ and the instruction files"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=DEFAULT_CALIBRATION_PATH,
+        required=False,
+        help="Where to save the calibration"
+    )
+
+    args = parser.parse_args()
+
+    from section_grouper import section_content
+    texts = []
+    for name in sorted(os.listdir(os.path.join(args.raw_dir, "outputs"))):
+        if name.endswith(".json"):
+            with open(os.path.join(args.raw_dir, "outputs", name), 'r') as f:
+                texts.extend(section_content(s) for s in json.load(f)['chunker_result']['document_sections'])
+    for name in ["retrieval_instructions.json", "extraction_instructions.json"]:
+        with open(os.path.join(args.raw_dir, name), 'r') as f:
+            texts.extend(json.dumps(d, indent=4) for d in json.load(f))
+    estimator, relative_errors = calibrate(texts, HFTokenCounter(args.model_name))
+    estimator.save(args.output, len(texts))
+    print(f"Calibrated on {len(texts)} texts against {args.model_name}: coefficients {dict(zip(FEATURE_NAMES, [round(c, 3) for c in estimator.coefficients]))}")
+    print(f"Held-out relative error: mean {relative_errors.mean():.3f}, p99 {estimator.error_bound:.3f}, max {relative_errors.max():.3f}")
+    print(f"Saved to {args.output}")
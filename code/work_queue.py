@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import subprocess
+from tqdm import tqdm
+from llm_dispatch import FOLLOW_UP_PRIORITY
+
+
+QUEUE_BACKENDS = ['sqlite']
+# A unit whose lease expired this many times (its workers died on it) is completed without a response.
+MAX_LEASE_ATTEMPTS = 3
+# Units are written in transactions of this many, so that workers can lease and complete units in between.
+ENQUEUE_CHUNK_SIZE = 256
+
+
+class SQLiteWorkQueue:
+    """Durable work queue of processing units in a SQLite file, shared by a coordinator and any number of workers.
+
+    Every backend implements the same interface:
+        open(queue_name) / close(queue_name): a coordinator starts and ends a run of a named queue.
+        enqueue(queue_name, units, run_id, priority): add or reset units, keyed by `unit_id`.
+        lease(worker_id, limit, lease_seconds): claim up to `limit` units of any open queue, lower priority
+            first, then largest estimated prompt first; the claim expires after `lease_seconds`
+            (visibility timeout), after which another worker can lease the unit again.
+        renew(worker_id, lease_seconds): extend the leases of a worker still working on its units.
+        complete(unit, response): store the response (None for a failed request) of a unit still under its lease.
+        collect(queue_name, run_id, limit) / mark_collected(...): completed units not yet handed to the coordinator.
+        remaining(queue_name, run_id): units of a run the coordinator has not collected yet.
+        is_drained(): every queue is closed, i.e. no coordinator is waiting for results.
+    Units are stored as JSON; a worker only needs their `create_params`.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Transactions are explicit, so that leasing is atomic across processes.
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS queues (name TEXT PRIMARY KEY, closed INTEGER NOT NULL)")
+        # The unit and result JSON come last, so that queries on the other columns do not read through them.
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "queue TEXT NOT NULL, unit_id TEXT NOT NULL, run_id TEXT NOT NULL, "
+            "priority INTEGER NOT NULL, estimated_tokens INTEGER NOT NULL, status TEXT NOT NULL, "
+            "lease_owner TEXT, lease_id TEXT, lease_expires REAL, attempts INTEGER NOT NULL, collected INTEGER NOT NULL, "
+            "unit TEXT NOT NULL, result TEXT, "
+            "PRIMARY KEY (queue, unit_id))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS units_lease ON units (status, priority, estimated_tokens DESC)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS units_collect ON units (queue, run_id, status, collected)")
+
+    def open(self, queue_name):
+        self.conn.execute(
+            "INSERT INTO queues (name, closed) VALUES (?, 0) ON CONFLICT (name) DO UPDATE SET closed = 0", (queue_name,)
+        )
+
+    def close(self, queue_name):
+        self.conn.execute("UPDATE queues SET closed = 1 WHERE name = ?", (queue_name,))
+
+    def enqueue(self, queue_name, units, run_id, priority=0):
+        """Add units to a queue as pending and return their number.
+
+        A unit already in the queue is reset to pending, unless it was completed but never collected
+        with the same content (e.g. the previous coordinator stopped): its response is then collected by this run.
+        `units` may be a lazy iterable: units are built and serialized outside of the write transactions,
+        and committed `ENQUEUE_CHUNK_SIZE` at a time, so workers already running are not locked out meanwhile.
+        """
+        num_units = 0
+        rows = []
+        for unit in units:
+            rows.append((queue_name, unit['unit_id'], run_id, json.dumps(unit, ensure_ascii=False), priority, int(unit.get('estimated_tokens') or 0)))
+            if len(rows) == ENQUEUE_CHUNK_SIZE:
+                num_units += self._insert_units(rows)
+                rows = []
+        if rows:
+            num_units += self._insert_units(rows)
+        return num_units
+
+    def _insert_units(self, rows):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                "INSERT INTO units (queue, unit_id, run_id, unit, priority, estimated_tokens, status, attempts, collected) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, 0) "
+                "ON CONFLICT (queue, unit_id) DO UPDATE SET run_id = excluded.run_id, "
+                "unit = excluded.unit, priority = excluded.priority, estimated_tokens = excluded.estimated_tokens, "
+                "status = CASE WHEN status = 'done' AND collected = 0 AND unit = excluded.unit THEN status ELSE 'pending' END, "
+                "result = CASE WHEN status = 'done' AND collected = 0 AND unit = excluded.unit THEN result ELSE NULL END, "
+                "attempts = 0, lease_owner = NULL, lease_id = NULL, lease_expires = NULL, collected = 0",
+                rows,
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def lease(self, worker_id, limit, lease_seconds):
+        """Claim up to `limit` pending (or expired) units; returns them with their queue and lease in `unit['queue_name']` and `unit['lease_id']`."""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Units whose workers repeatedly died on them are given up on instead of crashing more workers.
+            self.conn.execute(
+                "UPDATE units SET status = 'done', result = ?, lease_owner = NULL, lease_id = NULL "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (json.dumps({"response": None, "error": "lease expired too many times"}), now, MAX_LEASE_ATTEMPTS),
+            )
+            self.conn.execute("UPDATE units SET status = 'pending' WHERE status = 'leased' AND lease_expires < ?", (now,))
+            rows = self.conn.execute(
+                "SELECT queue, unit_id, unit FROM units "
+                "WHERE status = 'pending' AND queue IN (SELECT name FROM queues WHERE closed = 0) "
+                "ORDER BY priority, estimated_tokens DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+            leases = [(worker_id, uuid.uuid4().hex, now + lease_seconds, queue_name, unit_id) for queue_name, unit_id, _ in rows]
+            self.conn.executemany(
+                "UPDATE units SET status = 'leased', lease_owner = ?, lease_id = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE queue = ? AND unit_id = ?",
+                leases,
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        units = []
+        for (queue_name, _, unit_json), (_, lease_id, *_) in zip(rows, leases):
+            unit = json.loads(unit_json)
+            unit['queue_name'] = queue_name
+            unit['lease_id'] = lease_id
+            units.append(unit)
+        return units
+
+    def renew(self, worker_id, lease_seconds):
+        self.conn.execute(
+            "UPDATE units SET lease_expires = ? WHERE status = 'leased' AND lease_owner = ?",
+            (time.time() + lease_seconds, worker_id),
+        )
+
+    def complete(self, unit, response):
+        """Store the response of a leased unit.
+
+        Dropped if the lease expired and another worker took the unit over, or if the coordinator
+        replaced it meanwhile (e.g. by a follow-up with the same unit id).
+        """
+        result = {
+            "response": response,
+            "latency_seconds": unit.get('latency_seconds'),
+            "retries": unit.get('retries'),
+        }
+        self.conn.execute(
+            "UPDATE units SET status = 'done', result = ?, lease_owner = NULL, lease_id = NULL, lease_expires = NULL "
+            "WHERE queue = ? AND unit_id = ? AND status = 'leased' AND lease_id = ?",
+            (json.dumps(result, ensure_ascii=False), unit['queue_name'], unit['unit_id'], unit['lease_id']),
+        )
+
+    def collect(self, queue_name, run_id, limit=256):
+        """`(unit, response)` of completed units of a run not collected yet, with the worker's `latency_seconds` and `retries`."""
+        rows = self.conn.execute(
+            "SELECT unit, result FROM units WHERE queue = ? AND run_id = ? AND status = 'done' AND collected = 0 LIMIT ?",
+            (queue_name, run_id, limit),
+        ).fetchall()
+        collected = []
+        for unit_json, result_json in rows:
+            unit = json.loads(unit_json)
+            result = json.loads(result_json)
+            unit['latency_seconds'] = result.get('latency_seconds')
+            unit['retries'] = result.get('retries')
+            collected.append((unit, result['response']))
+        return collected
+
+    def mark_collected(self, queue_name, unit_id):
+        self.conn.execute(
+            "UPDATE units SET collected = 1 WHERE queue = ? AND unit_id = ? AND status = 'done'", (queue_name, unit_id)
+        )
+
+    def remaining(self, queue_name, run_id):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM units WHERE queue = ? AND run_id = ? AND collected = 0", (queue_name, run_id)
+        ).fetchone()[0]
+
+    def is_drained(self):
+        return self.conn.execute("SELECT COUNT(*) FROM queues WHERE closed = 0").fetchone()[0] == 0
+
+    def counts(self, queue_name):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM units WHERE queue = ? GROUP BY status", (queue_name,)))
+
+    def disconnect(self):
+        self.conn.close()
+
+
+def get_work_queue(backend, path):
+    if backend == 'sqlite':
+        return SQLiteWorkQueue(path)
+    raise ValueError(f"Unknown work queue backend {backend}")
+
+
+def local_worker_args(args):
+    """`queue_worker.py` dispatch flags of a step's local workers: its own, with the rate budgets split between them."""
+    num_workers = max(1, args.local_workers)
+    return [
+        "--n-jobs", str(args.n_jobs),
+        "--rpm", str(max(1, args.rpm // num_workers) if args.rpm else 0),
+        "--tpm", str(max(1, args.tpm // num_workers) if args.tpm else 0),
+        "--max-retries", str(args.max_retries),
+        "--cache-mode", args.cache_mode,
+        "--cache-path", args.cache_path,
+        "--cache-max-mb", str(args.cache_max_mb),
+    ]
+
+
+def start_local_workers(num_workers, work_queue, worker_args=()):
+    """Start `num_workers` `queue_worker.py` processes on this host; they exit once no coordinator is running."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queue_worker.py")
+    return [
+        subprocess.Popen([
+            sys.executable, script,
+            "--queue-backend", work_queue.backend,
+            "--queue-path", work_queue.path,
+            "--worker-id", f"local-{os.getpid()}-{worker_idx}",
+            "--coordinator-pid", str(os.getpid()),
+            *worker_args,
+        ])
+        for worker_idx in range(num_workers)
+    ]
+
+
+def run_queue(units, work_queue, queue_name, on_result, poll_seconds=1.0, local_workers=0, worker_args=()):
+    """Run units through a work queue served by worker processes and call `on_result(unit, response)` for each of them.
+
+    The coordinator only enqueues and collects: workers (`queue_worker.py`, `local_workers` processes started
+    with `worker_args` once the units are enqueued, or started on other hosts against the same queue)
+    lease the units, send the requests and write the responses back.
+    Units returned by `on_result` are enqueued as follow-ups in the same run. Units are collected
+    in completion order; the ones that failed get `None`, like with `run_units`.
+    """
+    run_id = uuid.uuid4().hex
+    work_queue.open(queue_name)
+    workers = []
+    try:
+        num_units = work_queue.enqueue(queue_name, units, run_id)
+        workers = start_local_workers(local_workers, work_queue, worker_args)
+        with tqdm(total=num_units) as pbar:
+            while work_queue.remaining(queue_name, run_id) > 0:
+                collected = work_queue.collect(queue_name, run_id)
+                if not collected:
+                    if workers and all(worker.poll() is not None for worker in workers):
+                        raise RuntimeError(f"All {len(workers)} local workers exited with {work_queue.remaining(queue_name, run_id)} units left in {queue_name}")
+                    time.sleep(poll_seconds)
+                    continue
+                for unit, response in collected:
+                    follow_ups = list(on_result(unit, response) or ())
+                    # Collected before its follow-ups are enqueued, which may reuse its unit id.
+                    work_queue.mark_collected(queue_name, unit['unit_id'])
+                    if follow_ups:
+                        pbar.total += work_queue.enqueue(queue_name, follow_ups, run_id, priority=FOLLOW_UP_PRIORITY)
+                        pbar.refresh()
+                    pbar.update(1)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        work_queue.close(queue_name)
+    for worker in workers:
+        worker.wait()
+    print(f"Work queue {queue_name}: {work_queue.counts(queue_name)}")
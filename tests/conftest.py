@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code"))
+
+from mock_openai_server import ServerBehavior, start_mock_server
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """Start an in-process mock OpenAI server and point the client at it; set `server.behavior` for latency and errors."""
+    server = start_mock_server(behavior=ServerBehavior())
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "mock")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_unit(unit_id, prompt_chars=100, **extra):
+    return {
+        "unit_id": unit_id,
+        "create_params": {"model": "mock", "messages": [{"role": "user", "content": f"{unit_id} " + "x" * prompt_chars}]},
+        **extra,
+    }
@@ -0,0 +1,88 @@
+import os
+
+from batch_api import LocalBatchBackend, run_batch, write_batch_files
+from conftest import make_unit
+from mock_openai_server import build_completion
+
+
+class RecordingBackend(LocalBatchBackend):
+    """Local backend that counts submissions and can fail or drop the results of some units."""
+
+    def __init__(self, directory, failed_ids=(), dropped_ids=()):
+        super().__init__(directory)
+        self.submitted = []
+        self.failed_ids = set(failed_ids)
+        self.dropped_ids = set(dropped_ids)
+
+    def submit(self, batch_path):
+        self.submitted.append(batch_path)
+        return super().submit(batch_path)
+
+    def results(self, batch_id):
+        for line in super().results(batch_id):
+            if line['custom_id'] in self.dropped_ids:
+                continue
+            if line['custom_id'] in self.failed_ids:
+                line['response'] = {"status_code": 500, "body": {"error": {"message": "server error"}}}
+            yield line
+
+
+def run(units, backend, tmp_path, **kwargs):
+    responses = {}
+    run_batch(
+        units,
+        backend,
+        str(tmp_path / "batches" / "step"),
+        lambda unit, response: responses.__setitem__(unit['unit_id'], response),
+        poll_seconds=0,
+        **kwargs,
+    )
+    return responses
+
+
+def test_results_are_mapped_back_by_custom_id(tmp_path):
+    units = [make_unit(f"u{i}", 10 * i) for i in range(5)]
+    responses = run(units, RecordingBackend(str(tmp_path / "backend")), tmp_path)
+    assert set(responses) == {unit['unit_id'] for unit in units}
+    for unit in units:
+        expected = build_completion(unit['create_params'])
+        assert responses[unit['unit_id']]['id'] == expected['id']
+
+
+def test_failed_and_missing_results_get_none(tmp_path):
+    units = [make_unit(f"u{i}") for i in range(4)]
+    backend = RecordingBackend(str(tmp_path / "backend"), failed_ids=["u1"], dropped_ids=["u2"])
+    responses = run(units, backend, tmp_path)
+    assert responses['u1'] is None and responses['u2'] is None
+    assert responses['u0'] is not None and responses['u3'] is not None
+
+
+def test_files_split_by_request_count_and_size(tmp_path):
+    units = [make_unit(f"u{i}", 1000) for i in range(10)]
+    paths = write_batch_files(str(tmp_path / "count"), units, max_requests=4)
+    assert [sum(1 for _ in open(p)) for p in paths] == [4, 4, 2]
+    line_bytes = os.path.getsize(write_batch_files(str(tmp_path / "one"), units[:1])[0])
+    paths = write_batch_files(str(tmp_path / "size"), units, max_bytes=3 * line_bytes + 10)
+    assert all(os.path.getsize(p) <= 3 * line_bytes + 10 for p in paths)
+    assert sum(sum(1 for _ in open(p)) for p in paths) == 10 and len(paths) == 4
+
+    backend = RecordingBackend(str(tmp_path / "backend"))
+    responses = run(units, backend, tmp_path, max_batch_bytes=3 * line_bytes + 10)
+    assert len(backend.submitted) == 4
+    assert all(responses[unit['unit_id']] is not None for unit in units)
+
+
+def test_rerun_polls_submitted_batches_and_cache_skips_them(tmp_path):
+    units = [make_unit(f"u{i}") for i in range(3)]
+    backend = RecordingBackend(str(tmp_path / "backend"))
+    first = run(units, backend, tmp_path)
+    second = run(units, backend, tmp_path)
+    assert len(backend.submitted) == 1
+    assert second == first
+
+    cache_path = str(tmp_path / "cache.sqlite")
+    run(units, backend, tmp_path, cache_path=cache_path, cache_mode='readwrite')
+    cached_backend = RecordingBackend(str(tmp_path / "backend2"))
+    responses = run(units, cached_backend, tmp_path, cache_path=cache_path, cache_mode='readwrite')
+    assert cached_backend.submitted == []
+    assert responses == first
@@ -0,0 +1,28 @@
+import json
+
+from document_store import DocumentStore, RawDocument
+
+
+def write_raw_document(raw_dir, num_sections=6):
+    sections = [{"id": f"doc{i:03d}", "title": f"Section {i}", "text": f"text {i}"} for i in range(num_sections)]
+    (raw_dir / "outputs").mkdir(parents=True)
+    with open(raw_dir / "outputs" / "doc.json", "w") as f:
+        json.dump({"chunker_result": {"document_sections": sections}, "results": []}, f)
+    return sections
+
+
+def test_stored_document_decodes_only_the_sections_asked_for(tmp_path):
+    sections = write_raw_document(tmp_path / "raw_data")
+    store = DocumentStore(str(tmp_path / "store"), raw_dir=str(tmp_path / "raw_data"))
+    document = store.open("doc")
+    try:
+        fetched = list(document.iter_sections({"doc004", "doc001", "missing"}))
+        assert fetched == [sections[1], sections[4]]
+        assert set(document._decoded) == {"doc001", "doc004"}
+        # The fingerprint was computed at conversion, it decodes nothing and matches the raw document's.
+        raw_document = RawDocument("doc", raw_dir=str(tmp_path / "raw_data"))
+        assert document.fingerprint() == raw_document.fingerprint()
+        assert set(document._decoded) == {"doc001", "doc004"}
+        assert list(document.iter_sections()) == sections
+    finally:
+        document.close()
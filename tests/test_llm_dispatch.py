@@ -0,0 +1,121 @@
+import asyncio
+import sqlite3
+
+import llm_dispatch
+from conftest import make_unit
+from llm_dispatch import LLMDispatcher, get_async_client, run_units
+from mock_openai_server import ServerBehavior
+
+
+def dispatch(units, concurrency=1, on_result=None, **dispatcher_kwargs):
+    """Stream units through a dispatcher; returns `(unit_id, response)` in completion order."""
+
+    async def _run():
+        client = get_async_client()
+        try:
+            dispatcher = LLMDispatcher(client, concurrency=concurrency, **dispatcher_kwargs)
+            results = []
+            async for unit, response in dispatcher.stream(units):
+                results.append((unit['unit_id'], response))
+                for follow_up in (on_result(unit, response) if on_result else None) or ():
+                    dispatcher.submit(follow_up, priority=llm_dispatch.FOLLOW_UP_PRIORITY)
+            return results
+        finally:
+            await client.close()
+
+    return asyncio.run(asyncio.wait_for(_run(), timeout=30))
+
+
+def test_retries_rate_limits_and_server_errors(mock_server, monkeypatch):
+    mock_server.behavior = ServerBehavior(error_rate=0.4, retry_after_ms=50, seed=1)
+    delays = []
+
+    def fast_backoff(attempt, retry_after=None):
+        delays.append(retry_after)
+        return retry_after or 0.01
+
+    monkeypatch.setattr(llm_dispatch, "backoff_delay", fast_backoff)
+    responses = {}
+    stats = run_units(
+        [make_unit(f"u{i}") for i in range(30)],
+        4,
+        lambda unit, response: responses.__setitem__(unit['unit_id'], response),
+        max_retries=20,
+    )
+    assert len(responses) == 30 and all(r is not None for r in responses.values())
+    assert mock_server.error_count > 0
+    assert stats.retries == mock_server.error_count
+    assert stats.requests == mock_server.request_count == 30 + mock_server.error_count
+    assert stats.failures == 0
+    # 429s carry `retry-after-ms`, which the backoff honors.
+    assert 0.05 in delays
+
+
+def test_gives_up_after_max_retries(mock_server, monkeypatch):
+    mock_server.behavior = ServerBehavior(error_rate=1.0)
+    monkeypatch.setattr(llm_dispatch, "backoff_delay", lambda attempt, retry_after=None: 0.0)
+    responses = []
+    stats = run_units([make_unit("u0")], 1, lambda unit, response: responses.append(response), max_retries=2)
+    assert responses == [None]
+    assert mock_server.request_count == 3
+    assert stats.failures == 1
+
+
+def test_largest_prompt_first_and_follow_ups_ahead(mock_server):
+    units = [make_unit("small", 10), make_unit("large", 3000), make_unit("tiny", 1), make_unit("medium", 500)]
+
+    def on_result(unit, response):
+        if unit['unit_id'] == "large":
+            return [make_unit("follow_up", 1)]
+
+    order = [unit_id for unit_id, _ in dispatch(units, on_result=on_result)]
+    # The worker already took "medium" when "large" is handed back; the follow-up goes before the units still queued.
+    assert order == ["large", "medium", "follow_up", "small", "tiny"]
+
+
+def test_priority_before_size(mock_server):
+
+    async def _run():
+        client = get_async_client()
+        try:
+            dispatcher = LLMDispatcher(client, concurrency=1)
+            dispatcher.submit(make_unit("large", 3000))
+            dispatcher.submit(make_unit("urgent", 10), priority=-1)
+            return [unit['unit_id'] async for unit, _ in dispatcher.stream()]
+        finally:
+            await client.close()
+
+    assert asyncio.run(_run()) == ["urgent", "large"]
+
+
+def test_follow_ups_ahead_of_queued_warm_ups(mock_server):
+    units = [
+        make_unit("warm_a", 3000, prefix_key="a"),
+        make_unit("sibling_a", 2000, prefix_key="a"),
+        make_unit("warm_b", 1000, prefix_key="b"),
+        make_unit("warm_c", 500, prefix_key="c"),
+    ]
+
+    def on_result(unit, response):
+        if unit['unit_id'] == "warm_a":
+            return [make_unit("follow_up", 1)]
+
+    order = [unit_id for unit_id, _ in dispatch(units, on_result=on_result, warmup=True)]
+    # Warm-ups go before the siblings of their priority, but not before a follow-up ("warm_b" was already taken).
+    assert order == ["warm_a", "warm_b", "follow_up", "warm_c", "sibling_a"]
+
+
+class BrokenCache:
+    def get(self, create_params):
+        if "broken" in create_params['messages'][0]['content']:
+            raise sqlite3.OperationalError("database is locked")
+        return None
+
+    def put(self, create_params, response):
+        pass
+
+
+def test_unexpected_error_fails_only_its_unit(mock_server):
+    results = dict(dispatch([make_unit("ok"), make_unit("broken"), make_unit("ok2")], concurrency=2, cache=BrokenCache()))
+    assert results['broken'] is None
+    assert results['ok'] is not None and results['ok2'] is not None
@@ -0,0 +1,92 @@
+import json
+import random
+from argparse import Namespace
+
+import pytest
+
+from relevance_memo import get_relevance_memo
+from step_3_retrieval import build_retrieval_units, memo_item_key
+from token_counter import get_token_counter
+
+LINE_ITEMS = {
+    "Premium": {"Line item instruction": "The premium of the policy."},
+    "Retention": {"Line item instruction": "The retention of the policy."},
+}
+
+
+@pytest.fixture
+def retrieval_dir(tmp_path, monkeypatch):
+    """A working directory with one 35 section document, packed into 4 section groups."""
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(2000)]
+    sections = [
+        {"id": f"doc{i:03d}", "title": f"Section {i}", "text": " ".join(rng.choice(words) for _ in range(200))}
+        for i in range(35)
+    ]
+    (tmp_path / "raw_data" / "outputs").mkdir(parents=True)
+    (tmp_path / "processed_data").mkdir()
+    with open(tmp_path / "raw_data" / "outputs" / "doc.json", "w") as f:
+        json.dump({"chunker_result": {"document_sections": sections}}, f)
+    monkeypatch.chdir(tmp_path)
+    return [s['id'] for s in sections]
+
+
+def build_units(args, token_counter):
+    """Build the units of a run, like the step does, with the memo as left by the previous runs."""
+    memo = get_relevance_memo("processed_data/relevance_memo.sqlite", 'readwrite')
+    units = build_retrieval_units(["doc"], LINE_ITEMS, args, token_counter, memo=memo)
+    return units, memo
+
+
+def records_by_id(units):
+    return {unit['unit_id']: unit for unit in units if 'batch_items' not in unit}
+
+
+@pytest.mark.parametrize("items_per_call", [1, 2])
+def test_resume_never_skips_sections_that_were_not_sent(retrieval_dir, items_per_call):
+    args = Namespace(items_per_call=items_per_call, prefilter='none', prompt_cache_warmup=False, model_name="mock")
+    token_counter = get_token_counter('estimate')
+
+    # First run: the memo is empty, every section is sent; it stops after the first group of every line item.
+    units, memo = build_units(args, token_counter)
+    assert not any(unit.get('memo') for unit in units)
+    sections_by_record = {}
+    for unit in units:
+        for record_id in unit['record_ids']:
+            sections_by_record[record_id] = unit['section_ids']
+    completed_ids = {f"doc::{item_name}::0" for item_name in LINE_ITEMS}
+    for record_id in completed_ids:
+        _, item_name, _ = record_id.split("::")
+        section_ids = sections_by_record[record_id]
+        memo.record("doc", memo_item_key(LINE_ITEMS[item_name], "mock"), section_ids, section_ids[:1])
+    memo.close()
+
+    # Resumed run: the memo serves the sections of the completed groups, the others are packed again.
+    units, memo = build_units(args, token_counter)
+    memo.close()
+    covered = {item_name: set() for item_name in LINE_ITEMS}
+    for unit in units:
+        item_names = unit.get('item_names', [unit.get('item_name')])
+        for item_name, record_id in zip(item_names, unit['record_ids']):
+            if record_id in completed_ids:
+                # Skipped by the resumed run: it must be the record of the very same sections.
+                assert unit['section_ids'] == sections_by_record[record_id]
+            covered[item_name].update(unit['section_ids'])
+    assert all(covered[item_name] == set(retrieval_dir) for item_name in LINE_ITEMS)
+
+
+def test_memo_record_id_changes_with_its_decisions(retrieval_dir):
+    args = Namespace(items_per_call=1, prefilter='none', prompt_cache_warmup=False, model_name="mock")
+    token_counter = get_token_counter('estimate')
+    item_key = memo_item_key(LINE_ITEMS["Premium"], "mock")
+    memo_ids = []
+    for num_decided in [5, 12]:
+        _, memo = build_units(args, token_counter)
+        memo.record("doc", item_key, retrieval_dir[:num_decided], [])
+        memo.close()
+        units, memo = build_units(args, token_counter)
+        memo.close()
+        [memo_record] = [unit for unit in units if unit.get('memo')]
+        assert len(memo_record['section_ids']) == num_decided
+        memo_ids.append(memo_record['unit_id'])
+    assert memo_ids[0] != memo_ids[1]
@@ -0,0 +1,56 @@
+import random
+
+from prompt_cache import MIN_CACHEABLE_PREFIX_TOKENS
+from step_4_extraction import DocumentPromptBuilder, LineItemFragments, build_extraction_unit
+from token_counter import estimate_tokens
+
+SCHEMA = {"type": "object", "properties": {"amount": {"type": "number"}}}
+INSTRUCTIONS = {
+    name: {"Line item name": name, "Line item instruction": f"Extract the {name}.", "Line item schema": SCHEMA}
+    for name in ["Premium", "Retention", "Limit"]
+}
+
+
+def make_builder(num_sections, prefix_first=True):
+    rng = random.Random(0)
+    sections = [
+        {"id": f"doc{i:03d}", "title": f"Section {i}", "text": " ".join(f"word{rng.randrange(1000)}" for _ in range(150))}
+        for i in range(num_sections)
+    ]
+    fragments = LineItemFragments(INSTRUCTIONS, 'NO')
+    return DocumentPromptBuilder("doc", sections, '{"insured": "Acme"}', fragments, prefix_first=prefix_first)
+
+
+def prompt(unit):
+    return unit['create_params']['messages'][0]['content']
+
+
+def common_prefix(texts):
+    prefix = texts[0]
+    for text in texts[1:]:
+        while not text.startswith(prefix):
+            prefix = prefix[:-1]
+    return prefix
+
+
+def test_full_document_prompts_share_a_key_of_their_common_prefix():
+    builder = make_builder(20)
+    all_ids = set(builder.section_tokens)
+    units = [build_extraction_unit(builder.sample(name, all_ids, 'full'), "mock") for name in ["Premium", "Retention"]]
+    units.append(build_extraction_unit(builder.batch_sample(0, ["Premium", "Limit"], all_ids, 'full'), "mock"))
+    assert len({unit['prefix_key'] for unit in units}) == 1
+    # The key stands for the metadata and document blocks that every one of these prompts starts with.
+    shared = common_prefix([prompt(unit) for unit in units])
+    assert builder.document_block() in shared
+    assert estimate_tokens(shared) >= MIN_CACHEABLE_PREFIX_TOKENS
+
+
+def test_retrieved_prompts_are_keyed_by_their_own_sections():
+    builder = make_builder(20)
+    section_ids = sorted(builder.section_tokens)
+    same = [builder.sample(name, set(section_ids[:10]), 'retrieved') for name in ["Premium", "Retention"]]
+    other = builder.sample("Limit", set(section_ids[5:15]), 'retrieved')
+    assert same[0]['prefix_key'] == same[1]['prefix_key'] != other['prefix_key']
+    # A prefix shorter than the providers cache gets no key, and nothing is keyed without prefix-first prompts.
+    assert builder.sample("Premium", set(section_ids[:1]), 'retrieved')['prefix_key'] is None
+    assert make_builder(20, prefix_first=False).sample("Premium", set(section_ids), 'full')['prefix_key'] is None
@@ -0,0 +1,136 @@
+import time
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import make_unit
+import work_queue as work_queue_module
+from queue_worker import LeaseRenewer, retry_when_locked, run_worker
+from work_queue import MAX_LEASE_ATTEMPTS, SQLiteWorkQueue, run_queue
+
+
+def open_queue(tmp_path, units, queue_name="step"):
+    work_queue = SQLiteWorkQueue(str(tmp_path / "queue.sqlite"))
+    work_queue.open(queue_name)
+    work_queue.enqueue(queue_name, units, "run")
+    return work_queue
+
+
+def test_expired_lease_is_leased_again_and_stale_complete_dropped(tmp_path):
+    work_queue = open_queue(tmp_path, [make_unit("u0")])
+    [first] = work_queue.lease("w1", 10, lease_seconds=0.05)
+    assert work_queue.lease("w2", 10, lease_seconds=60) == []
+    time.sleep(0.1)
+    [second] = work_queue.lease("w2", 10, lease_seconds=60)
+    assert second['unit_id'] == "u0" and second['lease_id'] != first['lease_id']
+
+    # The first worker finishing late must not overwrite the unit leased by the second one.
+    work_queue.complete(first, {"id": "stale"})
+    assert work_queue.collect("step", "run") == []
+    work_queue.complete(second, {"id": "fresh"})
+    [(unit, response)] = work_queue.collect("step", "run")
+    assert unit['unit_id'] == "u0" and response == {"id": "fresh"}
+
+
+def test_complete_is_idempotent(tmp_path):
+    work_queue = open_queue(tmp_path, [make_unit("u0")])
+    [unit] = work_queue.lease("w1", 10, lease_seconds=60)
+    work_queue.complete(unit, {"id": "first"})
+    work_queue.complete(unit, {"id": "second"})
+    [(_, response)] = work_queue.collect("step", "run")
+    assert response == {"id": "first"}
+    work_queue.mark_collected("step", "u0")
+    work_queue.complete(unit, {"id": "third"})
+    assert work_queue.collect("step", "run") == []
+    assert work_queue.remaining("step", "run") == 0
+    assert work_queue.counts("step") == {"done": 1}
+
+
+def test_unit_given_up_after_max_lease_attempts(tmp_path):
+    work_queue = open_queue(tmp_path, [make_unit("u0")])
+    for attempt in range(MAX_LEASE_ATTEMPTS):
+        assert len(work_queue.lease(f"w{attempt}", 10, lease_seconds=0.01)) == 1
+        time.sleep(0.05)
+    assert work_queue.lease("w", 10, lease_seconds=60) == []
+    [(unit, response)] = work_queue.collect("step", "run")
+    assert unit['unit_id'] == "u0" and response is None
+
+
+def test_enqueue_keeps_uncollected_result_of_same_unit(tmp_path):
+    units = [make_unit("u0"), make_unit("u1")]
+    work_queue = open_queue(tmp_path, units)
+    for unit in work_queue.lease("w1", 10, lease_seconds=60):
+        work_queue.complete(unit, {"id": unit['unit_id']})
+    # A new coordinator run enqueues the same units plus a changed one.
+    work_queue.enqueue("step", [units[0], make_unit("u1", prompt_chars=5)], "run2")
+    assert [unit['unit_id'] for unit, _ in work_queue.collect("step", "run2")] == ["u0"]
+    assert [unit['unit_id'] for unit in work_queue.lease("w1", 10, lease_seconds=60)] == ["u1"]
+
+
+def test_lease_renewer_keeps_leases_alive(tmp_path):
+    work_queue = open_queue(tmp_path, [make_unit("u0")])
+    assert len(work_queue.lease("w1", 10, lease_seconds=0.2)) == 1
+    with LeaseRenewer(work_queue, "w1", lease_seconds=0.2):
+        time.sleep(0.6)
+        assert work_queue.lease("w2", 10, lease_seconds=60) == []
+    time.sleep(0.3)
+    assert len(work_queue.lease("w2", 10, lease_seconds=60)) == 1
+
+
+def test_worker_answers_coordinator_until_drained(tmp_path, mock_server):
+    units = [make_unit(f"u{i}", 10 * i) for i in range(6)]
+    path = str(tmp_path / "queue.sqlite")
+    work_queue = SQLiteWorkQueue(path)
+    # Opened before the worker starts, which would otherwise find no coordinator waiting and return.
+    work_queue.open("step")
+    num_answered = []
+    # The worker runs in another thread with its own connection, like a worker process would.
+    worker = threading.Thread(target=lambda: num_answered.append(
+        run_worker(SQLiteWorkQueue(path), "w1", 2, lease_seconds=1, poll_seconds=0.01, cache_mode='off')
+    ))
+    worker.start()
+    responses = {}
+    run_queue(units, work_queue, "step", lambda unit, response: responses.__setitem__(unit['unit_id'], response), poll_seconds=0.01)
+    worker.join(30)
+    assert num_answered == [len(units)]
+    assert all(responses[unit['unit_id']] is not None for unit in units)
+
+
+def test_enqueue_does_not_lock_workers_out_while_units_are_built(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue_module, "ENQUEUE_CHUNK_SIZE", 2)
+    work_queue = open_queue(tmp_path, [])
+    worker_queue = SQLiteWorkQueue(str(tmp_path / "queue.sqlite"))
+    # Fail right away instead of waiting for the lock.
+    worker_queue.conn.execute("PRAGMA busy_timeout = 0")
+    leased = []
+
+    def units():
+        for i in range(5):
+            if i == 3:
+                # The first chunk is committed, and the write lock is free while the next units are built.
+                leased.extend(worker_queue.lease("w1", 10, lease_seconds=60))
+            yield make_unit(f"u{i}")
+
+    assert work_queue.enqueue("step", units(), "run") == 5
+    assert sorted(unit['unit_id'] for unit in leased) == ["u0", "u1"]
+    assert work_queue.counts("step") == {"leased": 2, "pending": 3}
+
+
+def test_worker_retries_queue_operations_while_database_is_locked():
+    calls = []
+
+    def lease():
+        calls.append(None)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return ["unit"]
+
+    assert retry_when_locked(lease, "w1", poll_seconds=0) == ["unit"]
+    assert len(calls) == 3
+
+    def broken():
+        raise sqlite3.OperationalError("no such table: units")
+
+    with pytest.raises(sqlite3.OperationalError):
+        retry_when_locked(broken, "w1", poll_seconds=0)